@@ -82,8 +82,8 @@ function patchTraining (id, data) {
   return request({ method: 'PATCH', url: `/api/admin/cardpc/zhixiang/training/${id}`, data })
 }
 
-function exportTrainingData () {
-  return request({ method: 'POST', url: `/api/admin/cardpc/zhixiang/training/export`, responseType: 'blob' })
+function exportTraining (params) {
+  return request({ method: 'POST', url: `/api/admin/cardpc/zhixiang/training/export`, params })
 }
 
 function trainingPassQualification (id, examination) {
@@ -134,6 +134,10 @@ function listDocument (params) {
   return request({ method: 'GET', url: `/api/admin/cardpc/project/documents`, params })
 }
 
+function exportDocument (params) {
+  return request({ method: 'POST', url: `/api/admin/cardpc/project/documents/export`, params })
+}
+
 function getDocument ({ id }) {
   return request({ method: 'GET', url: `/api/admin/cardpc/project/documents/${id}` })
 }
@@ -244,7 +248,7 @@ export default {
       trainingRejectQualification,
       getTrainingSearchForm: () => getTrainingForm('search'),
       getTrainingEditForm: () => getTrainingForm('edit'),
-      exportTrainingData,
+      exportTraining,
     },
 
     project: {
@@ -257,6 +261,7 @@ export default {
       getProjectEditForm: () => getProjectForm('edit'),
 
       listDocument,
+      exportDocument,
       getDocument,
       createDocument,
       patchDocument,
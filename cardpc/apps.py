@@ -56,3 +56,6 @@ class CardpcConfig(AppConfig):
 
         # 将页面类型挂载到 ProjectPage 上，方便以后直接访问
         ProjectPage.PAGE_TYPES = TYPES
+
+        # 注册 signal handlers
+        from . import signals
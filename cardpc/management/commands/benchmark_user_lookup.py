@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+import time
+import random
+import string
+
+from cardpc.models import User
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ('向用户表中写入大量（默认最多 100 万个）用户，比较登录时按用户名/手机号/邮箱查找用户的耗时：'
+            'UserManager.get_by_natural_key()（先判断格式，只查询一个索引）与原来 OR 三个条件的查询。'
+            '所有数据在一个事务中写入，结束后回滚，不会保留在数据库中')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000', help='依次写入到这些数量后各测量一次，以逗号分隔')
+        parser.add_argument('--lookups', type=int, default=200, help='每次测量、每种查询执行的次数')
+        parser.add_argument('--explain', action='store_true', help='输出最后一次测量时的查询计划')
+
+    def seed(self, start, count):
+        """
+        写入 count 个用户，返回 [(username, phone, email)]。密码设置为不可用（'!'），避免计算哈希
+        """
+        identities = []
+        batch = []
+        for i in range(start, start + count):
+            username = f'bench_{i}_' + ''.join(random.choices(string.ascii_lowercase, k=4))
+            phone = f'139{i:08d}'
+            email = f'Bench.{i}@Example.com'
+            identities.append((username, phone, email))
+            batch.append(User(
+                    username = username,
+                    password = '!',
+                    phone = phone,
+                    phone_validated = random.random() < 0.8,
+                    email = email,
+                    email_validated = random.random() < 0.5,
+                    ))
+            if len(batch) >= 5000:
+                User.objects.bulk_create(batch)
+                batch = []
+        User.objects.bulk_create(batch)
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(User._meta.db_table)}')
+        return identities
+
+    def legacy_get(self, username):
+        # 原来的 get_by_natural_key()，OR 三个条件，email 使用 iexact
+        return User.objects.get(
+                Q(username=username) |
+                Q(phone_validated=True, phone=username) |
+                Q(email_validated=True, email__iexact=username)
+                )
+
+    def measure(self, lookup, samples):
+        start = time.perf_counter()
+        for identity in samples:
+            try:
+                lookup(identity)
+            except User.DoesNotExist:
+                pass
+        return (time.perf_counter() - start) / len(samples) * 1000
+
+    def explain(self, username, phone, email):
+        for title, queryset in (
+                ('legacy', User.objects.filter(
+                    Q(username=phone) | Q(phone_validated=True, phone=phone) | Q(email_validated=True, email__iexact=phone))),
+                ('phone', User.objects.filter(phone_validated=True, phone=phone)),
+                ('email', User.objects.annotate(email_lower=Lower('email'))
+                    .filter(email_validated=True, email_lower=email.lower())),
+                ('username', User.objects.filter(username=username)),
+                ):
+            self.stdout.write(f'{title}:')
+            self.stdout.write(queryset.explain())
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        try:
+            with transaction.atomic():
+                identities = []
+                for size in sizes:
+                    start = time.perf_counter()
+                    identities += self.seed(len(identities), size - len(identities))
+                    seeded = time.perf_counter() - start
+
+                    self.stdout.write(f'{size:>10} users (seeded in {seeded:.1f}s):')
+                    for kind, pos in (('username', 0), ('phone', 1), ('email', 2)):
+                        samples = [random.choice(identities)[pos] for i in range(options['lookups'])]
+                        if kind == 'email':
+                            # 登录时用户输入的邮箱大小写可能与注册时不同
+                            samples = [email.lower() for email in samples]
+                        legacy = self.measure(self.legacy_get, samples)
+                        current = self.measure(User.objects.get_by_natural_key, samples)
+                        self.stdout.write(f'    {kind:<8} legacy {legacy:8.3f} ms, get_by_natural_key {current:8.3f} ms')
+
+                if options['explain']:
+                    self.explain(*identities[0])
+                raise Rollback()
+        except Rollback:
+            pass
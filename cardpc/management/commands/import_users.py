@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import os
+
+from cardpc import provisioning
+
+class Command(BaseCommand):
+    help = '从 csv 或 xlsx 文件批量创建用户（见 cardpc.provisioning），有错误的行会被跳过'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='csv 或 xlsx 文件，第一行为表头（手机号、邮箱、密码、用户名）')
+        parser.add_argument('--format', choices=['csv', 'xlsx'], help='文件格式，默认根据扩展名判断')
+        parser.add_argument('--unvalidated', action='store_true', help='不将手机号、邮箱标记为已验证')
+        parser.add_argument('--workers', type=int, help='计算密码哈希的进程数，默认为 CPU 数量')
+        parser.add_argument('--dry-run', action='store_true', help='只校验，不创建用户')
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if format not in ('csv', 'xlsx'):
+            raise CommandError(f'unknown format: {format}, use --format csv/xlsx')
+
+        with open(options['path'], 'rb') as fp:
+            try:
+                rows = provisioning.read_users(fp, format)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        result = provisioning.create_users_bulk(rows,
+                validated = not options['unvalidated'],
+                workers = options['workers'],
+                dry_run = options['dry_run'],
+                )
+
+        for line, message in result.errors:
+            self.stdout.write(f'line {line}: {message}')
+        action = 'would be created' if options['dry_run'] else 'created'
+        self.stdout.write(f'{len(rows)} row(s), {result.created} user(s) {action}, {len(result.errors)} error(s)')
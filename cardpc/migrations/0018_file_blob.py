@@ -0,0 +1,20 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media', '0011_blob'),
+        ('cardpc', '0017_auto_20190606_0949'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectgalleryimage',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='media.Blob'),
+        ),
+    ]
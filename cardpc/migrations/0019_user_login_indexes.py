@@ -0,0 +1,23 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardpc', '0018_file_blob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(phone_validated=True), fields=['phone'], name='cardpc_user_phone_idx'),
+        ),
+        # 按已验证的邮箱（不区分大小写）登录、查找用户，见 UserManager.get_by_email()
+        # Django 2.2 的 Index 不支持表达式，因此直接使用 SQL（postgres、sqlite 均支持）
+        migrations.RunSQL(
+            'CREATE INDEX "cardpc_user_email_lower_idx" ON "cardpc_user" (lower("email")) WHERE "email_validated" = true',
+            'DROP INDEX "cardpc_user_email_lower_idx"',
+        ),
+    ]
@@ -0,0 +1,57 @@
+from django.db import migrations
+
+
+# PresentationLesson.STATUSES.published
+LESSON_PUBLISHED = 1
+
+
+def refresh_b_status(apps, schema_editor):
+    """
+    此前课程学习状态在访问培训页面时才计算，已学完但还没有访问过页面的用户 b_status 仍然为 1。
+    现在读取时不再计算，因此这里一次性计算所有记录（与 ZhixiangTraining.refresh_b() 相同：
+    课程中所有已发布的 lesson 对应的 PPT 都已经看完，没有 lesson 的课程视为已学完）
+    """
+    ZhixiangTraining = apps.get_model('cardpc', 'ZhixiangTraining')
+    PresentationLesson = apps.get_model('course', 'PresentationLesson')
+    PresentationWatchRecord = apps.get_model('media', 'PresentationWatchRecord')
+
+    queryset = ZhixiangTraining.objects \
+            .filter(b_status=1, examination__isnull=False) \
+            .order_by('id') \
+            .values_list('id', 'user_id', 'examination__course_id')
+    last_id = 0
+    while True:
+        records = list(queryset.filter(id__gt=last_id)[:500])
+        if not records:
+            return
+
+        lessons = {course_id: set() for id, user_id, course_id in records}
+        for course_id, presentation_id in PresentationLesson.objects \
+                .filter(course_id__in=lessons.keys(), status=LESSON_PUBLISHED) \
+                .values_list('course_id', 'presentation_id'):
+            lessons[course_id].add(presentation_id)
+
+        watched = {user_id: set() for id, user_id, course_id in records}
+        presentation_ids = set.union(*lessons.values())
+        if presentation_ids:
+            for user_id, presentation_id in PresentationWatchRecord.objects \
+                    .filter(user_id__in=watched.keys(), presentation_id__in=presentation_ids, watched=True) \
+                    .values_list('user_id', 'presentation_id'):
+                watched[user_id].add(presentation_id)
+
+        finished = [id for id, user_id, course_id in records if lessons[course_id] <= watched[user_id]]
+        ZhixiangTraining.objects.filter(id__in=finished).update(b_status=2)
+        last_id = records[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardpc', '0019_user_login_indexes'),
+        ('course', '0003_auto_20190509_2355'),
+        ('media', '0011_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(refresh_b_status, migrations.RunPython.noop),
+    ]
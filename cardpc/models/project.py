@@ -1,4 +1,6 @@
 from django.db import models
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.urls import reverse
 from django.utils.functional import cached_property
 
@@ -10,12 +12,13 @@ import jsonfield
 import json
 import os
 
-from natureself.django.media.models import AbstractFile
+from natureself.django.media.models import AbstractFile, ImageRenditionMixin
 from natureself.django.core.model_mixins import Orderable
 from natureself.django.core.utils import get_pagination, serialize_datetime
 from natureself.admin.forms import Form, panels, choices
 
 from cardpc.panels import ProjectGalleryEditorPanel, ProjectCarouselEditorPanel, ProjectPageAttachmentPanel
+from cardpc import pagecache
 
 class Project(models.Model):
     # 专题名称
@@ -39,6 +42,11 @@ class Project(models.Model):
     def colors(self):
         return self.theme_colors
 
+    @classmethod
+    def get_serialize_related(cls, with_menu=False, **kwargs):
+        # 见 natureself.django.core.serialize，菜单树通过 ProjectNavMenu.objects.get_tree() 加载
+        return ['banner', 'banner_background', 'menu'] if with_menu else ['banner', 'banner_background']
+
     def serialize(self, to_dict=True, with_menu=False):
         data = dict(
                 id = self.id,
@@ -57,6 +65,103 @@ class Project(models.Model):
 
         return data if to_dict else json.dumps(data, ensure_ascii=False)
 
+def _get_subclass_instance(page, subclasses):
+    """
+    参考 django-model-utils 中 InheritanceQuerySet 的实现，从 select_related 的结果中取出页面的实际子类
+    """
+    # 与 model-utils 一样，长的路径优先，以便 'a' 与 'a__b' 同时存在时，选择更深的子类
+    for path in sorted(subclasses, key=len, reverse=True):
+        obj = page
+        for name in path.split('__'):
+            try:
+                obj = getattr(obj, name)
+            except ObjectDoesNotExist:
+                obj = None
+                break
+        if obj:
+            return obj
+    return page
+
+class ProjectNavMenuManager(models.Manager):
+    def get_tree(self, root_id):
+        """
+        获取以 root_id 为根的整棵菜单树（包括每个菜单项链接的页面），返回根节点。
+
+        返回的每一个节点都已经设置好了 children、parent、root、link_page（页面的实际子类），
+        渲染菜单时不会再查询数据库。
+
+        结果按照专题数据的版本号缓存（见 cardpc.pagecache），当菜单、页面被修改时，版本号会递增，缓存自动失效。
+        由于缓存中取出的是新反序列化的对象，调用者可以放心的修改节点（例如设置 active）。
+        """
+        cache_key = f'cardpc:project-menu:{pagecache.get_version()}:{root_id}'
+        root = cache.get(cache_key)
+        if root is None:
+            root = self.build_tree(root_id)
+            cache.set(cache_key, root, timeout=pagecache.PAGE_CACHE_TIMEOUT)
+        return root
+
+    def build_tree(self, root_id):
+        """
+        使用一次查询取出整棵菜单树，不使用缓存。一般请使用 get_tree()。
+
+        菜单树中的节点通过 WITH RECURSIVE 查询（sqlite、postgres 均支持），
+        同时通过 select_related 取出链接的页面、页面所属的专题，以及页面的所有子类。
+        """
+        # 注意这里不能用 filter(id__in=RawSQL(...))，Django 会在 RawSQL 外面再加一层括号，
+        # 数据库会将其当作标量子查询，只返回第一行
+        table = self.model._meta.db_table
+        tree_ids = f"""{table}.id IN (
+            WITH RECURSIVE tree(id) AS (
+                SELECT id FROM {table} WHERE id = %s
+                UNION ALL
+                SELECT m.id FROM {table} m INNER JOIN tree ON m.parent_id = tree.id
+            )
+            SELECT id FROM tree
+            )"""
+
+        subclasses = ProjectPage.objects.select_subclasses().subclasses
+        nodes = list(self.get_queryset()
+                .extra(where=[tree_ids], params=[root_id])
+                .select_related('link_page', 'link_page__project', *[f'link_page__{s}' for s in subclasses])
+                .order_by('sort_order', 'id'))
+
+        nodes_by_id = { node.id: node for node in nodes }
+        if root_id not in nodes_by_id:
+            raise self.model.DoesNotExist()
+        top = nodes_by_id[root_id]
+        # 如果 root_id 不是根节点（获取的是一棵子树），那么子树中节点的 root 仍然需要查询得到
+        root = top if not top.parent_id else None
+
+        parent_field = self.model._meta.get_field('parent')
+        link_page_field = self.model._meta.get_field('link_page')
+        project_field = ProjectPage._meta.get_field('project')
+
+        for node in nodes:
+            node._cached_children = []
+
+        for node in nodes:
+            if node.link_page_id:
+                page = node.link_page
+                if page.status == ProjectPage.STATUSES.published:
+                    sub_page = _get_subclass_instance(page, subclasses)
+                    if sub_page is not page:
+                        project_field.set_cached_value(sub_page, page.project)
+                else:
+                    # 与原来的实现一致，菜单中只显示已发布的页面，这里不修改 link_page_id
+                    sub_page = None
+                link_page_field.set_cached_value(node, sub_page)
+
+            parent = nodes_by_id.get(node.parent_id)
+            if parent and node is not top:
+                parent_field.set_cached_value(node, parent)
+                parent._cached_children.append(node)
+
+            if root:
+                # 预先设置 cached_property，避免逐级查询 parent
+                node.__dict__['root'] = root
+
+        return top
+
 class ProjectNavMenu(Orderable, models.Model):
     """
     专题导航菜单
@@ -64,8 +169,11 @@ class ProjectNavMenu(Orderable, models.Model):
     目前暂时仅支持一级菜单，即每个菜单项都对应一个页面或外部地址，
     不支持子菜单（任何形式的子菜单，包括静态配置的、动态发现的）。
 
-    不过我们在实现时，预留对将来对子菜单的支持。
+    不过我们在实现时，预留对将来对子菜单的支持。菜单树通过 ProjectNavMenu.objects.get_tree()
+    一次性加载，该函数支持任意层级的菜单。
     """
+    objects = ProjectNavMenuManager()
+
     # 父节点，如果 parent 为 null，则表示该节点为根节点
     parent = models.ForeignKey('self', models.CASCADE, null=True, related_name='children')
 
@@ -84,8 +192,8 @@ class ProjectNavMenu(Orderable, models.Model):
 
     @cached_property
     def root(self):
-        # TODO optomize
-        if not self.parent:
+        # 通过 get_tree() 加载的节点已经预先设置了 root，不会执行到这里
+        if not self.parent_id:
             return self
         else:
             return self.parent.root
@@ -94,7 +202,7 @@ class ProjectNavMenu(Orderable, models.Model):
         if self.text:
             return self.text
 
-        if not self.parent:
+        if not self.parent_id:
             # 根节点没有 text 值，根节点不应该被渲染
             return 'ROOT'
 
@@ -109,40 +217,42 @@ class ProjectNavMenu(Orderable, models.Model):
             return 'NO-TEXT'
 
     def get_url(self):
-        if not self.parent:
+        if not self.parent_id:
             return None
         if self.link_type == self.LINK_TYPES.external:
             return self.link_url
         elif self.link_type == self.LINK_TYPES.page:
-            return self.link_page.url
+            return self.link_page.url if self.link_page else None
 
     def get_children(self):
         if not hasattr(self, '_cached_children'):
-            # TODO 现在我们只支持一级菜单，将来这里需要支持多级菜单
-            if self.parent_id:
-                self._cached_children = list()
-            else:
-                self._cached_children = list(self.children.all().prefetch_related(
-                    models.Prefetch('link_page', queryset=ProjectPage.published.select_subclasses())
-                    ))
+            # 通过 get_tree() 加载的节点已经设置了 _cached_children，
+            # 对于单独获取的节点，我们加载以该节点为根的子树
+            self._cached_children = ProjectNavMenu.objects.get_tree(self.id).get_children()
         return self._cached_children
 
     def get_active(self, page):
         """
         根据页面判断当前导航项是否为 active
+
+        如果当前导航项链接的页面包含 page，或者任一子菜单项为 active，则当前导航项为 active
         """
-        if self.link_type != self.LINK_TYPES.page:
-            # 如果链接类型不是内部页面，则一定非 active
-            return False
+        if self.link_type == self.LINK_TYPES.page and self.link_page and self.link_page.is_subpage(page):
+            return True
 
-        return self.link_page.is_subpage(page)
+        return any(child.get_active(page) for child in self.get_children())
+
+    @classmethod
+    def get_serialize_related(cls, **kwargs):
+        # 子菜单由 get_children() 加载，这里仅需要根节点对应的专题
+        return ['project', 'project__banner', 'project__banner_background']
 
     def serialize(self, to_dict=True):
         data = dict(
                 id = self.id,
                 sort_order = self.sort_order,
                 parent = dict(id=self.parent_id),
-                project = self.project.serialize(with_menu=False) if not self.parent else None,
+                project = self.project.serialize(with_menu=False) if not self.parent_id else None,
                 children = [child.serialize() for child in self.get_children()],
                 link_type = self.link_type,
                 link_url = self.link_url,
@@ -163,6 +273,10 @@ class ProjectDocument(models.Model):
     # 标签，只能填一个。前端可以提供下拉框选择，也可以用户自行创建，取值如 哮喘、间质性肺炎
     tag = models.TextField(verbose_name='标签')
 
+    @classmethod
+    def get_serialize_related(cls, **kwargs):
+        return ['project', 'project__banner', 'project__banner_background', 'document']
+
     def serialize(self, to_dict=True):
         data = dict(
                 id = self.id,
@@ -235,7 +349,7 @@ class ProjectPage(models.Model):
     def get_context(self, request):
         page = self
         project = self.project
-        menu = self.project.menu.get_children()
+        menu = ProjectNavMenu.objects.get_tree(project.menu_id).get_children()
         for child in menu:
             child.active = child.get_active(self)
         attachments = list(self.attachments.all())
@@ -249,6 +363,14 @@ class ProjectPage(models.Model):
     def url(self):
         return reverse('project-page', kwargs=dict(project_slug=self.project.slug, page_id=self.id))
 
+    @classmethod
+    def get_serialize_related(cls, simple=False, **kwargs):
+        # 见 natureself.django.core.serialize，子类可以重载并在此基础上增加 lookup
+        if simple:
+            # 页面 url 中包含专题的 slug
+            return ['project']
+        return ['project', 'project__banner', 'project__banner_background', 'attachments']
+
     def serialize(self, to_dict=True, simple=False):
         # simple 模式是给菜单序列化用的
         data = dict(
@@ -338,6 +460,11 @@ class ProjectHomepage(ProjectPage):
 
         return context
 
+    @classmethod
+    def get_serialize_related(cls, simple=False, **kwargs):
+        lookups = super().get_serialize_related(simple=simple, **kwargs)
+        return lookups if simple else lookups + ['carousel_items__image']
+
     def serialize(self, to_dict=True, simple=False):
         data = super().serialize(to_dict=True, simple=simple)
         if not simple:
@@ -358,6 +485,10 @@ class ProjectCarouselItem(Orderable):
     title = models.TextField(verbose_name='标题')
     link_url = models.TextField(verbose_name='链接地址', blank=True)
 
+    @classmethod
+    def get_serialize_related(cls, **kwargs):
+        return ['image']
+
     def serialize(self, to_dict=True):
         data = dict(
                 id = self.id,
@@ -395,6 +526,11 @@ class ProjectNews(ProjectPage):
         context['news'] = self
         return context
 
+    @classmethod
+    def get_serialize_related(cls, simple=False, **kwargs):
+        lookups = super().get_serialize_related(simple=simple, **kwargs)
+        return lookups if simple else lookups + ['cover_picture']
+
     def serialize(self, to_dict=True, simple=False):
         data = super().serialize(to_dict=True, simple=simple)
         if not simple:
@@ -472,6 +608,11 @@ class ProjectGallery(ProjectPage):
 
         return context
 
+    @classmethod
+    def get_serialize_related(cls, simple=False, **kwargs):
+        lookups = super().get_serialize_related(simple=simple, **kwargs)
+        return lookups if simple else lookups + ['images']
+
     def serialize(self, to_dict=True, simple=False):
         data = super().serialize(to_dict=True, simple=simple)
         if not simple:
@@ -487,7 +628,7 @@ class ProjectGallery(ProjectPage):
             ProjectGalleryEditorPanel('images', form_field_property='id'),
         ]
 
-class ProjectGalleryImage(Orderable, AbstractFile):
+class ProjectGalleryImage(ImageRenditionMixin, Orderable, AbstractFile):
     """
     花絮集锦中的图片
     """
@@ -575,6 +716,11 @@ class ProjectVideo(ProjectPage):
     # 讲者简介 富文本
     teacher_introduction = models.TextField(verbose_name='讲者简介')
 
+    @classmethod
+    def get_serialize_related(cls, simple=False, **kwargs):
+        lookups = super().get_serialize_related(simple=simple, **kwargs)
+        return lookups if simple else lookups + ['video', 'video__owner', 'video__thumbnail']
+
     def serialize(self, to_dict=True, simple=False):
         data = super().serialize(to_dict=True, simple=simple)
         if not simple:
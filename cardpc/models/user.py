@@ -1,8 +1,11 @@
 from django.db import models
 from django.db.models import Q
+from django.db.models.functions import Lower
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, UserManager as DjangoUserManager
 
+from natureself.django.core.validators import is_valid_email, is_valid_phone
+
 import json
 import random
 import string
@@ -13,11 +16,22 @@ class UserManager(DjangoUserManager):
         phone = phone or ''
         return phone
 
+    def generate_random_usernames(self, count):
+        """
+        生成 count 个数据库中不存在的随机用户名，一次查询检查所有候选用户名，只有（极少出现的）重复的用户名需要重新生成
+        """
+        usernames = set()
+        while len(usernames) < count:
+            candidates = {
+                'cardpc_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=7))
+                for i in range(count - len(usernames))
+            } - usernames
+            taken = set(self.filter(username__in=candidates).values_list('username', flat=True))
+            usernames |= candidates - taken
+        return list(usernames)
+
     def generate_random_username(self):
-        while True:
-            username = 'cardpc_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=7))
-            if not self.filter(username=username).exists():
-                return username
+        return self.generate_random_usernames(1)[0]
 
     def create_user(self, username=None, phone=None, email=None, **kwargs):
         # 参考 Django 的 BaseUserManager，对 username、phone 进行 normalize
@@ -28,24 +42,61 @@ class UserManager(DjangoUserManager):
             username = self.generate_random_username()
         return super().create_user(username=username, phone=phone, email=email, **kwargs)
 
+    def get_by_phone(self, phone):
+        """
+        根据已验证的手机号查找用户（索引 cardpc_user_phone_idx）
+        """
+        return self.get(phone_validated=True, phone=phone)
+
+    def get_by_email(self, email):
+        """
+        根据已验证的邮箱查找用户，不区分大小写（索引 cardpc_user_email_lower_idx）
+
+        注意不能使用 email__iexact，在 postgres 中 iexact 是 UPPER(email) = UPPER(%s)，不会使用 lower(email) 的索引
+        """
+        return self.annotate(email_lower=Lower('email')).get(email_validated=True, email_lower=email.lower())
+
     def get_by_natural_key(self, username):
-        try:
-            return self.get(
-                Q(username=username) |
-                Q(phone_validated=True, phone=username) |
-                Q(email_validated=True, email__iexact=username)
-                )
-        except self.model.MultipleObjectsReturned:
-            # 在特殊情况下，有可能会选出多个用户，这会导致 Django 的 authenticate() 函数挂掉
-            # 因此我们 Hack 一下，这种情况下抛出 DoesNotExist
+        """
+        用户可以使用用户名、已验证的手机号或已验证的邮箱登录。
+
+        先根据格式判断 username 是手机号、邮箱还是用户名，只查询对应的一个索引（而不是 OR 三个条件）；
+        按手机号、邮箱找不到时，再按用户名查找（用户名也可以是手机号或邮箱的格式）。
+        """
+        if not username:
             raise self.model.DoesNotExist()
 
+        lookups = []
+        if is_valid_phone(username):
+            lookups.append(self.get_by_phone)
+        elif is_valid_email(username):
+            lookups.append(self.get_by_email)
+        lookups.append(lambda username: self.get(username=username))
+
+        for lookup in lookups:
+            try:
+                return lookup(username)
+            except self.model.DoesNotExist:
+                pass
+            except self.model.MultipleObjectsReturned:
+                # 在特殊情况下，有可能会选出多个用户，这会导致 Django 的 authenticate() 函数挂掉
+                # 因此我们 Hack 一下，这种情况下抛出 DoesNotExist
+                raise self.model.DoesNotExist()
+        raise self.model.DoesNotExist()
+
 class User(AbstractUser):
     """
     网站用户，普通会员、管理员均使用该 model
 
     需要在 settings.py 中设置：AUTH_USER_MODEL = 'cardpc.User'
     """
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # 按已验证的手机号登录、查找用户，见 UserManager.get_by_phone()
+            # lower(email) 的索引（cardpc_user_email_lower_idx）Django 2.2 不支持在这里定义，见迁移 0019
+            models.Index(fields=['phone'], name='cardpc_user_phone_idx', condition=Q(phone_validated=True)),
+        ]
+
     objects = UserManager()
 
     # username, email, password, is_active, is_staff, is_superuser 在 AbstractUser 中定义
@@ -1,14 +1,55 @@
 from django.db import models
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
-from django.utils.functional import cached_property
 
 import json
 from model_utils import Choices
 
 from natureself.django.core.utils import serialize_datetime
+from natureself.django.course import progress
+
+# 培训课程列表的缓存时间（秒），课程、lesson、考试修改时会主动失效（见 cardpc.signals）
+TRAINING_COURSES_CACHE_TIMEOUT = getattr(settings, 'CARDPC_TRAINING_COURSES_CACHE_TIMEOUT', 60 * 10)
+TRAINING_COURSES_CACHE_KEY = 'cardpc:zhixiang:training-courses'
+
+class ZhixiangExaminationManager(models.Manager):
+    def get_training_courses(self):
+        """
+        培训课程页显示的课程列表：关联了考试、并且有已发布 lesson 的课程。
+
+        每个课程已经设置了 thumbnail 与 presentationlessons（已发布的 lesson，以及 lesson.presentation），
+        结果会缓存，可以使用 progress.set_courses_progress() 设置用户的学习进度，不需要再查询数据库。
+        """
+        courses = cache.get(TRAINING_COURSES_CACHE_KEY)
+        if courses is None:
+            courses = self.build_training_courses()
+            cache.set(TRAINING_COURSES_CACHE_KEY, courses, timeout=TRAINING_COURSES_CACHE_TIMEOUT)
+        return courses
+
+    def build_training_courses(self):
+        """
+        不使用缓存，课程使用课程目录（Course.objects.get_catalog()），lesson 一次查询。一般请使用 get_training_courses()
+        """
+        Course = self.model._meta.get_field('course').related_model
+        course_ids = set(self.get_queryset().values_list('course_id', flat=True))
+        # 没有已发布 lesson 的课程不显示
+        courses = [course for course in Course.objects.get_catalog() if course.id in course_ids and course.published]
+
+        lessons = {course.id: [] for course in courses}
+        for lesson in progress.get_lessons_queryset(lessons.keys()).select_related('presentation'):
+            lessons[lesson.course_id].append(lesson)
+        for course in courses:
+            course.presentationlessons = lessons[course.id]
+
+        return [course for course in courses if course.presentationlessons]
+
+    def invalidate_training_courses(self):
+        cache.delete(TRAINING_COURSES_CACHE_KEY)
 
 class ZhixiangExamination(models.Model):
+    objects = ZhixiangExaminationManager()
+
     # 考试名称
     title = models.TextField(blank=False, verbose_name='名称')
     # 问卷星地址
@@ -40,8 +81,8 @@ class ZhixiangTraining(models.Model):
     a_end = models.DateTimeField(null=True, verbose_name='课程调研结束时间')
 
     B = Choices(
-            # 默认处于未学完课程的状态，代码中，当读取到状态为 1 时，应该重新根据实际情况计算用户是否已学完
-            # 如果发现已学完，就写入数据库，以后就不用再次计算了
+            # 默认处于未学完课程的状态。用户看完 PPT、关联的考试或课程的 lesson 变化时重新计算（见 refresh_b()），
+            # 已学完时写入数据库，以后就不用再次计算了。读取时直接使用 b_status，不再计算
             (1, '未学完课程'),
             (2, '已学完课程'),
             )
@@ -66,6 +107,11 @@ class ZhixiangTraining(models.Model):
     d_end = models.DateTimeField(null=True, verbose_name='考试评定结束时间')
 
     def get_b(self):
+        """
+        重新计算课程学习状态，已学完时写入数据库，返回 b_status。
+
+        在状态可能变化时调用（关联考试修改、用户看完 PPT 等），页面、接口中读取 b、b_status 不会触发计算
+        """
         # 如果之前已经将状态标记为了已学完相应课程，那么就永远都是已学完
         if self.b_status == 2:
             return self.b_status
@@ -80,19 +126,46 @@ class ZhixiangTraining(models.Model):
             return 1
 
         # 否则，计算用户学习情况，如果计算结果为已学完，那么需要把 b_status 设置为 2 并保存入数据库
-        course = self.examination.course
-        course.fetch_presentationlesson_details(self.user)
-        if course.all_presentationlessons_watched:
-            self.b_status = 2
-            self.save(update_fields=['b_status'])
-            return 2
-        return 1
+        self.fetch_b([self])
+        return self.b_status
+
+    @classmethod
+    def fetch_b(cls, records):
+        """
+        批量计算 records 的课程学习状态，学完的记录批量更新 b_status 为 2。
+        查询次数与记录数量无关（见 natureself.django.course.progress）
+        """
+        pending = [record for record in records if record.b_status == 1 and record.examination_id]
+        if pending:
+            courses = {record.id: record.examination.course_id for record in pending}
+            result = progress.get_progress([record.user_id for record in pending], courses.values())
+            finished = [record for record in pending if result[(record.user_id, courses[record.id])].all_watched]
+            if finished:
+                cls.objects.filter(id__in=[record.id for record in finished]).update(b_status=2)
+                for record in finished:
+                    record.b_status = 2
+
+    @classmethod
+    def refresh_b(cls, queryset, chunk_size=500):
+        """
+        重新计算 queryset 中未学完课程的记录（每 chunk_size 条记录查询一次），返回变为已学完的记录数量。
+        例如课程的 lesson 被修改后，关联该课程的所有用户都需要重新计算
+        """
+        queryset = queryset.filter(b_status=1, examination__isnull=False).select_related('examination').order_by('id')
+        count, last_id = 0, 0
+        while True:
+            records = list(queryset.filter(id__gt=last_id)[:chunk_size])
+            if not records:
+                return count
+            cls.fetch_b(records)
+            count += len([record for record in records if record.b_status == 2])
+            last_id = records[-1].id
 
     a = property(lambda self: self.a_status)
     a1 = property(lambda self: self.a == 1)
     a2 = property(lambda self: self.a == 2)
 
-    b = cached_property(lambda self: self.get_b())
+    b = property(lambda self: self.b_status)
     b1 = property(lambda self: self.b == 1)
     b2 = property(lambda self: self.b == 2)
 
@@ -114,6 +187,36 @@ class ZhixiangTraining(models.Model):
             setattr(self, field_name, timezone.now())
             self.save(update_fields=[field_name])
 
+    def get_default_tab(self):
+        """
+        培训页面默认显示的 tab：
+        (a1, *, *, *): 默认显示课程调研页
+        (a2, b2, c3, *): 默认显示考试页
+        其他情况显示培训课程页
+        """
+        if self.a1:
+            return 'a'
+        elif self.a2 and self.b2 and self.c3:
+            return 'd'
+        return 'b'
+
+    def get_exam_page_status(self):
+        """
+        考试评定页的状态：
+        (*, *, C1|C2|C4, *): 1. 文案提示请先通过资格审核
+        (*, B1, C3, D1): 2. 文案提示需要学习完某一个课程才能参加考试，请先学习
+        (*, B2, C3, D1): 3. 可以参加考试，显示「立即参加」按钮
+        (*, *, *, D2)：4. 文案提示已参加考试，等待官方公布考试结果，不显示「立即参加」按钮
+        """
+        if self.c1 or self.c2 or self.c4:
+            return 1
+        elif self.b1 and self.c3 and self.d1:
+            return 2
+        elif self.b2 and self.c3 and self.d1:
+            return 3
+        elif self.d2:
+            return 4
+
     def serialize(self, to_dict=True):
         data = dict(
                 id = self.id,
@@ -138,10 +241,24 @@ class ZhixiangTraining(models.Model):
 
         return data if to_dict else json.dumps(data, ensure_ascii=False)
 
+class ZhixiangNewsManager(models.Manager):
+    def get_list_queryset(self):
+        """
+        新闻列表（首页、列表页）使用的 queryset，按发布时间倒序。
+
+        列表中不显示正文，正文（富文本）可能很大，因此不读取 content 字段
+        """
+        return self.get_queryset() \
+                .select_related('thumbnail') \
+                .defer('content') \
+                .order_by('-publish_time', '-id')
+
 class ZhixiangNews(models.Model):
     """
     我们暂时先使用独立的知享新闻模块，等 CMS 开发好之后，再改为使用 CMS 页面
     """
+    objects = ZhixiangNewsManager()
+
     # 新闻标题
     title = models.TextField(verbose_name='新闻标题')
     # 新闻内容，富文本
@@ -0,0 +1,77 @@
+"""
+专题页面缓存
+
+专题页面只有在管理员编辑后才会变化，但每一次访问都需要查询页面、菜单、附件，并渲染模板。
+在会议当天，大量用户访问的都是相同的页面，因此我们把渲染后的 HTML 缓存起来。
+
+缓存的 key 由以下几部分组成：
+* 项目 slug、页面 id（专题首页的 id 记为 home）
+* UA 类型（pc/mobile），render_for_ua() 会根据 UA 选择不同的模板
+* querystring（例如新闻列表页的分页参数）
+* 全局版本号
+
+失效策略：专题相关的 model 被修改时（见 cardpc.signals），我们只递增版本号，
+旧版本的缓存不会再被读到，会在超时或被 cull 时清理掉，因此无需逐个删除缓存。
+
+注意：缓存使用 settings.CACHES 中的 default 缓存。我们用 gunicorn 多进程部署，
+因此该缓存必须是进程间共享的（例如文件缓存、memcached、redis），否则某个进程中递增的版本号，
+其他进程看不到。
+"""
+from django.core.cache import cache
+from django.conf import settings
+from django.http import HttpResponse
+
+import time
+import hashlib
+
+# 页面缓存的有效时间（秒），即使失效逻辑有遗漏，页面最多也只会延迟这么久更新
+PAGE_CACHE_TIMEOUT = getattr(settings, 'CARDPC_PAGE_CACHE_TIMEOUT', 60 * 10)
+
+VERSION_KEY = 'cardpc:project:version'
+
+def _new_version():
+    # 版本号的初始值使用当前时间（毫秒），如果版本号由于某种原因丢失（例如缓存被清空、被 cull），
+    # 新的版本号仍然大于此前使用过的所有版本号，不会读到旧的缓存
+    return int(time.time() * 1000)
+
+def get_version():
+    """
+    获取当前专题数据的版本号
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, _new_version(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def invalidate():
+    """
+    递增版本号，使所有专题页面的缓存失效
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # 版本号不存在
+        cache.set(VERSION_KEY, _new_version(), timeout=None)
+
+def get_page_cache_key(request, project_slug, page_id=None):
+    ua = 'mobile' if request.user_agent.is_mobile else 'pc'
+    query = sorted((key, request.GET.getlist(key)) for key in request.GET)
+    query = hashlib.md5(repr(query).encode()).hexdigest()
+    page_id = 'home' if page_id is None else page_id
+    slug = hashlib.md5(project_slug.encode()).hexdigest()
+
+    return f'cardpc:project-page:{get_version()}:{slug}:{page_id}:{ua}:{query}'
+
+def get_cached_page(cache_key):
+    cached = cache.get(cache_key)
+    if cached is None:
+        return None
+    content_type, content = cached
+    return HttpResponse(content, content_type=content_type)
+
+def set_cached_page(cache_key, response):
+    # 只缓存正常渲染的页面
+    if response.status_code != 200 or response.streaming:
+        return
+    cache.set(cache_key, (response['Content-Type'], response.content), timeout=PAGE_CACHE_TIMEOUT)
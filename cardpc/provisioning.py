@@ -0,0 +1,210 @@
+"""
+批量创建用户（例如会议参会人员名单导入）
+
+    with open('users.xlsx', 'rb') as fp:
+        rows = read_users(fp, 'xlsx')
+        result = create_users_bulk(rows)
+    result.created, result.errors
+
+也可以使用命令 `python manage.py import_users users.xlsx`。
+
+文件的第一行为表头，可以使用中文或英文列名（见 HEADERS），其他列会被忽略。每个用户至少需要手机号、邮箱中的一个：
+
+    手机号,邮箱,密码,用户名
+    13912345678,zhangsan@example.com,,
+
+与逐个调用 User.objects.create_user() 相比：
+
+* 所有行先校验（格式、文件内重复、数据库中已存在），每 BATCH_SIZE 行只查询一次数据库
+* 随机用户名每批一次查询（UserManager.generate_random_usernames()），而不是每个用户名一次查询
+* 用户通过 bulk_create 写入
+* 密码哈希（PBKDF2）是 CPU 密集的操作，行数较多时使用多个进程计算。没有密码的用户设置为不可用的密码，
+  只能使用验证码登录
+"""
+import django
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models.functions import Lower
+
+import io
+import os
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from natureself.django.core.validators import is_valid_email, is_valid_phone
+
+from cardpc.models import User
+
+# 每批校验、写入的行数
+BATCH_SIZE = 500
+# 密码数量超过该值时，使用多个进程计算哈希（启动进程需要加载 Django，数量较少时不值得）
+POOL_THRESHOLD = 100
+
+# 表头 -> 字段
+HEADERS = {
+    'username': 'username', '用户名': 'username',
+    'phone': 'phone', '手机号': 'phone', '手机': 'phone',
+    'email': 'email', '邮箱': 'email',
+    'password': 'password', '密码': 'password',
+}
+FIELDS = ('username', 'phone', 'email', 'password')
+
+class ProvisionResult:
+    def __init__(self):
+        # 创建的用户数量
+        self.created = 0
+        # [(行号, 错误信息)]，有错误的行不会创建用户
+        self.errors = []
+
+def to_str(value):
+    if value is None:
+        return ''
+    # xlsx 中的手机号可能是数字
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def iter_csv(fp):
+    # 兼容 Excel 保存的带 BOM 的 csv
+    yield from csv.reader(io.TextIOWrapper(fp, encoding='utf-8-sig', newline=''))
+
+def iter_xlsx(fp):
+    # 只在导入 xlsx 时需要 openpyxl
+    import openpyxl
+    workbook = openpyxl.load_workbook(fp, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def read_users(fp, format):
+    """
+    从以二进制方式打开的文件中读取用户，返回 [(行号, {字段: 值})]
+    """
+    if format == 'csv':
+        rows = iter_csv(fp)
+    elif format == 'xlsx':
+        rows = iter_xlsx(fp)
+    else:
+        raise ValueError(f'unknown format: {format}')
+
+    header = next(rows, None)
+    if not header:
+        return []
+    columns = [HEADERS.get(to_str(title).lower()) for title in header]
+    if not any(columns):
+        raise ValueError(f'no known columns in header, expecting some of: {", ".join(HEADERS)}')
+
+    users = []
+    for line, values in enumerate(rows, start=2):
+        data = {field: '' for field in FIELDS}
+        for field, value in zip(columns, values):
+            if field:
+                data[field] = to_str(value)
+        # 跳过空行
+        if any(data.values()):
+            users.append((line, data))
+    return users
+
+def validate(rows, seen):
+    """
+    校验一批用户，返回 (有效的行, 错误)。seen 记录已经出现过的手机号、邮箱、用户名，用于检查文件内的重复
+    """
+    valid, errors = [], []
+    for line, data in rows:
+        data['email'] = User.objects.normalize_email(data['email']) if data['email'] else ''
+        if not data['phone'] and not data['email']:
+            errors.append((line, '缺少手机号或邮箱'))
+        elif data['phone'] and not is_valid_phone(data['phone']):
+            errors.append((line, f'手机号无效: {data["phone"]}'))
+        elif data['email'] and not is_valid_email(data['email']):
+            errors.append((line, f'邮箱无效: {data["email"]}'))
+        else:
+            keys = [('phone', data['phone']), ('email', data['email'].lower()), ('username', data['username'])]
+            duplicated = [value for field, value in keys if value and (field, value) in seen]
+            if duplicated:
+                errors.append((line, f'与文件中之前的行重复: {duplicated[0]}'))
+            else:
+                seen.update((field, value) for field, value in keys if value)
+                valid.append((line, data))
+
+    # 数据库中已经存在的手机号、邮箱（已验证）、用户名，每种一次查询
+    phones = {data['phone'] for line, data in valid if data['phone']}
+    emails = {data['email'].lower() for line, data in valid if data['email']}
+    usernames = {data['username'] for line, data in valid if data['username']}
+    existing = set()
+    if phones:
+        existing |= {('phone', phone) for phone in User.objects
+                .filter(phone_validated=True, phone__in=phones).values_list('phone', flat=True)}
+    if emails:
+        existing |= {('email', email) for email in User.objects.annotate(email_lower=Lower('email'))
+                .filter(email_validated=True, email_lower__in=emails).values_list('email_lower', flat=True)}
+    if usernames:
+        existing |= {('username', username) for username in User.objects
+                .filter(username__in=usernames).values_list('username', flat=True)}
+
+    result = []
+    for line, data in valid:
+        for key in (('phone', data['phone']), ('email', data['email'].lower()), ('username', data['username'])):
+            if key in existing:
+                errors.append((line, f'已注册: {key[1]}'))
+                break
+        else:
+            result.append((line, data))
+    return result, errors
+
+def hash_passwords(passwords, workers=None):
+    """
+    计算密码哈希，空密码返回不可用的密码。数量超过 POOL_THRESHOLD 时使用 workers 个进程（默认为 CPU 数量）
+    """
+    workers = workers or os.cpu_count() or 1
+    if len([p for p in passwords if p]) < POOL_THRESHOLD or workers == 1:
+        return [make_password(password or None) for password in passwords]
+
+    # 使用 spawn 而不是 fork：fork 的子进程会继承父进程的数据库连接，子进程退出时可能会关闭父进程的连接。
+    # 子进程只需要加载 settings（密码哈希算法），注意不能在子进程中导入本模块（导入 models 需要先 django.setup()）
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup) as executor:
+        return list(executor.map(make_password, [password or None for password in passwords], chunksize=20))
+
+def create_users_bulk(rows, validated=True, workers=None, dry_run=False, batch_size=BATCH_SIZE):
+    """
+    rows: read_users() 的返回值，[(行号, {字段: 值})]
+    validated: 是否将导入的手机号、邮箱标记为已验证（已验证的手机号、邮箱才能用于登录）
+    dry_run: 只校验，不创建用户
+
+    返回 ProvisionResult。先校验所有行，再每批（batch_size 行）在一个事务中写入
+    """
+    result = ProvisionResult()
+    seen = set()
+    valid = []
+    for i in range(0, len(rows), batch_size):
+        batch, errors = validate(rows[i:i+batch_size], seen)
+        valid += batch
+        result.errors += errors
+    result.errors.sort()
+    if dry_run:
+        result.created = len(valid)
+        return result
+
+    # 所有密码一起计算，只启动一次进程池
+    passwords = hash_passwords([data['password'] for line, data in valid], workers=workers)
+    for i in range(0, len(valid), batch_size):
+        batch = valid[i:i+batch_size]
+        usernames = iter(User.objects.generate_random_usernames(len([1 for line, data in batch if not data['username']])))
+        users = [
+            User(
+                username = data['username'] or next(usernames),
+                password = password,
+                phone = data['phone'],
+                phone_validated = validated and bool(data['phone']),
+                email = data['email'],
+                email_validated = validated and bool(data['email']),
+            )
+            for (line, data), password in zip(batch, passwords[i:i+batch_size])
+        ]
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        result.created += len(users)
+    return result
@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+
+from natureself.django.course.models import Course, PresentationLesson
+from natureself.django.media.signals import presentation_watched
+
+from cardpc import pagecache
+from cardpc.models import Project, ProjectPage, ProjectNavMenu, ProjectCarouselItem, ProjectGalleryImage, ProjectDocument
+from cardpc.models import ZhixiangExamination, ZhixiangTraining, ZhixiangNews
+
+# 这些 model 的修改会影响专题页面的渲染结果
+PAGE_CACHE_MODELS = (
+        Project,
+        ProjectPage,
+        ProjectNavMenu,
+        ProjectCarouselItem,
+        ProjectGalleryImage,
+        ProjectDocument,
+        )
+
+# 注意失效需要在事务提交之后进行，否则在事务提交之前，其他请求可能会读到旧数据并以新的版本号写入缓存
+# （例如菜单树缓存，见 ProjectNavMenuManager.get_tree）。不在事务中时，on_commit 会立即执行。
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_project_page_cache(sender, **kwargs):
+    # ProjectPage 的子类（ProjectNews 等）保存时，sender 是子类，因此这里用 issubclass 判断
+    if issubclass(sender, PAGE_CACHE_MODELS):
+        transaction.on_commit(pagecache.invalidate)
+
+@receiver(m2m_changed)
+def invalidate_project_page_cache_m2m(sender, instance, action, **kwargs):
+    # 页面附件、首页轮播图是 ManyToManyField，修改时不会触发 post_save
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, PAGE_CACHE_MODELS):
+        transaction.on_commit(pagecache.invalidate)
+
+# 知享培训：课程学习状态（ZhixiangTraining.b_status）在以下情况下重新计算，培训页面只读取计算好的状态
+
+@receiver(presentation_watched)
+def refresh_zhixiang_training_on_watched(sender, presentation, user, **kwargs):
+    # 只有看完的 PPT 属于用户需要学习的课程时才需要重新计算
+    def refresh():
+        ZhixiangTraining.refresh_b(ZhixiangTraining.objects.filter(
+            user_id=user.id, examination__course__presentationlesson__presentation_id=presentation.id).distinct())
+    transaction.on_commit(refresh)
+
+@receiver(post_save, sender=PresentationLesson)
+@receiver(post_delete, sender=PresentationLesson)
+def refresh_zhixiang_training_on_lesson_changed(sender, instance, **kwargs):
+    # lesson 发布、取消发布、删除时，课程列表以及关联该课程的用户的学习状态都可能变化
+    def refresh():
+        ZhixiangExamination.objects.invalidate_training_courses()
+        ZhixiangTraining.refresh_b(ZhixiangTraining.objects.filter(examination__course_id=instance.course_id))
+    transaction.on_commit(refresh)
+
+@receiver(post_save, sender=ZhixiangExamination)
+@receiver(post_delete, sender=ZhixiangExamination)
+def refresh_zhixiang_training_on_examination_changed(sender, instance, **kwargs):
+    # 考试关联的课程可能被修改
+    def refresh():
+        ZhixiangExamination.objects.invalidate_training_courses()
+        ZhixiangTraining.refresh_b(ZhixiangTraining.objects.filter(examination_id=instance.id))
+    transaction.on_commit(refresh)
+
+@receiver(post_save, sender=Course)
+def invalidate_zhixiang_training_courses(sender, **kwargs):
+    transaction.on_commit(ZhixiangExamination.objects.invalidate_training_courses)
+
+@receiver(post_save, sender=ZhixiangNews)
+@receiver(post_delete, sender=ZhixiangNews)
+def invalidate_zhixiang_news_card(sender, instance, **kwargs):
+    # 新闻列表中每条新闻的缓存片段（见 cardpc/zhixiang/news-list.html），发布时间修改后 key 会变化，
+    # 但标题、缩略图修改时 key 不变，因此需要删除。这里只能删除当前发布时间对应的片段，旧的片段会自动过期
+    key = make_template_fragment_key('zhixiang-news-card', [instance.id, instance.publish_time.timestamp()])
+    transaction.on_commit(lambda: cache.delete(key))
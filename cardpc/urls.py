@@ -40,7 +40,6 @@ urlpatterns = [
     path('api/admin/cardpc/zhixiang/', include(zhixiang.NewsAdminView.urls('news', 'api-zhixiang'))),
     path('api/admin/cardpc/zhixiang/', include(zhixiang.ExaminationAdminView.urls('examinations', 'api-zhixiang'))),
     path('api/admin/cardpc/zhixiang/', include(zhixiang.TrainingAdminView.urls('training', 'api-zhixiang'))),
-    path('api/admin/cardpc/zhixiang/training/export', zhixiang.api_export_training_data),
     path('api/admin/cardpc/project/', include(project.ProjectAdminView.urls('projects', 'api-project'))),
     path('api/admin/cardpc/project/', include(project.ProjectDocumentAdminView.urls('documents', 'api-project'))),
     path('api/admin/cardpc/project/', include(project.ProjectPageAdminView.urls('pages', 'api-project'))),
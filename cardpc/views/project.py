@@ -18,9 +18,19 @@ from cardpc.models import ProjectHomepage, ProjectNews, ProjectNewsList
 from cardpc.models import ProjectGallery, ProjectGalleryImage, ProjectRichtextPage
 from cardpc.models import ProjectCarouselItem
 from cardpc.panels import ProjectThemeColorPickerPanel
+from cardpc import pagecache
 
 @require_http_methods(['GET'])
 def page(request, project_slug, page_id=None):
+    preview = get_boolean_query(request, 'preview', False)
+
+    # 预览模式用于查看草稿，不使用缓存
+    cache_key = None if preview else pagecache.get_page_cache_key(request, project_slug, page_id)
+    if cache_key:
+        response = pagecache.get_cached_page(cache_key)
+        if response:
+            return response
+
     try:
         if page_id is None:
             page = ProjectHomepage.objects \
@@ -33,27 +43,22 @@ def page(request, project_slug, page_id=None):
     except ProjectPage.DoesNotExist:
         return api.not_found()
 
-    preview = get_boolean_query(request, 'preview', False)
     if page.status != page.STATUSES.published and not preview:
         return api.not_found()
 
     context = page.get_context(request)
     template = page.get_template(request)
 
-    return render_for_ua(request, template, context=context)
+    response = render_for_ua(request, template, context=context)
+    if cache_key:
+        pagecache.set_cached_page(cache_key, response)
+
+    return response
 
 @method_decorator(role_required(['admin']), name='dispatch')
 class ProjectAdminView(AdminView):
     MODEL = Project
-    QUERYSET_SELECT_RELATED = [
-            'banner',
-            'menu',
-            'menu__link_page',
-            ]
-    QUERYSET_PREFETCH_RELATED = [
-            'menu__children',
-            'menu__children__link_page',
-            ]
+    # 序列化时需要的关联对象由 Project.get_serialize_related() 声明，见 natureself.django.core.serialize
 
     SEARCH_FORM = Form([
         panels.TextPanel('title'),
@@ -125,6 +130,19 @@ class ProjectDocumentAdminView(AdminView):
         panels.TextPanel('subject', search_op='icontains'),
     ], model=MODEL, form_mode='search')
 
+    EXPORT_FILENAME = '项目附件'
+    EXPORT_COLUMNS = [
+        ('ID', 'id', 8),
+        ('项目', 'project__title', 30),
+        ('标题', 'subject', 40),
+        ('描述', 'description', 40),
+        ('标签', 'tag', 15),
+        ('发布时间', 'publish_time', 20),
+        ('文件名', 'document__filename', 30),
+        ('文件大小', 'document__size', None),
+        ('下载地址', lambda model: model.document.download_url(), 50),
+    ]
+
     EDIT_FORM = Form([
         panels.SelectPanel('project', choices=choices.ApiChoices('api-project-projects', label_field='title')),
         panels.TextPanel('subject'),
@@ -179,6 +197,24 @@ class ProjectPageAdminView(AdminView):
         panels.SelectPanel('status'),
         ], model=MODEL, form_mode='search')
 
+    EMPTY_FORM = Form()
+    # {页面类型: Form}，每种页面的编辑表单只创建、编译一次
+    EDIT_FORMS = {}
+
+    @classmethod
+    def get_edit_form(cls, Page):
+        form = cls.EDIT_FORMS.get(Page)
+        if form is None:
+            form = cls.EDIT_FORMS[Page] = Form(Page.get_edit_panels(), model=Page, form_mode='edit')
+        return form
+
+    @classmethod
+    def get_all_forms(cls):
+        forms = dict(super().get_all_forms(), empty=cls.EMPTY_FORM)
+        for pagetype, Page in ProjectPage.PAGE_TYPES.items():
+            forms[f'edit?pagetype={pagetype}'] = cls.get_edit_form(Page)
+        return forms
+
     def get_serialize_kwargs(self, request):
         simple = get_boolean_query(request, 'simple', False)
         return dict(simple=simple)
@@ -191,11 +227,10 @@ class ProjectPageAdminView(AdminView):
             pagetype = request.GET.get('pagetype')
             Page = ProjectPage.PAGE_TYPES.get(pagetype)
             if not Page:
-                return api.ok(data=Form().serialize())
-            form = Form(Page.get_edit_panels(), model=Page, form_mode='edit')
-            return api.ok(data=form.serialize())
+                return self.EMPTY_FORM.response(request)
+            return self.get_edit_form(Page).response(request)
         if form_name == 'empty':
-            return api.ok(data=Form().serialize())
+            return self.EMPTY_FORM.response(request)
         if panel:
             if panel == 'project':
                 return api.ok(data=self.PROJECT_SELECT_PANEL.serialize())
@@ -299,6 +334,9 @@ class ProjectPageAdminView(AdminView):
 
         model.carousel_items.set(carousel_item_ids)
 
+        # bulk_update 不会触发 post_save，需要手动使页面缓存失效
+        pagecache.invalidate()
+
     def set_gallery_images(self, model, image_ids):
         images_to_update = list(model.images.all())
         images_to_update = { image.id: image for image in images_to_update }
@@ -320,6 +358,9 @@ class ProjectPageAdminView(AdminView):
 
         ProjectGalleryImage.objects.bulk_update(images_to_update.values(), ['gallery', 'sort_order'])
 
+        # bulk_update 不会触发 post_save，需要手动使页面缓存失效
+        pagecache.invalidate()
+
     @classmethod
     def urls(cls, base, app):
         return super().urls(base, app) + [
@@ -333,10 +374,6 @@ class ProjectNavMenuAdminView(AdminView):
     QUERYSET_SELECT_RELATED = [
             'link_page',
             ]
-    QUERYSET_PREFETCH_RELATED = [
-            'children',
-            'children__link_page',
-            ]
 
     """
     菜单管理比较特殊，我们将菜单分为两大类：根节点、非根节点。
@@ -401,7 +438,8 @@ class ProjectNavMenuAdminView(AdminView):
         for child in children_to_create:
             child.save()
 
-        root.refresh_from_db()
+        # 此时事务尚未提交，菜单树缓存还没有失效，因此这里直接从数据库加载
+        root = ProjectNavMenu.objects.build_tree(root.id)
         return api.ok(data=root.serialize())
 
 class ProjectGalleryImageAdminView(AbstractFileView):
@@ -5,22 +5,24 @@ from django.utils.decorators import method_decorator
 from django.db.models import Prefetch
 from django.urls import reverse
 from django.utils import timezone
-from django.http import FileResponse
 
 from natureself.django.core.shortcuts import render_for_ua
-from natureself.django.course.models import Course, PresentationLesson
+from natureself.django.course.models import PresentationLesson
+from natureself.django.course import progress
 from natureself.django.account.decorators import role_required
 from natureself.django.core import api
+from natureself.django.core.utils import get_pagination
 from natureself.admin.forms import Form, panels, choices
 from natureself.admin.views import AdminView
 
 from cardpc.models import User, ZhixiangNews, ZhixiangTraining, ZhixiangExamination
 from cardpc.panels import UserSearchPanel
+from cardpc import pagecache
 
-import xlsxwriter
-import tempfile
 
 ZX_SETTINGS = settings.ZHIXIANG
+# 新闻列表页每页的新闻数量
+NEWS_PAGE_SIZE = 10
 
 @require_http_methods(['GET'])
 def homepage(request):
@@ -32,7 +34,7 @@ def homepage(request):
     除了新闻动态以外，其他数据全部 Hardcode 在页面中。
     """
     # TODO 需要确定首页新闻动态最多显示几条
-    news = ZhixiangNews.objects.select_related('thumbnail').order_by('-publish_time')[:10]
+    news = ZhixiangNews.objects.get_list_queryset()[:10]
     context = dict(news=news)
     return render_for_ua(request, 'cardpc/zhixiang/homepage.html', context=context)
 
@@ -52,7 +54,8 @@ def training(request):
         action: 'start-a', // 取值：start-a, start-c, start-d
     }
     """
-    status, _ = ZhixiangTraining.objects.select_related('examination').get_or_create(user=request.user)
+    # 课程学习状态（b_status）在状态变化时已经计算好（见 ZhixiangTraining.get_b），这里只需要读取一行数据
+    status, _ = ZhixiangTraining.objects.select_related('examination__course').get_or_create(user=request.user)
 
     # 首先处理 POST 请求。我们只考虑正常情况，其他情况均返回 400 bad request
     if request.method == 'POST':
@@ -128,14 +131,7 @@ def training(request):
     }
     """
 
-    # (a1, *, *, *): 默认显示课程调研页
-    # (a2, b2, c3, *): 默认显示考试页
-    if status.a1:
-        default_tab = 'a'
-    elif status.a2 and status.b2 and status.c3:
-        default_tab = 'd'
-    else:
-        default_tab = 'b'
+    default_tab = status.get_default_tab()
     # 如果有 show 参数，则使用 show 参数
     show = request.GET.get('show')
     if show in ['a', 'b', 'c', 'd']:
@@ -158,29 +154,15 @@ def training(request):
     # (*, *, C4, *): 文案提示审核被驳回，可以重新填表，显示「立即参加」按钮
     c_status = status.c
 
-    # 考试评定页
-    # (*, *, C1|C2|C4, *): 文案提示请先通过资格审核
-    # (*, B1, C3, D1): 文案提示需要学习完某一个课程才能参加考试，请先学习
-    # (*, B2, C3, D1): 可以参加考试，显示「立即参加」按钮
-    # (*, *, *, D2)：文案提示已参加考试，等待官方公布考试结果，不显示「立即参加」按钮
-    if status.c1 or status.c2 or status.c4:
-        d_status = 1
-    elif status.b1 and status.c3 and status.d1:
-        d_status = 2
-    elif status.b2 and status.c3 and status.d1:
-        d_status = 3
-    elif status.d2:
-        d_status = 4
+    # 考试评定页，见 ZhixiangTraining.get_exam_page_status()
+    d_status = status.get_exam_page_status()
 
     exam_course = status.examination.course if status.examination else None
 
-    courses = Course.objects \
-            .filter(zhixiang_exams__isnull=False) \
-            .select_related('thumbnail') \
-            .distinct()
-    courses = [course for course in courses if course.published]
+    # 课程列表（包括已发布的 lesson）使用缓存，用户的学习进度使用缓存中的观看记录，不查询数据库
+    courses = ZhixiangExamination.objects.get_training_courses()
+    progress.set_courses_progress(courses, progress.get_user_watched(request.user))
     for course in courses:
-        course.fetch_presentationlesson_details(request.user)
         course.lesson_url = reverse('zhixiang-lesson', kwargs=dict(id=course.default_presentationlesson.id))
 
     context = {
@@ -223,6 +205,7 @@ def wjx_callback(request, action):
         return redirect_to_training_page()
 
     default_tab = None
+    # 这里的状态变化不影响课程学习状态（b_status），不需要重新计算
     if action == 'investigation':
         status.a_status = 2
         status.a_end = timezone.now()
@@ -268,7 +251,10 @@ def lesson(request, id):
     }
     """
     if request.method == 'POST':
-        seconds = request.json.get('add_watch_time', 0)
+        try:
+            seconds = int(request.json.get('add_watch_time', 0))
+        except (TypeError, ValueError):
+            return api.bad_request(message='invalid add_watch_time')
         watch_end = request.json.get('watch_end', False)
         try:
             lesson = PresentationLesson.objects.select_related('presentation') \
@@ -276,7 +262,8 @@ def lesson(request, id):
         except PresentationLesson.DoesNotExist:
             return api.not_found()
 
-        record = lesson.presentation.add_watch_time(request.user, seconds)
+        # 观看到最后一页时，需要准确的累计时长来判断是否标记为已学习，因此立即写入数据库
+        record = lesson.presentation.add_watch_time(request.user, seconds, flush=watch_end)
         mark_watched = False
 
         if watch_end:
@@ -314,12 +301,19 @@ def news_list(request):
     """
     知享新闻列表页
 
-    注：由于目前设计图上没有分页，因此我们暂时先不实现分页，时间富裕的时候再实现
+    GET /zhixiang/news/?page=2
 
-    GET /zhixiang/news/
+    每页 NEWS_PAGE_SIZE 条新闻，列表中不读取新闻正文。每条新闻渲染后的 HTML 片段会缓存（见模板），
+    缓存的 key 包括新闻 id 与发布时间，新闻被修改时失效（见 cardpc.signals）
     """
-    all_news = ZhixiangNews.objects.select_related('thumbnail').all()
-    context = dict(all_news=all_news)
+    # 不允许通过 page_size 参数修改分页大小，避免一次读取所有新闻
+    page, paginator, pagination = get_pagination(request, ZhixiangNews.objects.get_list_queryset(),
+            page_size=NEWS_PAGE_SIZE)
+    context = dict(
+            all_news = page,
+            pagination = pagination,
+            cache_timeout = pagecache.PAGE_CACHE_TIMEOUT,
+            )
     return render_for_ua(request, 'cardpc/zhixiang/news-list.html', context=context)
 
 @require_http_methods(['GET'])
@@ -411,62 +405,31 @@ class TrainingAdminView(AdminView):
         panels.DateTimePickerPanel('d_end', disabled=True),
     ], model=MODEL, form_mode='edit')
 
+    EXPORT_FILENAME = '培训信息导出'
+    EXPORT_COLUMNS = [
+        ('用户 ID', 'user_id', 5),
+        ('用户名', 'user__username', 20),
+        ('邮箱', 'user__email', 20),
+        ('手机号', 'user__phone', 20),
+        ('课程调研状态', 'a_status', 20),
+        ('需学习的课程', lambda model: model.examination.title if model.examination else '-', 20),
+        ('课程学习状态', 'b_status', 20),
+        ('资格认证状态', 'c_status', 20),
+        ('需参加的考试', lambda model: model.examination.course.title if model.examination else '-', None),
+        ('考试评定状态', 'd_status', None),
+    ]
+
+    def get_export_queryset(self, request):
+        return super().get_export_queryset(request).order_by('user_id')
+
     def patch_model(self, request, pk):
         model = super().patch_model(request,pk, no_save=True)
         model.save()
 
         if 'examination' in request.json:
+            # 关联的考试（即需要学习的课程）变化，重新计算课程学习状态
             model.b_status = 1
+            model.save(update_fields=['b_status'])
             model.get_b()
-            model.save()
 
         return api.ok(data=model)
-
-@require_http_methods(['POST'])
-@role_required(['admin'])
-def api_export_training_data(request):
-    xlsxfile = tempfile.NamedTemporaryFile(delete=False)
-    workbook = xlsxwriter.Workbook(xlsxfile.name)
-    worksheet = workbook.add_worksheet()
-
-    for cell, title in [
-            ('A1', '用户 ID'),
-            ('B1', '用户名'),
-            ('C1', '邮箱'),
-            ('D1', '手机号'),
-            ('E1', '课程调研状态'),
-            ('F1', '需学习的课程'),
-            ('G1', '课程学习状态'),
-            ('H1', '资格认证状态'),
-            ('I1', '需参加的考试'),
-            ('J1', '考试评定状态'),
-            ]:
-        worksheet.write(cell, title)
-
-    worksheet.set_column('B:H', width=20)
-    worksheet.set_column('A:A', width=5)
-
-    data = ZhixiangTraining.objects \
-            .select_related('user', 'examination', 'examination__course') \
-            .order_by('user_id') \
-            .all()
-
-    row = 1
-    for record in data:
-        # 课程学习状态是每一次访问时计算一次，这里强制计算一次，使得 record.b_status 得到正确的赋值
-        record.get_b()
-        worksheet.write(row, 0, record.user_id)
-        worksheet.write(row, 1, record.user.username)
-        worksheet.write(row, 2, record.user.email)
-        worksheet.write(row, 3, record.user.phone)
-        worksheet.write(row, 4, record.get_a_status_display())
-        worksheet.write(row, 5, record.examination.title if record.examination else '-')
-        worksheet.write(row, 6, record.get_b_status_display())
-        worksheet.write(row, 7, record.get_c_status_display())
-        worksheet.write(row, 8, record.examination.course.title if record.examination else '-')
-        worksheet.write(row, 9, record.get_d_status_display())
-        row += 1
-    workbook.close()
-
-    now = timezone.now().strftime('%Y%m%d%H%M%S')
-    return FileResponse(open(xlsxfile.name, 'rb'), as_attachment=True, filename=f'培训信息导出{now}.xlsx')
@@ -5,6 +5,9 @@ set -e
 # Usage:
 #    /entrypoint.sh web
 #    /entrypoint.sh api
+#    /entrypoint.sh mailer
+#    /entrypoint.sh smser
+#    /entrypoint.sh exporter
 #    /entrypoint.sh any-command
 
 # originally we use $PORT, we should keep compability with old deployment
@@ -30,10 +33,25 @@ run_api() {
         nsproject.wsgi
 }
 
+run_mailer() {
+    exec python3 manage.py send_queued_mail
+}
+
+run_smser() {
+    exec python3 manage.py send_queued_sms
+}
+
+run_exporter() {
+    exec python3 manage.py run_export_jobs
+}
+
 help() {
     echo "Usage:"
     echo "    docker run ... web         # start frontend (and http entrypoint)"
     echo "    docker run ... api         # start django server"
+    echo "    docker run ... mailer      # start email queue worker"
+    echo "    docker run ... smser       # start sms queue worker"
+    echo "    docker run ... exporter    # start export job worker"
     echo "    docker run ... any-command # run specified command in the container"
 }
 
@@ -49,6 +67,15 @@ case "$1" in
     api)
         run_api
         ;;
+    mailer)
+        run_mailer
+        ;;
+    smser)
+        run_smser
+        ;;
+    exporter)
+        run_exporter
+        ;;
     *)
         exec "$@"
         ;;
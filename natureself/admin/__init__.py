@@ -0,0 +1 @@
+default_app_config = 'natureself.admin.apps.AdminConfig'
@@ -2,6 +2,12 @@ import request from '@webapp/request.js'
 
 const api = {
   request,
+  // 异步导出任务，见 natureself.django.export
+  export: {
+    getJob (id) {
+      return request({ method: 'GET', url: `/api/admin/export/jobs/${id}` })
+    },
+  },
 }
 export default api
 
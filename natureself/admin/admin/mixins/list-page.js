@@ -12,6 +12,8 @@ export default {
       searchFormdata: {},
       initialSearchFormdata: this.$store.getters.searchForms[this.$route.name] || {},
       cachedData: null,
+      exporting: false,
+      exportProgress: 0,
       pagination: {
         page: 1,
         page_size: 10,
@@ -43,6 +45,43 @@ export default {
       })
     },
 
+    // 按照当前的筛选条件导出列表，页面需要定义 exportDataApi（POST .../{model}/export），
+    // 后台异步导出，完成后下载，见 natureself.admin.views.AdminView.export_model
+    exportData (format = 'xlsx') {
+      let vm = this
+      vm.exporting = true
+      vm.exportProgress = 0
+      vm.exportDataApi({ ...vm.searchFormdata, format }).then(response => {
+        if (response.data.code === 0) {
+          vm.waitExportJob(response.data.data.id)
+        } else {
+          vm.exporting = false
+          vm.$message.error('导出失败')
+        }
+      }).catch(() => {
+        vm.exporting = false
+      })
+    },
+
+    waitExportJob (id) {
+      let vm = this
+      vm.$api.export.getJob(id).then(response => {
+        let job = response.data.data
+        if (response.data.code !== 0 || job.status === 'failed') {
+          vm.exporting = false
+          vm.$message.error('导出失败')
+        } else if (job.status === 'success') {
+          vm.exporting = false
+          window.location.href = job.download_url
+        } else {
+          vm.exportProgress = job.progress
+          setTimeout(() => vm.waitExportJob(id), 1000)
+        }
+      }).catch(() => {
+        vm.exporting = false
+      })
+    },
+
     handlePageChange () {
       this.refreshData()
     },
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+class AdminConfig(AppConfig):
+    name = 'natureself.admin'
+
+    def ready(self):
+        # 注册启动时的检查
+        from . import checks
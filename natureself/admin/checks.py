@@ -0,0 +1,36 @@
+"""
+启动时检查所有 AdminView 的表单定义都能够编译（见 natureself.admin.forms.schema）
+
+表单定义在第一次请求时才会编译，如果某个 Panel 的配置有误（例如字段名写错），只有打开对应的管理页面时才会报错。
+这里在 `manage.py check`、runserver 启动时编译所有表单，有错误时阻止启动。
+"""
+from django.core import checks
+from django.urls import get_resolver
+
+from .views import AdminView
+
+def get_admin_views(cls=AdminView):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from get_admin_views(subclass)
+
+@checks.register()
+def check_form_schemas(app_configs=None, **kwargs):
+    # 导入 URLconf，使得所有 AdminView 的子类都已经定义
+    get_resolver().url_patterns
+
+    errors = []
+    for view_class in get_admin_views():
+        name = f'{view_class.__module__}.{view_class.__qualname__}'
+        try:
+            forms = view_class.get_all_forms()
+        except Exception as e:
+            errors.append(checks.Error(f'{name}: failed to get forms: {e!r}', obj=view_class, id='natureself.admin.E001'))
+            continue
+        for form_name, form in forms.items():
+            try:
+                form.compile()
+            except Exception as e:
+                errors.append(checks.Error(f'{name}: form "{form_name}" failed to compile: {e!r}',
+                    obj=view_class, id='natureself.admin.E002'))
+    return errors
@@ -1,5 +1,8 @@
 from django.apps import apps
+from django.urls import get_script_prefix
+
 from .panels import Panel
+from .schema import CompiledSchema
 
 class Form:
     def __init__(self, panels=None, model=None, form_mode='edit'):
@@ -25,6 +28,7 @@ class Form:
 
         for panel in self.panels:
             panel.model = self._model
+        self._compiled = {}
 
     @property
     def form_mode(self):
@@ -36,6 +40,7 @@ class Form:
 
         for panel in self.panels:
             panel.form_mode = value
+        self._compiled = {}
 
     @property
     def data_panels(self):
@@ -48,3 +53,20 @@ class Form:
                 panels = [panel.serialize() for panel in self.panels],
                 form_mode = self.form_mode,
                 )
+
+    def compile(self):
+        """
+        返回编译好的表单定义（CompiledSchema），只在第一次调用时序列化，见 schema。
+        注意编译之后再修改 panel 的属性不会生效（修改 Form 的 model、form_mode 会重新编译）
+        """
+        prefix = get_script_prefix()
+        compiled = self._compiled.get(prefix)
+        if compiled is None:
+            compiled = self._compiled[prefix] = CompiledSchema(self.serialize())
+        return compiled
+
+    def response(self, request):
+        """
+        返回表单定义的响应，支持 ETag/304
+        """
+        return self.compile().response(request)
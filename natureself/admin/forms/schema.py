@@ -0,0 +1,44 @@
+"""
+表单定义（schema）的编译与缓存
+
+管理后台的每一个页面都会请求 .../forms/search、.../forms/edit 获取表单定义，
+而 Form.serialize() 每次都会遍历所有 Panel，重新计算 options、required、choices 等（每次都会调用 _meta.get_field()）。
+表单定义只与代码有关，因此我们在第一次使用时将其编译为 JSON 并保存在 Form 对象中（见 Form.compile()）：
+
+* 之后的请求直接返回编译好的 JSON，不再序列化
+* 响应中带有 ETag（JSON 内容的哈希），前端再次请求时带上 If-None-Match，表单定义没有变化时返回 304
+
+编译结果只保存在进程内存中，代码修改后（runserver 自动重新加载、gunicorn 重启）会重新编译，
+JSON 内容变化时 ETag 也随之变化，前端会取到新的表单定义。
+
+ApiChoices 中的 URL 与部署路径（SCRIPT_NAME）有关，因此编译结果按照 URL 前缀分别保存。
+
+启动时（`manage.py check`、runserver）会检查所有 AdminView 的表单都能够编译，见 natureself.admin.checks。
+"""
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+import hashlib
+
+from natureself.django.core import encoders
+
+class CompiledSchema:
+    def __init__(self, data):
+        self.data = data
+        # 与 api.ok(data=data) 的响应内容相同
+        self.content = encoders.dumps(dict(code=0, message='ok', data=data))
+        self.etag = '"%s"' % hashlib.md5(self.content).hexdigest()
+
+    def response(self, request):
+        """
+        返回表单定义，请求中的 If-None-Match 与 ETag 相同时返回 304
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (if_none_match.strip() == '*' or self.etag in parse_etags(if_none_match)):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(self.content, content_type='application/json')
+        response['ETag'] = self.etag
+        # 浏览器可以缓存，但每次使用前都需要向服务器确认（即发送带有 If-None-Match 的请求）
+        response['Cache-Control'] = 'private, no-cache'
+        return response
@@ -1,10 +1,22 @@
 from django.views import View
 from django.db.models import Q
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest, QueryDict
 from django.urls import path, include
+from django.utils import timezone
+from django.utils.cache import add_never_cache_headers
 from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+import datetime
 
 from natureself.django.core import api
-from natureself.django.core.utils import get_pagination
+from natureself.django.core.utils import get_pagination, get_boolean_query, InvalidCursor
+from natureself.django.core.serialize import serialize_objects, iter_serialize_objects
+from natureself.django.export import jobs
+from natureself.django.export.exporters import Exporter
+from natureself.django.export.models import ExportJob
 from .forms import Form, panels
 
 class AdminView(View):
@@ -19,6 +31,7 @@ class AdminView(View):
     PUT /api/admin/{model}/<int:id>       -> 更新单个资源
     PATCH /api/admin/{model}/<int:id>     -> 更新单个资源
     DELETE /api/admin/{model}/<int:id>    -> 删除单个资源
+    POST /api/admin/{model}/export        -> 导出资源列表（需要定义 EXPORT_COLUMNS）
     """
 
     # CRUD 所操作的 model 类
@@ -27,6 +40,11 @@ class AdminView(View):
     ORDER_BY = ['-id']
     # list 请求是否需要分页
     USE_PAGINATION = True
+    # 分页方式，'page' 为页码分页，'cursor' 为游标分页（按照 ORDER_BY 加 id 排序，见 get_cursor_pagination()）。
+    # 为了兼容现有的前端，即使设置为 'cursor'，如果请求中带有 page 参数，仍然使用页码分页。
+    PAGINATION_MODE = 'page'
+    # 游标分页时如何计算总数：'exact' 精确计数，'estimate' 估算，'none' 不计数
+    PAGINATION_COUNT = 'exact'
 
     QUERYSET_SELECT_RELATED = None
     QUERYSET_PREFETCH_RELATED = None
@@ -34,12 +52,21 @@ class AdminView(View):
     SEARCH_FORM = Form()
     EDIT_FORM = Form()
 
+    # 导出的列，[(标题, 字段, 列宽)]，为空时不支持导出，见 export_model()。
+    # 字段可以是字段名（可以用 __ 访问关联对象，例如 'user__username'，有 choices 的字段导出显示的名称），
+    # 也可以是函数（参数为 model），列宽为 None 时使用默认宽度。
+    # 导出的文件中常常有邮箱、手机号等信息，只有发起导出的用户（以及超级管理员）可以下载，见 natureself.django.export
+    EXPORT_COLUMNS = None
+    # 导出的文件名（不含扩展名），默认为 MODEL 的 verbose_name
+    EXPORT_FILENAME = None
+
     GET_METHOD = 'get_model'
     LIST_METHOD = 'list_model'
     CREATE_METHOD = 'create_model'
     UPDATE_METHOD = None
     PATCH_METHOD = 'patch_model'
     DELETE_METHOD = 'delete_model'
+    EXPORT_METHOD = 'export_model'
 
     def get_queryset(self, request=None):
         queryset = self.MODEL.objects.all()
@@ -59,13 +86,34 @@ class AdminView(View):
         for panel in self.SEARCH_FORM.data_panels:
             yield panel
 
+    def filter_queryset(self, request, queryset):
+        """
+        按照 SEARCH_FORM 筛选
+        """
+        for panel in self.get_search_panels():
+            kwargs = panel.get_filter_kwargs(request)
+            if kwargs:
+                if isinstance(kwargs, Q):
+                    queryset = queryset.filter(kwargs)
+                else:
+                    queryset = queryset.filter(**kwargs)
+        return queryset
+
     def get_edit_panels(self, request=None):
         for panel in self.EDIT_FORM.data_panels:
             yield panel
 
     @cached_property
     def forms(self):
-        return dict(search=self.SEARCH_FORM, edit=self.EDIT_FORM)
+        return self.get_all_forms()
+
+    @classmethod
+    def get_all_forms(cls):
+        """
+        返回 {名称: Form}，即 .../forms/<名称> 可以获取的表单。
+        如果在 get() 中还动态返回了其他表单，也应该在这里返回，启动时会检查这些表单都能够编译（见 natureself.admin.checks）
+        """
+        return dict(search=cls.SEARCH_FORM, edit=cls.EDIT_FORM)
 
     # ---------- 8< ----------
     # 以下代码可以重载，也可以通过 xx_METHOD 来指定自己实现的函数名
@@ -96,21 +144,23 @@ class AdminView(View):
         """
         GET /api/admin/.../{model}
         """
-        queryset = self.get_queryset(request)
-
-        for panel in self.get_search_panels():
-            kwargs = panel.get_filter_kwargs(request)
-            if kwargs:
-                if isinstance(kwargs, Q):
-                    queryset = queryset.filter(kwargs)
-                else:
-                    queryset = queryset.filter(**kwargs)
-
-        if self.USE_PAGINATION:
+        queryset = self.filter_queryset(request, self.get_queryset(request))
+
+        # 使用 serialize_objects() 批量序列化，避免每一行都查询关联对象，见 natureself.django.core.serialize
+        serialize_kwargs = self.get_serialize_kwargs(request)
+        if self.USE_PAGINATION and self.PAGINATION_MODE == 'cursor' and 'page' not in request.GET:
+            try:
+                page, paginator, pagination = get_pagination(request, queryset, mode='cursor',
+                        ordering=self.ORDER_BY, count=self.PAGINATION_COUNT)
+            except InvalidCursor:
+                return api.bad_request(message='invalid cursor')
+            return api.ok(data=serialize_objects(page, **serialize_kwargs), pagination=pagination)
+        elif self.USE_PAGINATION:
             page, paginator, pagination = get_pagination(request, queryset)
-            return api.ok(data=[model.serialize(**self.get_serialize_kwargs(request)) for model in page], pagination=pagination)
+            return api.ok(data=serialize_objects(page.object_list, **serialize_kwargs), pagination=pagination)
         else:
-            return api.ok(data=[model.serialize(**self.get_serialize_kwargs(request)) for model in queryset])
+            # 不分页时列表可能很长，流式返回，每次只取出、序列化、编码一批对象
+            return api.stream(iter_serialize_objects(queryset, **serialize_kwargs))
 
     def create_model(self, request, no_save=False):
         """
@@ -175,6 +225,66 @@ class AdminView(View):
             model.save()
             return api.ok(data=model.serialize(**self.get_serialize_kwargs(request)))
 
+    def export_model(self, request):
+        """
+        POST /api/admin/.../{model}/export
+
+        与 list 请求使用相同的 querystring 筛选（SEARCH_FORM），另外支持：
+        * format: xlsx/csv，默认为 xlsx
+        * async: 默认为 true，创建异步导出任务，返回任务信息（见 natureself.django.export.jobs），
+          为 false 时直接返回文件
+
+        异步导出的文件不公开，只有发起导出的用户（以及超级管理员）可以通过任务的 download_url 下载
+        """
+        if not self.EXPORT_COLUMNS:
+            return api.invalid_endpoint()
+
+        format = request.GET.get('format', 'xlsx')
+        if format not in ExportJob.FORMATS:
+            return api.bad_request(message=f'unknown format: {format}')
+
+        params = AdminViewExporter.get_params(type(self), request)
+        if get_boolean_query(request, 'async', True):
+            job = jobs.enqueue(AdminViewExporter, params, format=format, owner=request.user)
+            return api.ok(data=job.serialize(request=request))
+        response = AdminViewExporter(params).response(format)
+        # 与下载异步导出的文件相同，不允许浏览器、代理缓存
+        add_never_cache_headers(response)
+        return response
+
+    def get_export_queryset(self, request):
+        return self.filter_queryset(request, self.get_queryset(request))
+
+    def prepare_export(self, records):
+        """
+        导出时每读取一批记录后调用，可以在这里批量查询关联数据
+        """
+        pass
+
+    def get_export_value(self, model, field):
+        if callable(field):
+            value = field(model)
+        else:
+            *relations, name = field.split('__')
+            for relation in relations:
+                model = getattr(model, relation)
+                if model is None:
+                    return None
+            if model._meta.get_field(name).choices:
+                value = getattr(model, f'get_{name}_display')()
+            else:
+                value = getattr(model, name)
+
+        # xlsx 不支持带时区的时间，统一转换为本地时间的字符串
+        if isinstance(value, datetime.datetime):
+            return timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S') if timezone.is_aware(value) else str(value)
+        if value is not None and not isinstance(value, (str, int, float, bool)):
+            return str(value)
+        return value
+
+    def get_export_row(self, model):
+        return [self.get_export_value(model, field) for title, field, width in self.EXPORT_COLUMNS]
+
     # ---------- 8< ----------
     # 以下代码不建议重载
     # ---------- 8< ----------
@@ -185,12 +295,14 @@ class AdminView(View):
             path(f'{base}', cls.as_view(), name=f'{app}-{base}'),
             path(f'{base}/<int:pk>', cls.as_view(), name=f'{app}-{base}-single'),
             path(f'{base}/forms/<str:form_name>', cls.as_view(), name=f'{app}-{base}-forms'),
+            path(f'{base}/export', cls.as_view(), name=f'{app}-{base}-export', kwargs=dict(export=True)),
         ]
 
     def get(self, request, pk=None, form_name=None):
         if form_name is not None:
             if form_name in self.forms:
-                return api.ok(data=self.forms[form_name].serialize())
+                # 表单定义只编译一次，支持 ETag/304，见 natureself.admin.forms.schema
+                return self.forms[form_name].response(request)
             else:
                 return api.not_found()
         if pk is not None:
@@ -198,7 +310,9 @@ class AdminView(View):
         else:
             return self._list_method(request)
 
-    def post(self, request, pk=None):
+    def post(self, request, pk=None, export=False):
+        if export:
+            return self._export_method(request)
         if pk is not None:
             return api.invalid_endpoint()
         return self._create_method(request)
@@ -229,8 +343,50 @@ class AdminView(View):
         cls._update_method = getattr(cls, cls.UPDATE_METHOD) if cls.UPDATE_METHOD else cls._not_implemented
         cls._patch_method = getattr(cls, cls.PATCH_METHOD) if cls.PATCH_METHOD else cls._not_implemented
         cls._delete_method = getattr(cls, cls.DELETE_METHOD) if cls.DELETE_METHOD else cls._not_implemented
+        cls._export_method = getattr(cls, cls.EXPORT_METHOD) if cls.EXPORT_METHOD else cls._not_implemented
 
         return super().as_view(*args, **kwargs)
 
     def _not_implemented(request, *args, **kwargs):
         return api.invalid_endpoint()
+
+class AdminViewExporter(Exporter):
+    """
+    导出 AdminView 的列表（见 AdminView.export_model()），异步导出时在 worker 进程中重新创建 AdminView 和请求
+
+    params:
+    * view: AdminView 类的路径
+    * query: 导出请求的 querystring（SEARCH_FORM 的筛选条件）
+    * user: 发起导出的用户 id，get_queryset() 中可能会用到 request.user
+    """
+    @classmethod
+    def get_params(cls, view_class, request):
+        return dict(
+                view = f'{view_class.__module__}.{view_class.__qualname__}',
+                query = request.GET.urlencode(),
+                user = request.user.id,
+                )
+
+    def __init__(self, params=None):
+        super().__init__(params)
+        self.view = import_string(self.params['view'])()
+        self.request = self.build_request()
+        self.COLUMNS = [(title, width) for title, field, width in self.view.EXPORT_COLUMNS]
+        self.FILENAME = self.view.EXPORT_FILENAME or str(self.view.MODEL._meta.verbose_name)
+
+    def build_request(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict(self.params.get('query', ''))
+        request.json = {}
+        request.user = get_user_model().objects.filter(id=self.params.get('user')).first() or AnonymousUser()
+        return request
+
+    def get_queryset(self):
+        return self.view.get_export_queryset(self.request)
+
+    def prepare(self, records):
+        self.view.prepare_export(records)
+
+    def get_row(self, record):
+        return self.view.get_export_row(record)
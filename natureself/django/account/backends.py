@@ -1,17 +1,30 @@
 from django.contrib.auth import get_user_model
-from django.core.exceptions import FieldError
+from django.contrib.auth.backends import ModelBackend
+from django.core.exceptions import FieldError, PermissionDenied
 
 from natureself.django.otp.tools import verify_code, USAGES
 from natureself.django.core.validators import is_valid_email, is_valid_phone
 
 UserModel = get_user_model()
 
+def get_user_by(field, value):
+    """
+    根据已验证的手机号或邮箱查找用户。如果用户 model 的 manager 实现了 get_by_phone()/get_by_email()
+    （例如使用了专门的索引），则使用该方法，否则直接查询
+    """
+    method = getattr(UserModel.objects, f'get_by_{field}', None)
+    if method:
+        return method(value)
+    return UserModel.objects.get(**{f'{field}_validated': True, field: value})
+
 class BackendBase:
     def get_user(self, user_id):
+        # 与 ModelBackend 相同，已经登录的用户被禁用后，会话随之失效
         try:
-            return UserModel.objects.get(pk=user_id)
-        except User.DoesNotExist:
+            user = UserModel.objects.get(pk=user_id)
+        except UserModel.DoesNotExist:
             return None
+        return user if self.user_can_authenticate(user) else None
 
     def user_can_authenticate(self, user):
         """
@@ -21,6 +34,23 @@ class BackendBase:
         is_active = getattr(user, 'is_active', None)
         return is_active or is_active is None
 
+    def authenticate_code(self, request, engine, recipient, code, usage=None):
+        """
+        使用验证码登录，engine 为 sms 或 email，recipient 为手机号或邮箱。
+        先查找用户，用户存在时才校验验证码（不存在时不会增加验证码的校验次数）
+        """
+        try:
+            user = get_user_by('phone' if engine == 'sms' else 'email', recipient)
+        except (UserModel.DoesNotExist, UserModel.MultipleObjectsReturned):
+            return None
+        except FieldError:
+            return None
+
+        valid = verify_code(engine, request, recipient, usage or USAGES.login, code, True)
+
+        if valid and self.user_can_authenticate(user):
+            return user
+
 class SmsCodeBackend(BackendBase):
     def authenticate(self, request, identity=None, phone=None, code=None, **kwargs):
         """
@@ -32,18 +62,7 @@ class SmsCodeBackend(BackendBase):
         if not phone or not code:
             return None
 
-        try:
-            user = UserModel.objects.get(phone_validated=True, phone=phone)
-        except UserModel.DoesNotExist:
-            return None
-        except FieldError:
-            return None
-
-        usage = kwargs.get('usage', USAGES.login)
-        valid = verify_code('sms', request, phone, usage, code, True)
-
-        if valid and self.user_can_authenticate(user):
-            return user
+        return self.authenticate_code(request, 'sms', phone, code, kwargs.get('usage'))
 
 class EmailCodeBackend(BackendBase):
     def authenticate(self, request, identity=None, email=None, code=None, **kwargs):
@@ -53,15 +72,60 @@ class EmailCodeBackend(BackendBase):
         if not email or not code:
             return None
 
+        return self.authenticate_code(request, 'email', email, code, kwargs.get('usage'))
+
+class DispatchBackend(BackendBase, ModelBackend):
+    """
+    根据登录凭证的形式，只使用一种方式登录：
+
+    * 有 code：验证码登录，根据 phone、email 或者 identity 的格式选择短信或邮件验证码，不会计算密码哈希
+    * 有 password：密码登录（与 ModelBackend 相同），username 或 identity 作为用户名
+
+    使用 ModelBackend、SmsCodeBackend、EmailCodeBackend 时，Django 会依次尝试每一个后端，
+    每个后端都会查询一次用户，验证码登录时 ModelBackend 也会先查询一次用户。
+
+    识别出凭证的形式后，无论登录是否成功，都不会再尝试其他后端（抛出 PermissionDenied，authenticate() 返回 None）。
+    因此可以将其他后端放在它之后（已登录用户的 session 中记录了登录时使用的后端，从 AUTHENTICATION_BACKENDS
+    中删除这些后端会使这些用户退出登录）：
+
+        AUTHENTICATION_BACKENDS = [
+            'natureself.django.account.backends.DispatchBackend',
+            'django.contrib.auth.backends.ModelBackend',
+            'natureself.django.account.backends.SmsCodeBackend',
+            'natureself.django.account.backends.EmailCodeBackend',
+        ]
+    """
+    def authenticate(self, request, username=None, password=None, identity=None, phone=None, email=None, code=None,
+            **kwargs):
+        if code:
+            if not phone and not email:
+                if is_valid_phone(identity):
+                    phone = identity
+                elif is_valid_email(identity):
+                    email = identity
+            if phone:
+                user = self.authenticate_code(request, 'sms', phone, code, kwargs.get('usage'))
+            elif email:
+                user = self.authenticate_code(request, 'email', email, code, kwargs.get('usage'))
+            else:
+                user = None
+        elif password is not None and (username or identity):
+            user = self.authenticate_password(request, username or identity, password)
+        else:
+            # 无法识别的凭证，交给其他后端
+            return None
+
+        if user is None:
+            raise PermissionDenied()
+        return user
+
+    def authenticate_password(self, request, username, password):
         try:
-            user = UserModel.objects.get(email_validated=True, email=email)
+            user = UserModel._default_manager.get_by_natural_key(username)
         except UserModel.DoesNotExist:
-            return None
-        except FieldError:
+            # 与 ModelBackend 相同，用户不存在时也计算一次密码哈希，使得无法通过响应时间判断用户是否存在
+            UserModel().set_password(password)
             return None
 
-        usage = kwargs.get('usage', USAGES.login)
-        valid = verify_code('email', request, email, usage, code, True)
-
-        if valid and self.user_can_authenticate(user):
+        if user.check_password(password) and self.user_can_authenticate(user):
             return user
@@ -7,6 +7,7 @@ from django.contrib.auth import get_user_model
 from django.utils.module_loading import import_string
 
 from natureself.django.otp import tools as otp_tools
+from natureself.django.otp import ratelimit as otp_ratelimit
 from natureself.django.core import api
 from natureself.django.core.validators import is_valid_email, is_valid_phone
 from .utils import get_user_roles, serialize_user
@@ -52,6 +53,9 @@ def api_login(request):
     * code
     * identity: 如果没有提供 email 参数，但是提供了 identity，则用 identity 作为 email
 
+    n.d.account.backends.DispatchBackend 接受以上所有参数，但根据参数只使用其中一种方式：
+    有 code 时使用短信或邮箱验证码，有 password 时使用密码，不会依次尝试每一个后端
+
     简单的说，前端使用密码登录时，可以发送这样的请求：
 
     POST /api/account/login
@@ -130,7 +134,7 @@ def api_send_code(request):
 
     * 如果缺少参数（一般只在开发阶段），会返回 400，message 描述错误信息。
     * 如果传递的 phone、email 或 identity 非法，会返回 InvalidPhone, InvalidEmail 或 InvalidIdentity
-    * 如果在静默期内重复请求，会返回 RateExceeded
+    * 如果在静默期内重复请求，或者超过发送频率限制（见 natureself.django.otp.ratelimit），会返回 RateExceeded
     * 其他所有情况都会返回 200（比如被后端认定为恶意请求而没有发送，比如登录请求中提供的
       username 不存在而未发送等等），这些错误无需告知用户。
 
@@ -167,6 +171,12 @@ def api_send_code(request):
     else:
         return api.bad_request(message='Missing "phone", "email" or "identity"')
 
+    recipient = phone or email
+
+    # 在查询数据库之前，先用缓存中的计数器拒绝过于频繁的请求（静默期、单接收者、单会话、单 IP、全局）
+    if otp_ratelimit.check(request, recipient):
+        return errors.RateExceeded()
+
     # 对于登录、重置密码的验证码，我们需要校验用户存在
     if usage in ['login', 'reset-password']:
         if phone:
@@ -178,10 +188,10 @@ def api_send_code(request):
             # 用户不存在或用户已锁定，不发送验证码，但仍然返回“验证码已发送”
             return api.ok(message='验证码已发送')
 
-    recipient = phone or email
     engine = 'sms' if phone else 'email'
     vcode, result = otp_tools.generate_code(engine, request, recipient, usage=usage)
-    if result == otp_tools.GENERATE_RESULTS.silent:
+    # 静默期内，或者短信超过了单手机号、单 IP 的发送频率限制（没有发送，也没有生成验证码）
+    if result in (otp_tools.GENERATE_RESULTS.silent, otp_tools.GENERATE_RESULTS.rejected):
         return errors.RateExceeded()
 
     return api.ok(message='验证码已发送')
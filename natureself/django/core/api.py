@@ -2,12 +2,14 @@
 Utils for building api server.
 """
 
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, HttpResponsePermanentRedirect
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect
 from django.core.paginator import Page as PaginatorPage
 from django.db.models.query import QuerySet
 from django.db.models import Model
 from enum import IntEnum, unique
 
+from . import encoders
+
 @unique
 class Codes(IntEnum):
     OK = 0
@@ -20,7 +22,7 @@ class Codes(IntEnum):
     INTERNAL_SERVER_ERROR = 500
     NOT_IMPLEMENTED = 501
 
-class Response(JsonResponse):
+class Response(HttpResponse):
     def __init__(self, status=200, code=Codes.OK, message='', data=None, **kwargs):
         if isinstance(data, PaginatorPage) or isinstance(data, QuerySet):
             data = [item.serialize() for item in data]
@@ -36,11 +38,29 @@ class Response(JsonResponse):
             content['form_errors'] = kwargs['form_errors']
         if kwargs.get('login_url'):
             content['login_url'] = kwargs['login_url']
-        super().__init__(data=content, status=status)
+        # 不使用 JsonResponse 的编码（标准库 json），见 encoders
+        super().__init__(content=encoders.dumps(content), status=status, content_type='application/json')
+
+class StreamingResponse(StreamingHttpResponse):
+    """
+    流式返回列表，items 可以是生成器，每次只需要编码一部分元素，内存占用与列表的长度无关。
+    内容与 Response(data=list(items), pagination=pagination) 相同
+    """
+    def __init__(self, items, status=200, code=Codes.OK, message='', pagination=None, chunk_size=100):
+        head = encoders.dumps(dict(code=code, message=message))[:-1] + b',"data":['
+        tail = b']'
+        if pagination:
+            tail += b',"pagination":' + encoders.dumps(pagination)
+        tail += b'}'
+        super().__init__(encoders.iter_list(head, items, tail, chunk_size=chunk_size),
+                status=status, content_type='application/json')
 
 def ok(message='ok', code=Codes.OK, data=None, pagination=None):
     return Response(status=200, code=Codes.OK, message=message, data=data, pagination=pagination)
 
+def stream(items, message='ok', pagination=None):
+    return StreamingResponse(items, status=200, code=Codes.OK, message=message, pagination=pagination)
+
 def created(message='resource created', data=None):
     return Response(status=201, code=Codes.OK, message=message, data=data)
 
@@ -0,0 +1,107 @@
+"""
+API 响应的 JSON 编码
+
+api.Response 原来使用 JsonResponse（标准库 json + DjangoJSONEncoder）编码，数据较多的列表接口中编码会占用不少 CPU。
+这里提供可替换的编码后端：
+
+* orjson：安装了 orjson 时默认使用，比标准库快很多
+* stdlib：标准库 json，没有安装 orjson 时使用
+
+两种后端的输出（解析后）相同，datetime、date、time、timedelta、Decimal、UUID 以及延迟翻译的字符串
+的处理与 DjangoJSONEncoder 相同，因此 serialize() 中可以直接返回 datetime，不需要先转换为字符串。
+注意这与 serialize_datetime() 的格式（本地时间 '%Y-%m-%d %H:%M:%S'）不同，已有接口的字段不要随意修改。
+
+相关配置（均为可选）：
+
+    # auto（默认）：安装了 orjson 时使用 orjson，否则使用 stdlib；也可以指定为 orjson 或 stdlib
+    NS_API_JSON_ENCODER = 'auto'
+    # datetime 的格式：
+    # * django（默认）：与 DjangoJSONEncoder 相同，毫秒精度，UTC 时间以 Z 结尾，例如 2019-06-01T08:00:00.123Z
+    # * rfc3339：orjson 的原生格式，微秒精度，不需要调用 Python 代码，更快（使用 stdlib 时与 django 相同）
+    NS_API_JSON_DATETIME = 'django'
+
+可以使用 `manage.py benchmark_json` 比较不同后端的速度。
+"""
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+class StdlibBackend:
+    name = 'stdlib'
+
+    def __init__(self):
+        self.encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(self, data):
+        return self.encoder.encode(data).encode()
+
+class OrjsonBackend:
+    name = 'orjson'
+
+    def __init__(self, datetime_format='django'):
+        # orjson 不支持的类型（Decimal、延迟翻译的字符串等），以及 django 格式的 datetime，由 DjangoJSONEncoder 处理
+        self.default = DjangoJSONEncoder().default
+        # 与标准库相同，dict 的 key 可以是数字等类型
+        self.option = orjson.OPT_NON_STR_KEYS
+        if datetime_format == 'rfc3339':
+            self.option |= orjson.OPT_UTC_Z
+        else:
+            self.option |= orjson.OPT_PASSTHROUGH_DATETIME
+        self.fallback = StdlibBackend()
+
+    def dumps(self, data):
+        try:
+            return orjson.dumps(data, default=self.default, option=self.option)
+        except orjson.JSONEncodeError as e:
+            # orjson 不支持超过 64 位的整数等，使用标准库重试（仍然不支持的类型会抛出 TypeError）
+            logger.warning(f'orjson failed to encode response, fallback to stdlib: {e}')
+            return self.fallback.dumps(data)
+
+def get_backend(name=None, datetime_format=None):
+    """
+    name: auto、orjson 或 stdlib，默认使用 NS_API_JSON_ENCODER
+    """
+    name = name or getattr(settings, 'NS_API_JSON_ENCODER', 'auto')
+    datetime_format = datetime_format or getattr(settings, 'NS_API_JSON_DATETIME', 'django')
+    if name == 'auto':
+        name = 'orjson' if orjson else 'stdlib'
+    if name == 'orjson':
+        if not orjson:
+            raise ImportError('NS_API_JSON_ENCODER is orjson, but orjson is not installed')
+        return OrjsonBackend(datetime_format)
+    elif name == 'stdlib':
+        return StdlibBackend()
+    raise ValueError(f'unknown json encoder: {name}')
+
+backend = get_backend()
+
+def dumps(data):
+    """
+    编码为 JSON，返回 bytes（utf-8）
+    """
+    return backend.dumps(data)
+
+def iter_list(head, items, tail, chunk_size=100):
+    """
+    流式编码一个列表，依次返回 head、items 中的元素（以逗号分隔）、tail，每 chunk_size 个元素合并为一块。
+    head、tail 是已经编码好的 bytes，例如 b'{"data":[' 和 b']}'
+    """
+    yield head
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) >= chunk_size:
+            yield (b'' if first else b',') + b','.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield tail
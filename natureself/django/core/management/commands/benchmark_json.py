@@ -0,0 +1,130 @@
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+import json
+import time
+import random
+import string
+
+from natureself.django.core import encoders
+from natureself.django.core.utils import serialize_datetime
+
+# 中英文混合的文本，标准库 ensure_ascii 时中文会被转义
+CHARS = string.ascii_letters + string.digits + ' ' * 10 + '基层联盟知享呼吸培训课程资格认证考试评定新闻专题会议学术活动用户邮箱手机号验证码'
+
+def random_text(k):
+    return ''.join(random.choices(CHARS, k=k))
+
+def email_payload(count):
+    # 与 EmailMessage.serialize() 的结构相同，created_at、sent_at 为 datetime
+    now = timezone.now()
+    return [dict(
+            id = i,
+            subject = random_text(20),
+            from_email = ['基层联盟', 'noreply@example.com'],
+            recipients = [[random_text(3), f'user{i}@example.com']],
+            content = '<p>' + random_text(800) + '</p>',
+            status = random.randint(1, 4),
+            created_at = now - timezone.timedelta(seconds=random.randint(0, 86400 * 30), microseconds=random.randint(0, 999999)),
+            sent_at = now,
+            attempts = 1,
+            last_error = '',
+            attachments = [],
+            ) for i in range(count)]
+
+def sms_payload(count):
+    # 与 AliSms.serialize() 的结构相同
+    now = timezone.now()
+    return [dict(
+            phone_numbers = [f'139{i:08d}'],
+            content = f'【基层联盟】您的验证码为 {random.randint(100000, 999999)}，10 分钟内有效',
+            status = 2,
+            created_at = now - timezone.timedelta(seconds=random.randint(0, 86400 * 30), microseconds=random.randint(0, 999999)),
+            sent_at = now,
+            ali_bizid = ''.join(random.choices(string.digits, k=20)),
+            ali_code = 'OK',
+            ali_message = 'OK',
+            attempts = 1,
+            last_error = '',
+            ) for i in range(count)]
+
+def image(i):
+    return dict(id=i, url=f'https://example.com/images/{i}.jpg', filename=f'{i}.jpg', title=random_text(10),
+            content_type='image/jpeg', size=random.randint(10000, 1000000), renditions={'thumbnail': f'/r/{i}/thumbnail'})
+
+def page_payload(count, formatted):
+    # 与 ProjectPage.serialize() 的结构相同，包含专题以及附件。formatted 为 True 时时间使用 serialize_datetime() 转换
+    now = timezone.now()
+    project = dict(id=1, title=random_text(20), theme_colors={'primary': '#336699'}, theme='default',
+            banner=image(1), banner_background=image(2), introduction=random_text(300), slug='project', menu=dict(id=1))
+    pages = []
+    for i in range(count):
+        created_at = now - timezone.timedelta(seconds=random.randint(0, 86400 * 30))
+        pages.append(dict(
+            id = i,
+            page_title = random_text(15),
+            pagetype = dict(type='news', name='新闻'),
+            url = f'/project/project/{i}/',
+            status = 1,
+            page_name = '新闻',
+            project = project,
+            attachments = [image(i * 10 + j) for j in range(3)],
+            created_at = serialize_datetime(created_at) if formatted else created_at,
+            updated_at = serialize_datetime(now) if formatted else now,
+            ))
+    return pages
+
+class Command(BaseCommand):
+    help = ('比较 API 响应的 JSON 编码速度：JsonResponse 原来使用的编码方式（DjangoJSONEncoder、ensure_ascii）'
+            '与 natureself.django.core.encoders 的各个后端，数据为邮件、短信、专题页面等列表接口的典型响应')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='每种数据、每种编码方式执行的次数')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def get_encoders(self):
+        legacy = DjangoJSONEncoder()
+        result = [
+            ('JsonResponse', lambda data: legacy.encode(data).encode()),
+            ('stdlib', encoders.get_backend('stdlib').dumps),
+        ]
+        if encoders.orjson:
+            result += [
+                ('orjson', encoders.get_backend('orjson', 'django').dumps),
+                ('orjson-rfc3339', encoders.get_backend('orjson', 'rfc3339').dumps),
+            ]
+        else:
+            self.stdout.write('orjson is not installed, skipping orjson backends')
+        return result
+
+    def measure(self, dumps, data, repeat):
+        # 取最快的一次，减少其他进程的干扰
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            content = dumps(data)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, len(content)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        payloads = [
+            ('email list (20)', dict(code=0, message='ok', data=email_payload(20))),
+            ('sms list (100)', dict(code=0, message='ok', data=sms_payload(100))),
+            ('page list (20, formatted time)', dict(code=0, message='ok', data=page_payload(20, True))),
+            ('page list (20, datetime)', dict(code=0, message='ok', data=page_payload(20, False))),
+            ('sms export (10000)', dict(code=0, message='ok', data=sms_payload(10000))),
+        ]
+        backends = self.get_encoders()
+
+        for title, data in payloads:
+            # 所有后端的输出解析后应该相同（rfc3339 的时间格式不同，不比较）
+            expected = json.loads(backends[0][1](data))
+            self.stdout.write(f'{title}:')
+            for name, dumps in backends:
+                elapsed, size = self.measure(dumps, data, options['repeat'])
+                same = json.loads(dumps(data)) == expected
+                note = '' if same or name.endswith('rfc3339') else '  OUTPUT DIFFERS'
+                self.stdout.write(f'    {name:<16} {elapsed:9.3f} ms {size:>10} bytes{note}')
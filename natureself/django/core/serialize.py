@@ -0,0 +1,110 @@
+"""
+批量序列化
+
+model.serialize() 中经常会访问关联对象（例如 page.project.banner、page.attachments.all()），
+逐个序列化一个列表时，每一行都会产生若干次查询（N+1 问题）。
+
+为了解决这个问题，model 可以声明 serialize() 需要用到哪些关联对象：
+
+    class Project(models.Model):
+        @classmethod
+        def get_serialize_related(cls, with_menu=False, **kwargs):
+            # 参数与 serialize() 相同（to_dict 除外），返回 lookup 列表，格式与 prefetch_related() 相同
+            return ['banner', 'banner_background']
+
+然后使用 serialize_objects() 批量序列化：
+
+    data = serialize_objects(Project.objects.all(), with_menu=False)
+
+serialize_objects() 会：
+1. 如果传入的是未执行的 queryset，那么对于只经过 ForeignKey/OneToOneField 的 lookup，使用 select_related()，
+   这些关联对象跟随主查询一次取出；
+2. 执行查询后，将对象按照实际的类型分组（select_subclasses() 返回的是不同子类的对象，子类可以声明更多的 lookup），
+   对每一组调用 prefetch_related_objects()，已经通过 select_related 取出的对象不会重复查询；
+3. 逐个调用 obj.serialize(**kwargs)，返回的结果与逐个序列化完全相同。
+
+查询次数只与 lookup 的数量、子类的数量有关，与对象的数量无关。
+
+没有声明 get_serialize_related() 的 model 仍然可以使用 serialize_objects()，行为等同于逐个序列化。
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import QuerySet, prefetch_related_objects
+
+def get_serialize_related(model, **kwargs):
+    """
+    获取 model 序列化时需要的关联对象 lookup 列表
+    """
+    getter = getattr(model, 'get_serialize_related', None)
+    if getter is None:
+        return []
+    return list(getter(**kwargs))
+
+def _can_select_related(model, lookup):
+    # lookup 中的每一级都是 ForeignKey/OneToOneField（包括反向的 OneToOne）时，才可以使用 select_related
+    for name in lookup.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        if not field.is_relation or not (field.many_to_one or field.one_to_one):
+            return False
+        model = field.related_model
+    return True
+
+def select_serialize_related(queryset, **kwargs):
+    """
+    根据 queryset.model 声明的 lookup，为 queryset 加上 select_related()
+    """
+    lookups = [lookup for lookup in get_serialize_related(queryset.model, **kwargs)
+            if _can_select_related(queryset.model, lookup)]
+    if lookups:
+        queryset = queryset.select_related(*lookups)
+    return queryset
+
+def prefetch_serialize_related(objects, **kwargs):
+    """
+    按照对象的实际类型分组，批量取出每个类型声明的关联对象
+    """
+    groups = {}
+    for obj in objects:
+        groups.setdefault(type(obj), []).append(obj)
+
+    for model, instances in groups.items():
+        lookups = get_serialize_related(model, **kwargs)
+        if lookups:
+            prefetch_related_objects(instances, *lookups)
+
+def serialize_objects(objects, **kwargs):
+    """
+    批量序列化，objects 可以是 queryset 或者对象列表，kwargs 会原样传给 obj.serialize()
+    """
+    if isinstance(objects, QuerySet) and objects._result_cache is None:
+        objects = select_serialize_related(objects, **kwargs)
+    objects = list(objects)
+    prefetch_serialize_related(objects, **kwargs)
+    return [obj.serialize(**kwargs) for obj in objects]
+
+def iter_serialize_objects(queryset, chunk_size=500, **kwargs):
+    """
+    与 serialize_objects() 相同，但每次只取出 chunk_size 个对象（预取关联对象也是每一批一次），逐个返回序列化结果。
+    用于流式返回很长的列表（见 api.stream()），内存占用与列表长度无关。
+
+    queryset.iterator() 会忽略 queryset 上的 prefetch_related()，这里对每一批对象手动执行这些 lookup
+    """
+    if queryset._result_cache is None:
+        queryset = select_serialize_related(queryset, **kwargs)
+    prefetch_lookups = queryset._prefetch_related_lookups
+
+    def serialize_chunk(objects):
+        if prefetch_lookups:
+            prefetch_related_objects(objects, *prefetch_lookups)
+        prefetch_serialize_related(objects, **kwargs)
+        return [obj.serialize(**kwargs) for obj in objects]
+
+    objects = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        objects.append(obj)
+        if len(objects) >= chunk_size:
+            yield from serialize_chunk(objects)
+            objects = []
+    yield from serialize_chunk(objects)
@@ -1,7 +1,13 @@
 from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import F, Q
 from django.utils import timezone
 
-def get_pagination(request, queryset, page=None, page_size=None):
+import json
+import base64
+import binascii
+
+def get_pagination(request, queryset, page=None, page_size=None, mode='page', ordering=None, count='exact'):
     """
     根据 queryset 和 page/page_size 参数获取分页数据结构，返回三个东西：page, paginator, pagination
 
@@ -23,7 +29,13 @@ def get_pagination(request, queryset, page=None, page_size=None):
     page/page_size: 如果调用时提供了 page/page_size 参数，则使用该参数，否则会尝试从 QueryString 中读取，即 request.GET.get('page')
     url: 一个函数，该函数接受 request 和 page(页码) 两个参数，可以生成指定页码的 URL，如果提供了该参数，
          那么在返回的 pagination 中还会有 current_url, next_url, previous_url 这三个参数。
+    mode: 分页方式，'page' 为页码分页，'cursor' 为游标分页（keyset pagination）。
+          游标分页时，page 为当前页的资源列表，paginator 为 None，ordering、count 参数的含义请见 get_cursor_pagination()。
     """
+    if mode == 'cursor':
+        objects, pagination = get_cursor_pagination(request, queryset, page_size=page_size, ordering=ordering, count=count)
+        return objects, None, pagination
+
     if page is None:
         page = request.GET.get('page', 1)
     if page_size is None:
@@ -45,6 +57,216 @@ def get_pagination(request, queryset, page=None, page_size=None):
 
     return page, paginator, pagination
 
+class InvalidCursor(ValueError):
+    pass
+
+def _encode_cursor(direction, values):
+    data = json.dumps(dict(d=direction, v=values), separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(data.decode())
+        direction, values = data['d'], data['v']
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(f'invalid cursor: {cursor}') from e
+    if direction not in ('next', 'previous') or not isinstance(values, list):
+        raise InvalidCursor(f'invalid cursor: {cursor}')
+    return direction, values
+
+def _get_ordering_field(model, lookup):
+    # 支持 'field'、'fk__field' 形式的排序字段，返回最终的 field，用于还原游标中的值
+    field = None
+    for name in lookup.split('__'):
+        field = model._meta.get_field(name)
+        if field.is_relation:
+            model = field.related_model
+    return field
+
+def _get_row_value(obj, lookup):
+    names = lookup.split('__')
+    for name in names[:-1]:
+        obj = getattr(obj, name)
+        if obj is None:
+            return None
+    field = obj._meta.get_field(names[-1])
+    return getattr(obj, field.attname)
+
+def _get_keyset_filter(ordering, values, after):
+    """
+    构造 keyset 条件，after 为 True 时取排在 values 之后的行，否则取排在 values 之前的行。
+
+    排序时我们把 NULL 当作比任何值都大（与 postgres 的默认行为一致，这样才能用上普通的 btree 索引），因此：
+    * 比非 NULL 值 v 大：> v，或者 NULL
+    * 比 NULL 大：不存在
+    * 比非 NULL 值 v 小：< v，不包括 NULL
+    * 比 NULL 小：所有非 NULL 值
+    """
+    condition = Q(pk__in=[])
+    equal = Q()
+    for (name, desc), value in zip(ordering, values):
+        # 排在后面的行，在升序时是更大的值，在降序时是更小的值
+        greater = desc != after
+        if value is None:
+            if not greater:
+                condition |= equal & Q(**{f'{name}__isnull': False})
+            equal &= Q(**{f'{name}__isnull': True})
+        else:
+            if greater:
+                beyond = Q(**{f'{name}__gt': value}) | Q(**{f'{name}__isnull': True})
+            else:
+                beyond = Q(**{f'{name}__lt': value})
+            condition |= equal & beyond
+            equal &= Q(**{name: value})
+
+    # 上面的 OR 条件数据库一般无法用作索引条件，这里对第一个排序字段额外加一个范围条件，
+    # 使数据库可以直接从索引中定位到游标的位置，而不是从头扫描
+    (name, desc), value = ordering[0], values[0]
+    if value is not None:
+        if desc != after:
+            condition &= Q(**{f'{name}__gte': value}) | Q(**{f'{name}__isnull': True})
+        else:
+            condition &= Q(**{f'{name}__lte': value})
+
+    return condition
+
+def estimate_count(queryset):
+    """
+    估算 queryset 的行数，目前仅支持 postgres，其他数据库返回精确的 count()
+
+    * 没有过滤条件时，使用 pg_class.reltuples（由 VACUUM/ANALYZE 更新的表行数统计值）
+    * 有过滤条件时，使用查询计划（EXPLAIN）中估算的行数
+
+    估算值可能有较大误差，仅适用于不需要精确总数的场景（例如邮件、短信记录这类大表的分页）。
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            estimated = int(row[0]) if row else -1
+        else:
+            sql, params = queryset.order_by().values('pk').query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimated = int(plan[0]['Plan']['Plan Rows'])
+
+    # 从未 ANALYZE 过的表，reltuples 为 -1（PG14 之后）或 0，此时退回到精确计数
+    if estimated <= 0:
+        return queryset.count()
+    return estimated
+
+def get_cursor_pagination(request, queryset, cursor=None, page_size=None, ordering=None, count='exact'):
+    """
+    游标分页（keyset pagination），返回两个东西：objects, pagination
+
+    页码分页需要 COUNT(*) 以及 OFFSET，翻到越后面的页，数据库需要跳过的行就越多，对于邮件、短信记录这类大表，
+    深度翻页会越来越慢。游标分页记录当前页第一行、最后一行的排序字段的值，翻页时使用 WHERE 条件定位，
+    配合排序字段上的索引，任何一页的速度都是一样的。代价是只能翻到上一页、下一页，不能跳到指定页码。
+
+    * objects: 当前页的资源列表
+    * pagination: 格式化后的分页信息字典，内容如下：
+
+    {
+        "total": 123,                // 资源总数，count='none' 时为 null
+        "total_estimated": false,    // total 是否为估算值
+        "page_size": 10,             // 分页大小
+        "cursor": "xxx",             // 当前页的游标，第一页为 null
+        "next_cursor": "xxx",        // 下一页的游标，没有下一页时为 null
+        "previous_cursor": "xxx",    // 上一页的游标，没有上一页时为 null
+    }
+
+    游标是不透明的字符串，前端不应该解析，只需要在翻页时通过 cursor 参数原样传回。
+
+    参数:
+
+    cursor/page_size: 如果调用时提供了 cursor/page_size 参数，则使用该参数，否则会尝试从 QueryString 中读取。
+    ordering: 排序字段列表，格式与 order_by() 相同，如 ['-sent_at']。如果不提供，则使用 queryset 的排序。
+              我们会自动在最后加上 id，保证排序是确定的。NULL 值被当作最大值，即升序时排在最后，降序时排在最前。
+              为了获得好的性能，排序字段上（包括 id）应该有相应的索引。
+    count: 'exact' 精确计数，'estimate' 估算（见 estimate_count()），'none' 不计数。
+
+    如果 cursor 格式错误，抛出 InvalidCursor（ValueError 的子类）。
+    """
+    if cursor is None:
+        cursor = request.GET.get('cursor') or None
+    if page_size is None:
+        page_size = request.GET.get('page_size', 10)
+    try:
+        page_size = max(int(page_size), 1)
+    except (TypeError, ValueError):
+        page_size = 10
+
+    model = queryset.model
+    if ordering is None:
+        ordering = list(queryset.query.order_by) or list(model._meta.ordering)
+    ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+    ordering = [('pk' if name == 'id' else name, desc) for name, desc in ordering]
+    if not any(name == 'pk' for name, desc in ordering):
+        ordering.append(('pk', ordering[-1][1] if ordering else True))
+    fields = [(name, model._meta.pk if name == 'pk' else _get_ordering_field(model, name)) for name, desc in ordering]
+
+    if count == 'exact':
+        total = queryset.count()
+    elif count == 'estimate':
+        total = estimate_count(queryset)
+    else:
+        total = None
+
+    direction = 'next'
+    if cursor:
+        direction, values = _decode_cursor(cursor)
+        if len(values) != len(ordering):
+            raise InvalidCursor(f'invalid cursor: {cursor}')
+        try:
+            values = [None if value is None else field.to_python(value) for (name, field), value in zip(fields, values)]
+        except Exception as e:
+            raise InvalidCursor(f'invalid cursor: {cursor}') from e
+        queryset = queryset.filter(_get_keyset_filter(ordering, values, after=(direction == 'next')))
+
+    # 向前翻页时，反向排序取出 page_size 条记录再倒过来。
+    # 这里显式指定 NULL 的位置（当作最大值），使各个数据库的结果一致
+    reverse = direction == 'previous'
+    order_by = []
+    for name, desc in ordering:
+        if desc != reverse:
+            order_by.append(F(name).desc(nulls_first=True))
+        else:
+            order_by.append(F(name).asc(nulls_last=True))
+    objects = list(queryset.order_by(*order_by)[:page_size+1])
+    has_more = len(objects) > page_size
+    objects = objects[:page_size]
+    if reverse:
+        objects.reverse()
+
+    def row_cursor(direction, obj):
+        values = [obj.pk if name == 'pk' else _get_row_value(obj, name) for name, desc in ordering]
+        return _encode_cursor(direction, values)
+
+    next_cursor = previous_cursor = None
+    if objects:
+        if has_more or reverse:
+            next_cursor = row_cursor('next', objects[-1])
+        if (has_more and reverse) or (cursor and not reverse):
+            previous_cursor = row_cursor('previous', objects[0])
+
+    pagination = {
+        'total': total,
+        'total_estimated': count == 'estimate',
+        'page_size': page_size,
+        'cursor': cursor,
+        'next_cursor': next_cursor,
+        'previous_cursor': previous_cursor,
+    }
+
+    return objects, pagination
+
 def get_boolean_query(request, query, default=None):
     """
     获取一个 bool 类型的 querystring 参数。当该参数的值为 true, t, yes, y, 1 时（不区分大小写），返回 True，否则返回 False。
@@ -129,3 +351,10 @@ def serialize_datetime(t, format='%Y-%m-%d %H:%M:%S'):
     if timezone.is_aware(t):
         t = timezone.make_naive(t)
     return t.strftime(format)
+
+def get_client_ip(request):
+    """
+    获取客户端的 IP。在我们的架构中，nginx 会将客户端的真实 IP 放在 X-Real-IP 头中（见 nginx.conf），
+    此时 REMOTE_ADDR 是代理的地址；没有这个头时（例如在 k8s 中直接访问）使用 REMOTE_ADDR
+    """
+    return request.META.get('HTTP_X_REAL_IP') or request.META.get('REMOTE_ADDR')
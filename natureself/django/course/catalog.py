@@ -0,0 +1,66 @@
+"""
+课程目录
+
+课程列表中通常需要知道每个课程是否已发布（有已发布的 lesson）以及 lesson 数量，
+逐个课程调用 Course.published 时，每个课程一次查询。这里在一次查询中通过子查询计算：
+
+    # 设置 course.published、course.lesson_count（已发布的 lesson 数量）
+    Course.objects.with_lesson_stats()
+
+    # 所有课程（包括 thumbnail），结果会缓存，lesson、课程修改时失效
+    Course.objects.get_catalog()
+
+缓存使用 settings.CACHES 中的 default 缓存，多进程部署时该缓存必须是进程间共享的，否则其他进程中的缓存不会失效。
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Exists, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+# 课程目录的缓存时间（秒），lesson、课程修改时会主动失效，这里只是为了避免失效逻辑遗漏时长时间不更新
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'NS_COURSE_CATALOG_CACHE_TIMEOUT', 60 * 10)
+CATALOG_CACHE_KEY = 'ns:course:catalog'
+
+def annotate_lesson_stats(queryset):
+    """
+    为课程 queryset 添加 published、lesson_count 两个字段，使用关联子查询，不需要 JOIN + GROUP BY
+    """
+    # 这里不能直接导入 models，models 会导入本模块
+    PresentationLesson = apps.get_model('course', 'PresentationLesson')
+    lessons = PresentationLesson.objects \
+            .filter(course_id=OuterRef('pk'), status=PresentationLesson.STATUSES.published) \
+            .order_by()
+    lesson_count = lessons.values('course_id').annotate(count=Count('id')).values('count')
+    return queryset.annotate(
+            # 与 Course.published 相同，annotate 之后 course.published 不会再查询数据库
+            published = Exists(lessons.values('id')),
+            lesson_count = Coalesce(Subquery(lesson_count, output_field=IntegerField()), 0),
+            )
+
+def build_catalog():
+    Course = apps.get_model('course', 'Course')
+    return list(Course.objects.with_lesson_stats().select_related('thumbnail').order_by('id'))
+
+def get_catalog():
+    courses = cache.get(CATALOG_CACHE_KEY)
+    if courses is None:
+        courses = build_catalog()
+        cache.set(CATALOG_CACHE_KEY, courses, timeout=CATALOG_CACHE_TIMEOUT)
+    return courses
+
+def invalidate_catalog():
+    cache.delete(CATALOG_CACHE_KEY)
+
+# 课程（标题、缩略图等）以及 lesson（发布状态、所属课程）修改时失效。
+# 这里不能导入 models，因此 sender 使用 'app_label.ModelName' 的形式
+@receiver(post_save, sender='course.Course')
+@receiver(post_delete, sender='course.Course')
+@receiver(post_save, sender='course.PresentationLesson')
+@receiver(post_delete, sender='course.PresentationLesson')
+def invalidate_catalog_on_change(sender, **kwargs):
+    # 与 progress 相同，事务提交之后再失效，避免其他请求读到旧数据后重新写入缓存
+    transaction.on_commit(invalidate_catalog)
@@ -6,15 +6,36 @@ from django.conf import settings
 from django.utils.functional import cached_property
 
 from natureself.django.core.model_mixins import Orderable
-from natureself.django.media.models import PresentationWatchRecord
+
+from . import progress, catalog
 
 import json
 from model_utils import Choices
 
+class CourseQuerySet(models.QuerySet):
+    def with_lesson_stats(self):
+        """
+        设置 published（是否有已发布的 lesson）与 lesson_count（已发布的 lesson 数量），见 catalog
+        """
+        return catalog.annotate_lesson_stats(self)
+
+class CourseManager(models.Manager.from_queryset(CourseQuerySet)):
+    def get_catalog(self):
+        """
+        所有课程（已设置 thumbnail、published、lesson_count），按 id 排序。
+        结果会缓存，课程、lesson 修改时失效，课程列表页面请使用该方法
+        """
+        return catalog.get_catalog()
+
+    def invalidate_catalog(self):
+        catalog.invalidate_catalog()
+
 class Course(models.Model):
     """
     一个课程由若干 Lesson 组成
     """
+    objects = CourseManager()
+
     # 该课程的发布者
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, null=True, verbose_name='课程发布者')
     # 课程名称
@@ -30,36 +51,16 @@ class Course(models.Model):
         * self.presentationlessons: [PresentationLesson]
         * self.default_presentationlesson: 用户首个未学习过的课程
         * self.all_presentationlessons_watched: true/false
-        """
-        if hasattr(self, 'presentationlessons'):
-            return
-        self.presentationlessons = list(
-                self.presentationlesson_set \
-                        .filter(status=PresentationLesson.STATUSES.published) \
-                        .select_related('presentation') \
-                        .prefetch_related(models.Prefetch(
-                            'presentation__watch_records',
-                            queryset=PresentationWatchRecord.objects.filter(user=user, watched=True),
-                        )) \
-                        .order_by('id')
-                )
-        for lesson in self.presentationlessons:
-            lesson.watched = len(lesson.presentation.watch_records.all()) > 0
 
-        self.default_presentationlesson = self.presentationlessons[0] if self.presentationlessons else None
-        for lesson in self.presentationlessons:
-            if not lesson.watched:
-                self.default_presentationlesson = lesson
-                break
-
-        self.all_presentationlessons_watched = all(
-                [lesson.watched for lesson in self.presentationlessons]
-                )
+        对于多个课程，请使用 progress.fetch_courses_progress(courses, user)，所有课程只需要一次查询
+        """
+        progress.fetch_courses_progress([self], user)
 
     @cached_property
     def published(self):
         # 如果课程下没有 published 状态的 lesson，则 published 为 false
         # 暂时只考虑 presentation_lesson
+        # 使用 Course.objects.with_lesson_stats() 或 get_catalog() 取出的课程已经设置了该值，不会再查询
         return self.presentationlesson_set.filter(status=PresentationLesson.STATUSES.published).exists()
 
     def serialize(self, to_dict=True):
@@ -70,6 +71,9 @@ class Course(models.Model):
                 introduction = self.introduction,
                 thumbnail = self.thumbnail.serialize() if self.thumbnail else None,
                 )
+        # 使用 with_lesson_stats() 取出的课程
+        if hasattr(self, 'lesson_count'):
+            data.update(published=self.published, lesson_count=self.lesson_count)
         return data if to_dict else json.dumps(data, ensure_ascii=False)
 
 class Lesson(Orderable):
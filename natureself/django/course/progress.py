@@ -0,0 +1,167 @@
+"""
+课程学习进度
+
+用户是否学完一个课程，取决于课程中所有已发布的 PresentationLesson 对应的 PPT 是否都已经看完
+（PresentationWatchRecord.watched）。
+
+逐个课程、逐个用户计算时，每次都需要查询课程的 lesson 和用户的观看记录，在课程列表、导出所有用户的培训数据时，
+查询次数为 课程数 × 用户数。这里提供批量计算的方法，查询次数与课程数、用户数无关：
+
+    # 一次查询所有课程的 lesson，一次（每 500 个用户一次）查询所有用户的观看记录
+    progress = get_progress(user_ids, course_ids)
+    progress[(user_id, course_id)].all_watched
+
+    # 为课程列表设置 presentationlessons 等属性（见 Course.fetch_presentationlesson_details）
+    fetch_courses_progress(courses, user)
+
+单个用户看完的 PPT 列表会缓存（get_user_watched()），在 Presentation.mark_watched() 时失效
+（见 natureself.django.media.signals.presentation_watched）。
+"""
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.dispatch import receiver
+
+from natureself.django.media.signals import presentation_watched
+
+# 批量查询观看记录时，每次查询的用户数量
+USER_CHUNK_SIZE = 500
+# 用户观看记录缓存时间（秒），观看记录变化时会主动失效，这里只是为了避免缓存无限增长
+USER_CACHE_TIMEOUT = 60 * 60 * 24
+
+class CourseProgress:
+    """
+    一个用户在一个课程中的学习进度
+    """
+    def __init__(self, lessons, watched_presentation_ids):
+        # lessons: [(lesson_id, presentation_id)]，按照 lesson id 排序
+        self.lesson_ids = [lesson_id for lesson_id, presentation_id in lessons]
+        self.watched_lesson_ids = {
+                lesson_id for lesson_id, presentation_id in lessons if presentation_id in watched_presentation_ids
+                }
+
+    @property
+    def all_watched(self):
+        # 与原来的逻辑一致，没有 lesson 的课程视为已学完
+        return len(self.watched_lesson_ids) == len(self.lesson_ids)
+
+    @property
+    def default_lesson_id(self):
+        """
+        用户首个未学习过的 lesson，都学习过时为第一个 lesson，没有 lesson 时为 None
+        """
+        for lesson_id in self.lesson_ids:
+            if lesson_id not in self.watched_lesson_ids:
+                return lesson_id
+        return self.lesson_ids[0] if self.lesson_ids else None
+
+def get_lessons_queryset(course_ids):
+    # 这里不能直接导入 models，cardpc.models 会导入本模块，此时 User 模型还没有加载
+    PresentationLesson = apps.get_model('course', 'PresentationLesson')
+    return PresentationLesson.objects \
+            .filter(course_id__in=course_ids, status=PresentationLesson.STATUSES.published) \
+            .order_by('id')
+
+def get_watch_records():
+    return apps.get_model('media', 'PresentationWatchRecord').objects.all()
+
+def get_course_lessons(course_ids):
+    """
+    返回 {course_id: [(lesson_id, presentation_id)]}，一次查询
+    """
+    lessons = {course_id: [] for course_id in course_ids}
+    for lesson_id, course_id, presentation_id in get_lessons_queryset(course_ids) \
+            .values_list('id', 'course_id', 'presentation_id'):
+        lessons[course_id].append((lesson_id, presentation_id))
+    return lessons
+
+def get_watched(user_ids, presentation_ids):
+    """
+    返回 {user_id: set(presentation_id)}，每 USER_CHUNK_SIZE 个用户一次查询
+    """
+    user_ids = list(user_ids)
+    watched = {user_id: set() for user_id in user_ids}
+    if not presentation_ids:
+        return watched
+    for i in range(0, len(user_ids), USER_CHUNK_SIZE):
+        records = get_watch_records() \
+                .filter(user_id__in=user_ids[i:i+USER_CHUNK_SIZE], presentation_id__in=presentation_ids, watched=True) \
+                .values_list('user_id', 'presentation_id')
+        for user_id, presentation_id in records:
+            watched[user_id].add(presentation_id)
+    return watched
+
+def get_progress(user_ids, course_ids):
+    """
+    批量计算学习进度，返回 {(user_id, course_id): CourseProgress}
+    """
+    user_ids, course_ids = set(user_ids), set(course_ids)
+    lessons = get_course_lessons(course_ids)
+    presentation_ids = {presentation_id for items in lessons.values() for lesson_id, presentation_id in items}
+    watched = get_watched(user_ids, presentation_ids)
+    return {
+            (user_id, course_id): CourseProgress(lessons[course_id], watched[user_id])
+            for user_id in user_ids for course_id in course_ids
+            }
+
+def get_user_cache_key(user_id):
+    return f'ns:course:watched:{user_id}'
+
+def get_user_watched(user):
+    """
+    返回用户看完的所有 PPT 的 id（set），结果会缓存
+    """
+    if not user or not user.is_authenticated:
+        return set()
+
+    key = get_user_cache_key(user.id)
+    watched = cache.get(key)
+    if watched is None:
+        watched = set(get_watch_records().filter(user_id=user.id, watched=True)
+                .values_list('presentation_id', flat=True))
+        cache.set(key, watched, timeout=USER_CACHE_TIMEOUT)
+    return watched
+
+def invalidate_user(user_id):
+    cache.delete(get_user_cache_key(user_id))
+
+@receiver(presentation_watched)
+def invalidate_user_on_watched(sender, user, **kwargs):
+    # 与 cardpc.signals 相同，事务提交之后再失效，避免其他请求读到旧数据后重新写入缓存
+    transaction.on_commit(lambda: invalidate_user(user.id))
+
+def fetch_courses_progress(courses, user):
+    """
+    为每个课程设置 presentationlessons、default_presentationlesson、all_presentationlessons_watched，
+    每个 lesson 设置 watched（见 Course.fetch_presentationlesson_details）。
+
+    所有课程的 lesson 一次查询，用户的观看记录使用缓存。
+    """
+    courses = [course for course in courses if not hasattr(course, 'presentationlessons')]
+    if not courses:
+        return
+
+    lessons = {course.id: [] for course in courses}
+    for lesson in get_lessons_queryset(lessons.keys()).select_related('presentation'):
+        lessons[lesson.course_id].append(lesson)
+    for course in courses:
+        course.presentationlessons = lessons[course.id]
+
+    set_courses_progress(courses, get_user_watched(user))
+
+def set_courses_progress(courses, watched):
+    """
+    课程已经设置了 presentationlessons（例如从缓存中取出的课程列表）时，根据用户看完的 PPT（get_user_watched()）
+    设置 default_presentationlesson 等属性，不查询数据库
+    """
+    for course in courses:
+        progress = CourseProgress([(lesson.id, lesson.presentation_id) for lesson in course.presentationlessons], watched)
+        for lesson in course.presentationlessons:
+            lesson.course = course
+            lesson.watched = lesson.id in progress.watched_lesson_ids
+
+        course.default_presentationlesson = None
+        for lesson in course.presentationlessons:
+            if lesson.id == progress.default_lesson_id:
+                course.default_presentationlesson = lesson
+        course.all_presentationlessons_watched = progress.all_watched
@@ -27,6 +27,10 @@ class CourseAdminView(AdminView):
         panels.ImageUploaderPanel('thumbnail', bucket='thumbnails'),
     ], model=MODEL, form_mode='edit')
 
+    def get_queryset(self, request=None):
+        # 列表中显示课程是否已发布、已发布的 lesson 数量，一次查询
+        return super().get_queryset(request).with_lesson_stats()
+
     def get_extra_create_kwargs(self, request):
         return dict(owner=request.user)
 
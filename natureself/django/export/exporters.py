@@ -0,0 +1,93 @@
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
+
+import tempfile
+
+from natureself.django.media.views.download import content_disposition
+
+from . import writers
+
+class Exporter:
+    """
+    导出数据的基类，子类需要定义 COLUMNS、get_queryset() 和 get_row()。
+
+    同一个 Exporter 既可以在请求中直接导出（response()），也可以在 worker 进程中异步导出（见 jobs.py），
+    异步导出时，worker 通过类的路径（例如 'natureself.admin.views.AdminViewExporter'）找到 Exporter，
+    并使用相同的 params 创建，因此 params 必须可以 JSON 序列化。
+    """
+    # 文件名（不含扩展名），会加上导出的时间
+    FILENAME = '导出数据'
+    # [(标题, 列宽)]
+    COLUMNS = []
+    # 每次从数据库中读取的行数
+    CHUNK_SIZE = 500
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    @classmethod
+    def get_path(cls):
+        return f'{cls.__module__}.{cls.__qualname__}'
+
+    def get_queryset(self):
+        raise NotImplementedError()
+
+    def get_row(self, record):
+        raise NotImplementedError()
+
+    def prepare(self, records):
+        """
+        每读取一批（CHUNK_SIZE）记录后调用，可以在这里批量查询关联数据，避免每一行都查询数据库
+        """
+        pass
+
+    def count(self):
+        return self.get_queryset().count()
+
+    def iter_records(self):
+        records = []
+        for record in self.get_queryset().iterator(chunk_size=self.CHUNK_SIZE):
+            records.append(record)
+            if len(records) >= self.CHUNK_SIZE:
+                self.prepare(records)
+                yield from records
+                records = []
+        if records:
+            self.prepare(records)
+            yield from records
+
+    def iter_rows(self, progress=None):
+        """
+        progress(processed) 会在每一批记录写入后调用
+        """
+        processed = 0
+        for record in self.iter_records():
+            yield self.get_row(record)
+            processed += 1
+            if progress and processed % self.CHUNK_SIZE == 0:
+                progress(processed)
+        if progress:
+            progress(processed)
+
+    def get_filename(self, format):
+        now = timezone.localtime().strftime('%Y%m%d%H%M%S')
+        return f'{self.FILENAME}{now}.{format}'
+
+    def write(self, fp, format, progress=None):
+        writers.write(fp, format, self.COLUMNS, self.iter_rows(progress))
+
+    def response(self, format):
+        """
+        在请求中直接导出。csv 边查询边输出；xlsx 写入临时文件（关闭后自动删除）后再输出
+        """
+        filename = self.get_filename(format)
+        if format == 'csv':
+            response = StreamingHttpResponse(writers.iter_csv(self.COLUMNS, self.iter_rows()),
+                    content_type=writers.get_content_type(format))
+            response['Content-Disposition'] = content_disposition(filename)
+            return response
+
+        fp = tempfile.TemporaryFile()
+        self.write(fp, format)
+        fp.seek(0)
+        return FileResponse(fp, as_attachment=True, filename=filename, content_type=writers.get_content_type(format))
@@ -0,0 +1,181 @@
+"""
+异步导出
+
+数据量很大时，在请求中导出会长时间占用 gunicorn 的 worker（甚至超时）。此时可以创建导出任务：
+
+    job = enqueue(MyExporter, params, format='xlsx', owner=request.user)
+    return api.ok(data=job.serialize())
+
+由单独的 worker 进程执行：
+
+    python manage.py run_export_jobs
+
+前端轮询 GET /api/admin/export/jobs/<id> 获取进度（processed/total），完成后通过 download_url
+（GET /api/admin/export/jobs/<id>/download，只有任务的创建者和超级管理员可以下载）下载文件。
+
+worker 的工作方式：
+* 每次取出一个等待执行的任务，取出时将状态设置为 running，并增加 attempts（多个 worker 同时运行时不会重复执行）
+* 执行时每写入一批（Exporter.CHUNK_SIZE）数据，更新一次 processed（同时更新 updated_at）
+* 如果 worker 在执行过程中退出，running 任务的 updated_at 超过 NS_EXPORT_JOB_LEASE 没有更新时，会被重新执行，
+  超过 NS_EXPORT_JOB_MAX_ATTEMPTS 次后标记为 failed
+* 文件先写入 EXPORT_ROOT 中的临时文件，完成后重命名。导出的数据包含用户信息等，EXPORT_ROOT 不能放在 MEDIA_ROOT 下
+  （默认为 NS_PRIVATE_MEDIA_ROOT/exports，见 models.py）
+* 任务和文件保留 NS_EXPORT_JOB_RETENTION_DAYS 天，由 `manage.py gc_export_jobs` 删除（见 collect()），需要定期运行
+
+相关配置（均为可选）：
+
+    NS_EXPORT_JOB_LEASE = 600           # 秒
+    NS_EXPORT_JOB_MAX_ATTEMPTS = 3
+    NS_EXPORT_JOB_RETENTION_DAYS = 7
+    NS_EXPORT_ROOT = None               # 默认为 NS_PRIVATE_MEDIA_ROOT/exports
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+import os
+import uuid
+import datetime
+import tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+from natureself.django.media.blobs import get_file_mode
+
+from . import writers
+from .models import ExportJob, EXPORT_ROOT
+
+LEASE = getattr(settings, 'NS_EXPORT_JOB_LEASE', 60 * 10)
+MAX_ATTEMPTS = getattr(settings, 'NS_EXPORT_JOB_MAX_ATTEMPTS', 3)
+RETENTION_DAYS = getattr(settings, 'NS_EXPORT_JOB_RETENTION_DAYS', 7)
+TMP_PREFIX = '.export-'
+
+def enqueue(exporter_class, params=None, format='xlsx', owner=None):
+    return ExportJob.objects.create(
+            exporter = exporter_class.get_path(),
+            params = params or {},
+            format = format,
+            owner = owner,
+            )
+
+class ExportWorker:
+    """
+    执行导出任务，一般通过 `manage.py run_export_jobs` 运行
+    """
+    def claim(self):
+        """
+        取出一个待执行的任务（包括已经中断的任务）
+        """
+        stale = timezone.now() - datetime.timedelta(seconds=LEASE)
+        with transaction.atomic():
+            # skip_locked 使多个 worker 可以同时运行，sqlite 不支持 select_for_update，会忽略该选项
+            job = ExportJob.objects \
+                    .select_for_update(skip_locked=True) \
+                    .filter(Q(status=ExportJob.STATUSES.pending)
+                            | Q(status=ExportJob.STATUSES.running, updated_at__lt=stale)) \
+                    .order_by('created_at') \
+                    .first()
+            if job:
+                ExportJob.objects.filter(id=job.id).update(
+                        status = ExportJob.STATUSES.running,
+                        attempts = F('attempts') + 1,
+                        processed = 0,
+                        updated_at = timezone.now(),
+                        )
+                job.refresh_from_db()
+        return job
+
+    def run(self, job):
+        """
+        执行一个任务，返回是否成功
+        """
+        if job.attempts > MAX_ATTEMPTS:
+            self.mark_failed(job, 'worker exited while running the job')
+            return False
+
+        os.makedirs(EXPORT_ROOT, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=EXPORT_ROOT, prefix=TMP_PREFIX, suffix=f'.{job.format}')
+        # 与 media 文件相同，nginx 需要可以读取（X-Accel-Redirect）
+        os.fchmod(fd, get_file_mode())
+        os.close(fd)
+        try:
+            exporter = import_string(job.exporter)(job.params)
+            job.total = exporter.count()
+            job.save(update_fields=['total', 'updated_at'])
+
+            def progress(processed):
+                job.processed = processed
+                job.save(update_fields=['processed', 'updated_at'])
+
+            with open(tmp_path, 'wb') as fp:
+                exporter.write(fp, job.format, progress=progress)
+
+            job.file_path = f'{uuid.uuid4().hex}.{job.format}'
+            job.filename = exporter.get_filename(job.format)
+            job.content_type = writers.get_content_type(job.format)
+            os.replace(tmp_path, job.local_abs_path)
+        except Exception as e:
+            logger.exception('Error while running export job %s', job.id)
+            self.mark_failed(job, str(e) or e.__class__.__name__)
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        job.status = ExportJob.STATUSES.success
+        job.finished_at = timezone.now()
+        job.save(update_fields=['file_path', 'filename', 'content_type', 'status', 'finished_at', 'updated_at'])
+        return True
+
+    def mark_failed(self, job, error):
+        job.status = ExportJob.STATUSES.failed
+        job.last_error = error
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'last_error', 'finished_at', 'updated_at'])
+
+    def drain(self):
+        """
+        执行所有待执行的任务，返回执行的任务数量
+        """
+        count = 0
+        while True:
+            job = self.claim()
+            if not job:
+                return count
+            self.run(job)
+            count += 1
+
+def collect(days=None, dry_run=False):
+    """
+    删除完成（成功或失败）超过 days 天（默认为 NS_EXPORT_JOB_RETENTION_DAYS）的任务及其文件，
+    以及 EXPORT_ROOT 中超过 days 天、不属于任何任务的文件（例如 worker 中断时留下的临时文件）。
+    返回 (删除的任务数量, 删除的文件数量)
+    """
+    days = RETENTION_DAYS if days is None else days
+    before = timezone.now() - datetime.timedelta(days=days)
+
+    jobs_count, files_count = 0, 0
+    for job in ExportJob.objects.filter(finished_at__lt=before).iterator():
+        jobs_count += 1
+        if job.file_path:
+            files_count += 1
+        if not dry_run:
+            job.delete_file()
+            job.delete()
+
+    if os.path.isdir(EXPORT_ROOT):
+        known = set(ExportJob.objects.exclude(file_path='').values_list('file_path', flat=True))
+        for name in os.listdir(EXPORT_ROOT):
+            path = os.path.join(EXPORT_ROOT, name)
+            if name in known or not os.path.isfile(path) or os.path.getmtime(path) >= before.timestamp():
+                continue
+            files_count += 1
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+    return jobs_count, files_count
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from natureself.django.export import jobs
+
+class Command(BaseCommand):
+    help = '删除超过保留时间的导出任务及其文件（见 natureself.django.export.jobs.collect()），建议定期运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None,
+                help=f'删除完成超过指定天数的任务，默认为 NS_EXPORT_JOB_RETENTION_DAYS（{jobs.RETENTION_DAYS} 天）')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不删除')
+
+    def handle(self, *args, **options):
+        count, files = jobs.collect(options['days'], dry_run=options['dry_run'])
+        self.stdout.write(f'{count} job(s) removed, {files} file(s) deleted')
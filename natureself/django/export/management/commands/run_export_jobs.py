@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import time
+import signal
+
+from natureself.django.export.jobs import ExportWorker
+
+class Command(BaseCommand):
+    help = '执行异步导出任务（见 natureself.django.export.jobs）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='执行完当前等待中的任务后退出，不常驻运行')
+        parser.add_argument('--interval', type=float, default=1, help='没有任务时，等待多久（秒）再次检查')
+
+    def handle(self, *args, **options):
+        worker = ExportWorker()
+
+        if options['once']:
+            count = worker.drain()
+            self.stdout.write(f'{count} jobs finished')
+            return
+
+        # 收到 SIGTERM/SIGINT 时，执行完当前的任务再退出
+        self.stopping = False
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            # 常驻进程中需要手动清理失效的数据库连接（例如数据库重启后）
+            close_old_connections()
+            job = worker.claim()
+            if job:
+                worker.run(job)
+                self.stdout.write(f'job {job.id} {job.status}')
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('media', '0011_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exporter', models.TextField()),
+                ('params', jsonfield.fields.JSONField(default=dict)),
+                ('format', models.TextField(choices=[('xlsx', 'Excel'), ('csv', 'CSV')], default='xlsx')),
+                ('status', models.TextField(choices=[('pending', '等待执行'), ('running', '正在执行'), ('success', '导出成功'), ('failed', '导出失败')], default='pending')),
+                ('total', models.IntegerField(null=True)),
+                ('processed', models.IntegerField(default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('document', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='media.Document')),
+                ('owner', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='exportjob',
+            index=models.Index(condition=models.Q(status__in=['pending', 'running']), fields=['created_at'], name='export_job_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.1 on 2026-10-18 11:22
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+import os
+
+
+def remove_public_exports(apps, schema_editor):
+    """
+    此前导出的文件保存为 media.Document（bucket 为 exports），可以通过 /media/ 公开访问。
+    这里删除这些文件，并将 Document 标记为已删除（blob 由 gc_media_files 回收），已完成的任务需要重新导出
+    """
+    Document = apps.get_model('media', 'Document')
+    queryset = Document.objects.filter(bucket='exports', deleted_at__isnull=True)
+    for local_path in queryset.values_list('local_path', flat=True).iterator():
+        try:
+            os.unlink(os.path.join(settings.MEDIA_ROOT, 'documents', 'exports', local_path))
+        except FileNotFoundError:
+            pass
+    queryset.update(deleted_at=timezone.now(), blob=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('export', '0001_initial'),
+        ('media', '0011_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_public_exports, migrations.RunPython.noop),
+        # Django 2.2 在 sqlite 中重建表时，无法处理带 condition 的索引，修改字段前先删除，之后重新创建
+        migrations.RemoveIndex(
+            model_name='exportjob',
+            name='export_job_queue_idx',
+        ),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='document',
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='content_type',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='file_path',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='filename',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='exportjob',
+            index=models.Index(condition=models.Q(status__in=['pending', 'running']), fields=['created_at'], name='export_job_queue_idx'),
+        ),
+    ]
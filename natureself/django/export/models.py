@@ -0,0 +1,114 @@
+from django.db import models
+from django.conf import settings
+from django.urls import reverse
+
+import os
+import json
+import jsonfield
+from model_utils import Choices
+
+from natureself.django.core.utils import serialize_datetime
+
+# 导出的文件包含用户信息等数据，不能放在 MEDIA_ROOT 下（nginx 直接对外提供访问），
+# 默认保存在 NS_PRIVATE_MEDIA_ROOT/exports 中，只能通过 api_download_job 下载
+EXPORT_ROOT = getattr(settings, 'NS_EXPORT_ROOT', None) or os.path.join(
+        getattr(settings, 'NS_PRIVATE_MEDIA_ROOT', os.path.join(settings.BASE_DIR, 'private')), 'exports')
+
+class ExportJob(models.Model):
+    """
+    异步导出任务，由 worker 进程执行（`manage.py run_export_jobs`），见 natureself.django.export.jobs
+
+    导出完成后，文件保存在 EXPORT_ROOT 中，只有任务的创建者（以及超级管理员）可以通过 download_url 下载，
+    超过保留时间后由 `manage.py gc_export_jobs` 删除
+    """
+    class Meta:
+        indexes = [
+            # worker 取待执行的任务
+            models.Index(fields=['created_at'], name='export_job_queue_idx',
+                condition=models.Q(status__in=['pending', 'running'])),
+        ]
+
+    STATUSES = Choices(
+        ('pending', 'pending', '等待执行'),
+        ('running', 'running', '正在执行'),
+        ('success', 'success', '导出成功'),
+        ('failed', 'failed', '导出失败'),
+    )
+    FORMATS = Choices(
+        ('xlsx', 'xlsx', 'Excel'),
+        ('csv', 'csv', 'CSV'),
+    )
+
+    # 发起导出的用户，只有该用户可以查看任务状态
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, null=True, related_name='+')
+    # Exporter 类的路径，例如 'natureself.admin.views.AdminViewExporter'
+    exporter = models.TextField()
+    # 创建 Exporter 的参数
+    params = jsonfield.JSONField(default=dict)
+    format = models.TextField(choices=FORMATS, default=FORMATS.xlsx)
+
+    status = models.TextField(choices=STATUSES, default=STATUSES.pending)
+    # 总行数（开始执行后才知道），以及已经写入的行数
+    total = models.IntegerField(null=True)
+    processed = models.IntegerField(default=0)
+    # 执行的次数，worker 在执行过程中退出时，任务会被重新执行
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+
+    # 导出的文件，file_path 为相对于 EXPORT_ROOT 的路径
+    file_path = models.TextField(blank=True, default='')
+    filename = models.TextField(blank=True, default='')
+    content_type = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    # 执行过程中每写入一批数据更新一次，worker 根据该字段判断正在执行的任务是否已经中断
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True)
+
+    @property
+    def progress(self):
+        """
+        导出进度，0 ~ 100
+        """
+        if self.status == self.STATUSES.success:
+            return 100
+        if not self.total:
+            return 0
+        return min(int(self.processed * 100 / self.total), 99)
+
+    # 与 media 文件相同的属性，用于 natureself.django.media.views.download.send_file()
+    md5sum = None
+
+    @property
+    def local_abs_path(self):
+        return os.path.join(EXPORT_ROOT, self.file_path) if self.file_path else None
+
+    def download_url(self, request=None, absolute_uri=False):
+        if self.status != self.STATUSES.success or not self.file_path:
+            return None
+        url = reverse('export-job-download', kwargs=dict(id=self.id))
+        return url if (not request or not absolute_uri) else request.build_absolute_uri(url)
+
+    def delete_file(self):
+        if self.file_path:
+            try:
+                os.unlink(self.local_abs_path)
+            except FileNotFoundError:
+                pass
+
+    def serialize(self, to_dict=True, request=None):
+        data = dict(
+                id = self.id,
+                format = self.format,
+                status = self.status,
+                total = self.total,
+                processed = self.processed,
+                progress = self.progress,
+                last_error = self.last_error,
+                filename = self.filename or None,
+                download_url = self.download_url(request),
+                created_at = serialize_datetime(self.created_at),
+                finished_at = serialize_datetime(self.finished_at),
+                )
+
+        return data if to_dict else json.dumps(data, ensure_ascii=False)
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('api/admin/export/jobs/<int:id>', views.api_get_job, name='export-job'),
+    path('api/admin/export/jobs/<int:id>/download', views.api_download_job, name='export-job-download'),
+]
@@ -0,0 +1,51 @@
+from django.utils.cache import add_never_cache_headers
+from django.views.decorators.http import require_http_methods
+
+from natureself.django.core import api
+from natureself.django.account.decorators import role_required
+from natureself.django.account.utils import get_user_roles
+from natureself.django.media.views.download import send_file
+
+from .models import ExportJob
+
+def get_job(request, id):
+    """
+    只能访问自己创建的任务，超级管理员可以访问所有任务，没有权限时与任务不存在相同，返回 None
+    """
+    queryset = ExportJob.objects.all()
+    if 'superuser' not in get_user_roles(request.user):
+        queryset = queryset.filter(owner=request.user)
+    return queryset.filter(id=id).first()
+
+"""
+查询导出任务的状态，只能查询自己创建的任务（超级管理员可以查询所有任务）
+
+GET /api/admin/export/jobs/<int:id>
+
+返回 ExportJob.serialize()，前端轮询该接口，status 为 success 时通过 download_url 下载文件
+"""
+@require_http_methods(['GET'])
+@role_required(['admin'])
+def api_get_job(request, id):
+    job = get_job(request, id)
+    if not job:
+        return api.not_found()
+    return api.ok(data=job.serialize(request=request))
+
+"""
+下载导出的文件，权限与查询任务相同
+
+GET /api/admin/export/jobs/<int:id>/download
+
+文件保存在不公开的目录中（见 models.EXPORT_ROOT），检查权限后由 nginx（X-Accel-Redirect）或者 Django 发送
+"""
+@require_http_methods(['GET'])
+@role_required(['admin'])
+def api_download_job(request, id):
+    job = get_job(request, id)
+    if not job or not job.download_url():
+        return api.not_found()
+    response = send_file(request, job)
+    # 导出的数据包含用户信息，不允许浏览器、代理缓存
+    add_never_cache_headers(response)
+    return response
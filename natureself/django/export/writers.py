@@ -0,0 +1,82 @@
+"""
+流式写入表格（csv、xlsx）
+
+导出数据时，我们不把所有数据读入内存，而是一边从数据库中按批读取（queryset.iterator()），一边写入：
+
+* csv：每一行编码后直接输出，可以作为 StreamingHttpResponse 的内容，第一行数据查询出来后浏览器就开始下载
+* xlsx：使用 xlsxwriter 的 constant_memory 模式，每写完一行就把该行写入临时文件，内存占用与行数无关。
+  xlsx 是 zip 文件，只有全部数据写完后才能生成，因此无法边生成边下载，大量数据请使用异步导出（见 jobs.py）
+
+columns 为 [(标题, 列宽)]，列宽为 None 时使用默认宽度（只对 xlsx 有效）。
+"""
+import csv
+import xlsxwriter
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# csv 每次输出的大小（字符数）
+BUFFER_SIZE = 64 * 1024
+
+def get_content_type(format):
+    return FORMATS[format]
+
+class Echo:
+    """
+    csv.writer 需要一个 file-like 对象，这里直接返回写入的内容，
+    见 https://docs.djangoproject.com/en/2.2/howto/outputting-csv/#streaming-large-csv-files
+    """
+    def write(self, value):
+        return value
+
+def iter_csv(columns, rows, buffer_size=BUFFER_SIZE):
+    """
+    返回 bytes 的迭代器，每次返回大约 buffer_size 字节（逐行返回时，每一行都是一次 socket 写入）。
+    文件以 BOM 开头，否则 Excel 打开时中文会乱码
+    """
+    writer = csv.writer(Echo())
+    # 表头立即返回，浏览器可以马上开始下载
+    yield ('\ufeff' + writer.writerow([title for title, width in columns])).encode()
+    buffer, size = [], 0
+    for row in rows:
+        line = writer.writerow(['' if value is None else value for value in row])
+        buffer.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield ''.join(buffer).encode()
+            buffer, size = [], 0
+    yield ''.join(buffer).encode()
+
+def write_csv(fp, columns, rows):
+    """
+    写入 fp（以二进制方式打开的文件）
+    """
+    for chunk in iter_csv(columns, rows):
+        fp.write(chunk)
+
+def write_xlsx(fp, columns, rows):
+    """
+    写入 fp（文件路径，或者以二进制方式打开的文件）
+    """
+    workbook = xlsxwriter.Workbook(fp, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet()
+        for col, (title, width) in enumerate(columns):
+            if width:
+                worksheet.set_column(col, col, width=width)
+            worksheet.write(0, col, title)
+        # constant_memory 模式下必须按行的顺序写入
+        for row, values in enumerate(rows, start=1):
+            worksheet.write_row(row, 0, values)
+    finally:
+        workbook.close()
+
+def write(fp, format, columns, rows):
+    if format == 'csv':
+        write_csv(fp, columns, rows)
+    elif format == 'xlsx':
+        write_xlsx(fp, columns, rows)
+    else:
+        raise ValueError(f'unknown format: {format}')
@@ -0,0 +1,217 @@
+"""
+按内容保存文件（去重）
+
+管理员经常重复上传相同的图片、PPT、PDF，如果每次上传都保存一份，磁盘占用会不断增长。
+
+因此文件内容按 sha256 保存在 blob 目录中（{NS_MEDIA_BLOB_ROOT}/{sha256[:2]}/{sha256}，默认为 MEDIA_ROOT/blobs），
+每个文件（Image、Document、Slide 等 AbstractFile 的子类）原来的路径（local_abs_path）是 blob 文件的硬链接，
+这样文件的访问地址、nginx 的配置都不需要改变，而相同内容的文件在磁盘上只占用一份空间。
+
+上传文件时（store()），内容只写入一次：写入临时文件的同时计算 hash，如果 blob 已经存在，直接链接已有的 blob，
+删除临时文件；否则把临时文件移动到目标路径，再链接到 blob 目录。
+如果文件系统不支持硬链接，会退化为复制文件（不能去重，但是行为正确）。
+
+注意：硬链接共享同一份内容，不要原地修改 local_abs_path 指向的文件。
+
+相关的管理命令：
+* `manage.py dedup_media_files`：迁移已有的文件（blob 为 NULL 的文件），相同内容的文件会被替换为同一个 blob 的硬链接
+* `manage.py gc_media_files`：回收已经软删除（deleted_at）、且没有被其他数据引用的文件，
+  然后删除没有被任何文件引用（引用计数为 0）的 blob
+"""
+from django.apps import apps
+from django.conf import settings
+from django.db.models import ProtectedError
+from django.utils import timezone
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+BLOB_ROOT = getattr(settings, 'NS_MEDIA_BLOB_ROOT', os.path.join(settings.MEDIA_ROOT, 'blobs'))
+CHUNK_SIZE = 64 * 1024
+
+# os.umask() 只能在设置的同时读取，在导入时读取一次，避免多线程中临时修改 umask
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def get_blob_path(sha256):
+    return os.path.join(BLOB_ROOT, sha256[:2], sha256)
+
+def get_file_mode():
+    """
+    新文件的权限：与 FileSystemStorage 相同，优先使用 FILE_UPLOAD_PERMISSIONS，否则为 0o666 & ~umask。
+    mkstemp 创建的临时文件权限为 0600，重命名为最终文件前需要修改，否则 nginx 等其他用户无法读取
+    """
+    if settings.FILE_UPLOAD_PERMISSIONS is not None:
+        return settings.FILE_UPLOAD_PERMISSIONS
+    return 0o666 & ~UMASK
+
+def makedirs(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+def link(src, dst):
+    """
+    创建硬链接，文件系统不支持硬链接（或者跨文件系统）时复制文件
+    """
+    try:
+        os.link(src, dst)
+    except (FileNotFoundError, FileExistsError):
+        raise
+    except OSError as e:
+        logger.warning(f'Can not create hard link {dst} -> {src}, copying file: {e}')
+        shutil.copyfile(src, dst)
+
+def get_or_create_blob(sha256, md5sum, size):
+    Blob = apps.get_model('media', 'Blob')
+    blob, created = Blob.objects.get_or_create(sha256=sha256, defaults=dict(md5sum=md5sum, size=size))
+    return blob
+
+def hash_file(path):
+    """
+    返回 (sha256, md5, size)
+    """
+    sha256, md5, size = hashlib.sha256(), hashlib.md5(), 0
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), md5.hexdigest(), size
+
+def store(chunks, path):
+    """
+    将 chunks（bytes 的迭代器）保存到 path（path 不能已经存在），返回对应的 Blob
+    """
+    makedirs(path)
+    os.makedirs(BLOB_ROOT, exist_ok=True)
+
+    sha256, md5, size = hashlib.sha256(), hashlib.md5(), 0
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_ROOT, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            os.fchmod(fp.fileno(), get_file_mode())
+            for chunk in chunks:
+                sha256.update(chunk)
+                md5.update(chunk)
+                size += len(chunk)
+                fp.write(chunk)
+
+        blob_path = get_blob_path(sha256.hexdigest())
+        try:
+            # 已经有相同内容的文件
+            link(blob_path, path)
+        except FileNotFoundError:
+            shutil.move(tmp_path, path)
+            makedirs(blob_path)
+            try:
+                link(path, blob_path)
+            except FileExistsError:
+                # 并发上传了相同内容的文件，以先创建的 blob 为准即可，两者内容相同
+                pass
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    return get_or_create_blob(sha256.hexdigest(), md5.hexdigest(), size)
+
+def get_file_models():
+    from .models import AbstractFile
+    return [model for model in apps.get_models() if issubclass(model, AbstractFile)]
+
+def adopt(file, dry_run=False):
+    """
+    为已有的文件（blob 为 NULL）设置 blob，如果已经有相同内容的 blob，将文件替换为 blob 的硬链接。
+    返回回收的磁盘空间（字节），文件不存在时返回 None
+    """
+    path = file.local_abs_path
+    if not os.path.isfile(path):
+        logger.warning(f'File not found: {path} ({file.__class__.__name__} id={file.id})')
+        return None
+
+    sha256, md5, size = hash_file(path)
+    blob_path = get_blob_path(sha256)
+    stat = os.stat(path)
+    reclaimed = 0
+
+    if os.path.exists(blob_path):
+        if not os.path.samefile(path, blob_path):
+            # 一个文件只有一个链接时，替换后原来的内容才会被删除
+            reclaimed = stat.st_size if stat.st_nlink == 1 else 0
+            if not dry_run:
+                tmp_path = f'{path}.dedup'
+                link(blob_path, tmp_path)
+                os.replace(tmp_path, path)
+    elif not dry_run:
+        makedirs(blob_path)
+        link(path, blob_path)
+
+    if not dry_run:
+        blob = get_or_create_blob(sha256, md5, size)
+        type(file).objects.filter(pk=file.pk).update(blob=blob)
+    return reclaimed
+
+def is_referenced(file):
+    """
+    文件是否被其他数据引用（例如 Presentation.thumbnail），包括 related_name='+' 的引用
+    """
+    for field in file._meta.get_fields(include_hidden=True):
+        if field.auto_created and not field.concrete and field.is_relation:
+            if field.related_model._base_manager.filter(**{field.field.name: file}).exists():
+                return True
+    return False
+
+def collect_files(min_age, dry_run=False):
+    """
+    回收软删除时间超过 min_age（timedelta）、且没有被引用的文件：删除 local_abs_path，并将 blob 设置为 NULL。
+    返回回收的文件数量
+    """
+    deleted_before = timezone.now() - min_age
+    count = 0
+    for model in get_file_models():
+        queryset = model.objects.filter(deleted_at__lt=deleted_before, blob__isnull=False)
+        for file in queryset.iterator():
+            if is_referenced(file):
+                continue
+            count += 1
+            if dry_run:
+                continue
+            try:
+                os.unlink(file.local_abs_path)
+            except FileNotFoundError:
+                pass
+            if hasattr(file, 'delete_renditions'):
+                file.delete_renditions()
+            model.objects.filter(pk=file.pk).update(blob=None)
+    return count
+
+def get_unreferenced_blobs():
+    Blob = apps.get_model('media', 'Blob')
+    queryset = Blob.objects.all()
+    for model in get_file_models():
+        queryset = queryset.exclude(id__in=model.objects.filter(blob__isnull=False).values('blob_id'))
+    return queryset
+
+def collect_blobs(min_age, dry_run=False):
+    """
+    删除引用计数为 0、且创建时间超过 min_age 的 blob（刚上传的文件可能还没有保存到数据库中）。
+    返回 (删除的数量, 回收的磁盘空间)
+    """
+    count, reclaimed = 0, 0
+    for blob in get_unreferenced_blobs().filter(created_at__lt=timezone.now() - min_age).iterator():
+        if not dry_run:
+            try:
+                blob.delete()
+            except ProtectedError:
+                # 检查之后又有新的文件引用了该 blob
+                continue
+            try:
+                os.unlink(blob.local_abs_path)
+            except FileNotFoundError:
+                pass
+        count += 1
+        reclaimed += blob.size
+    return count, reclaimed
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from natureself.django.media import blobs
+
+class Command(BaseCommand):
+    help = '将已有的文件迁移到 blob 存储，相同内容的文件替换为同一个 blob 的硬链接（见 natureself.django.media.blobs）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不修改文件和数据库')
+
+    def handle(self, *args, **options):
+        total_files, total_missing, total_reclaimed = 0, 0, 0
+        for model in blobs.get_file_models():
+            files, missing, reclaimed = 0, 0, 0
+            for file in model.objects.filter(blob__isnull=True, deleted_at__isnull=True).iterator():
+                result = blobs.adopt(file, dry_run=options['dry_run'])
+                if result is None:
+                    missing += 1
+                else:
+                    files += 1
+                    reclaimed += result
+            self.stdout.write(f'{model._meta.label}: {files} file(s), {missing} missing, {reclaimed} bytes reclaimed')
+            total_files += files
+            total_missing += missing
+            total_reclaimed += reclaimed
+        self.stdout.write(f'total: {total_files} file(s), {total_missing} missing, {total_reclaimed} bytes reclaimed')
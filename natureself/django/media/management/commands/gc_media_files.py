@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+import datetime
+
+from natureself.django.media import blobs
+
+class Command(BaseCommand):
+    help = '回收软删除、且没有被引用的文件，然后删除引用计数为 0 的 blob（见 natureself.django.media.blobs）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=30,
+                help='只回收软删除超过指定天数的文件、创建超过指定天数的 blob，默认为 30 天')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不删除文件')
+
+    def handle(self, *args, **options):
+        min_age = datetime.timedelta(days=options['min_age'])
+        files = blobs.collect_files(min_age, dry_run=options['dry_run'])
+        count, reclaimed = blobs.collect_blobs(min_age, dry_run=options['dry_run'])
+        self.stdout.write(f'{files} deleted file(s) collected, {count} blob(s) removed, {reclaimed} bytes reclaimed')
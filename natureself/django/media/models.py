@@ -12,10 +12,14 @@ import os
 import json
 import uuid
 import magic
-import pathlib
-import hashlib
 from model_utils import Choices
 
+from . import blobs
+from . import renditions
+from . import watchtime
+from . import watchrecords
+from .signals import presentation_watched
+
 class FileManager(models.Manager):
     def create(self, bucket, file, **kwargs):
         """
@@ -47,24 +51,39 @@ class FileManager(models.Manager):
         kwargs['local_path'] = self.model.gen_local_path(**kwargs)
 
         local_abs_path = os.path.join(settings.MEDIA_ROOT, self.model.STORAGE_ROOT, kwargs['bucket'], kwargs['local_path'])
-        local_abs_dir = os.path.dirname(local_abs_path)
-        if not os.path.isdir(local_abs_dir):
-            pathlib.Path(local_abs_dir).mkdir(parents=True, exist_ok=True)
 
-        md5 = hashlib.md5()
+        # 文件内容只写入一次（写入临时文件的同时计算 hash），然后以硬链接的方式放到 local_abs_path，
+        # 相同内容的文件在磁盘上只保存一份，见 natureself.django.media.blobs
         if isinstance(file, UploadedFile):
-            with open(local_abs_path, 'wb+') as out_fp:
-                for chunk in file.chunks():
-                    md5.update(chunk)
-                    out_fp.write(chunk)
+            kwargs['blob'] = blobs.store(file.chunks(), local_abs_path)
         elif isinstance(file, str):
-            with open(local_abs_path, 'wb+') as out_fp, open(file, 'rb') as in_fp:
-                for chunk in iter(lambda: in_fp.read(4096), b''):
-                    md5.update(chunk)
-                    out_fp.write(chunk)
-        kwargs['md5sum'] = md5.hexdigest()
+            with open(file, 'rb') as in_fp:
+                kwargs['blob'] = blobs.store(iter(lambda: in_fp.read(blobs.CHUNK_SIZE), b''), local_abs_path)
+        kwargs['md5sum'] = kwargs['blob'].md5sum
+
+        file = super().create(**kwargs)
+        if isinstance(file, ImageRenditionMixin) and renditions.EAGER:
+            renditions.generate_async(file.local_abs_path)
+
+        return file
+
+class Blob(models.Model):
+    """
+    按内容（sha256）保存的文件，相同内容的文件只保存一份，见 natureself.django.media.blobs
+
+    引用计数即引用该 blob 的文件（Image、Document 等）的数量，没有引用的 blob 会被 `manage.py gc_media_files` 删除
+    """
+    sha256 = models.TextField(unique=True)
+    md5sum = models.TextField()
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def local_abs_path(self):
+        return blobs.get_blob_path(self.sha256)
 
-        return super().create(**kwargs)
+    def __str__(self):
+        return self.sha256
 
 class AbstractFile(models.Model):
     class Meta:
@@ -111,6 +130,10 @@ class AbstractFile(models.Model):
     # 文件内容的 md5
     md5sum = models.TextField()
 
+    # 文件内容，local_abs_path 是 blob 文件的硬链接。
+    # 旧的文件（dedup_media_files 迁移之前）、以及已经被回收的文件（gc_media_files），blob 为 NULL
+    blob = models.ForeignKey('media.Blob', models.PROTECT, null=True, related_name='+')
+
     # bucket 可以理解为一个子目录，一般来说我们鼓励按照用途来归类文件，每一种用途为一个 bucket，
     # 在将来，我们可能会按照不同的 bucket 来使用不同的存储后端
     bucket = models.TextField()
@@ -132,6 +155,14 @@ class AbstractFile(models.Model):
     def download_url(self, request=None, absolute_uri=False):
         return None
 
+    def can_download(self, request):
+        """
+        是否允许通过 download_url()（/download/...）下载，返回 False 时返回 403，需要限制时在子类中覆盖（可以根据 bucket 判断）。
+        注意文件同时可以通过 url()（/media/...）直接访问，真正不能公开的文件不要保存为 media 文件，
+        见 natureself.django.media.views.download
+        """
+        return True
+
     @property
     def local_abs_path(self):
         return os.path.join(settings.MEDIA_ROOT, self.STORAGE_ROOT, self.bucket, self.local_path)
@@ -157,7 +188,27 @@ class AbstractFile(models.Model):
 
         return data if to_dict else json.dumps(data, ensure_ascii=False)
 
-class Image(AbstractFile):
+class ImageRenditionMixin:
+    """
+    为图片提供缩略图（rendition），见 natureself.django.media.renditions
+    """
+    def rendition_url(self, name, request=None, absolute_uri=False):
+        url = renditions.get_rendition_path(self.url(), name)
+        return url if (not request or not absolute_uri) else request.build_absolute_uri(url)
+
+    def generate_rendition(self, name):
+        return renditions.generate(self.local_abs_path, name)
+
+    def delete_renditions(self):
+        renditions.delete_all(self.local_abs_path)
+
+    def serialize(self, to_dict=True, request=None, absolute_uri=False, **kwargs):
+        data = super().serialize(to_dict=True, request=request, absolute_uri=absolute_uri, **kwargs)
+        data['renditions'] = {name: self.rendition_url(name, request, absolute_uri) for name in renditions.RENDITIONS}
+
+        return data if to_dict else json.dumps(data, ensure_ascii=False)
+
+class Image(ImageRenditionMixin, AbstractFile):
     STORAGE_ROOT = 'images'
 
     def download_url(self, request=None, absolute_uri=False):
@@ -192,11 +243,25 @@ class PolyvVideo(models.Model):
     watched_users = models.ManyToManyField(get_user_model(), through='PolyvVideoWatchRecord', related_name='+')
 
     def mark_watched(self, user):
-        if user:
-            PolyvVideoWatchRecord.objects.get_or_create(user=user, video=self)
+        if user and user.is_authenticated:
+            watchrecords.videos.mark_watched(user, self)
 
     def get_watched(self, user):
-        return user and self.watched_users.filter(pk=user.pk).exists()
+        return self.id in watchrecords.videos.get_watched(user, [self])
+
+    @classmethod
+    def bulk_mark_watched(cls, pairs):
+        """
+        pairs: [(user, video)]
+        """
+        watchrecords.videos.bulk_mark_watched(pairs)
+
+    @classmethod
+    def fetch_watched(cls, items, user):
+        """
+        为列表中的每一个视频设置 watched 属性，一次查询
+        """
+        return watchrecords.videos.fetch_watched(user, items)
 
     def serialize(self, to_dict=True):
         data = dict(
@@ -248,11 +313,25 @@ class PolyvLive(models.Model):
     watched_users = models.ManyToManyField(get_user_model(), through='PolyvLiveWatchRecord', related_name='+')
 
     def mark_watched(self, user):
-        if user:
-            PolyvLiveWatchRecord.objects.get_or_create(user=user, live=self)
+        if user and user.is_authenticated:
+            watchrecords.lives.mark_watched(user, self)
 
     def get_watched(self, user):
-        return user and self.watched_users.filter(pk=user.pk).exists()
+        return self.id in watchrecords.lives.get_watched(user, [self])
+
+    @classmethod
+    def bulk_mark_watched(cls, pairs):
+        """
+        pairs: [(user, live)]
+        """
+        watchrecords.lives.bulk_mark_watched(pairs)
+
+    @classmethod
+    def fetch_watched(cls, items, user):
+        """
+        为列表中的每一个直播设置 watched 属性，一次查询
+        """
+        return watchrecords.lives.fetch_watched(user, items)
 
     def serialize(self, to_dict=True):
         data = dict(
@@ -297,34 +376,49 @@ class Presentation(models.Model):
         if not user or not user.is_authenticated:
             return None
 
-        record = self.get_watch_record(user)
-        if record:
-            record.watched = True
-            record.save()
-        else:
-            record = PresentationWatchRecord.objects.create(user=user, presentation=self, watched=True)
+        record = watchrecords.presentations.mark_watched(user, self)
+        watchtime.set_watched(user.id, self.id)
+        presentation_watched.send(sender=Presentation, presentation=self, user=user, record=record)
         return record
 
-    def add_watch_time(self, user, seconds):
+    @classmethod
+    def bulk_mark_watched(cls, pairs):
+        """
+        pairs: [(user, presentation)]，批量标记为已观看，每个 PPT 仍然会触发 presentation_watched 信号
+        """
+        pairs = [(user, presentation) for user, presentation in pairs if user and user.is_authenticated]
+        records = {(record.user_id, record.presentation_id): record
+                for record in watchrecords.presentations.bulk_mark_watched(pairs)}
+        for user, presentation in pairs:
+            watchtime.set_watched(user.id, presentation.id)
+            presentation_watched.send(sender=Presentation, presentation=presentation, user=user,
+                    record=records[(user.id, presentation.id)])
+        return list(records.values())
+
+    @classmethod
+    def fetch_watched(cls, items, user):
+        """
+        为列表中的每一个 PPT 设置 watched 属性，一次查询
+        """
+        return watchrecords.presentations.fetch_watched(user, items)
+
+    def add_watch_time(self, user, seconds, flush=False):
+        """
+        累加观看时长。观看时长会在进程内合并后批量写入数据库（见 natureself.django.media.watchtime），
+        flush 为 True 时立即写入。
+
+        返回的 PresentationWatchRecord 只包含 watched_seconds（包括尚未写入的时长）与 watched，没有 id，不要保存
+        """
         if not user or not user.is_authenticated:
             return None
-        record = self.get_watch_record(user)
-        if record:
-            record.watched_seconds = models.F('watched_seconds') + seconds
-            record.save()
-            record.refresh_from_db()
-        else:
-            record = PresentationWatchRecord.objects.create(user=user, presentation=self, watched_seconds=seconds)
-        return record
+        watched_seconds, watched = watchtime.add(user.id, self.id, seconds, flush=flush)
+        return PresentationWatchRecord(user=user, presentation=self, watched_seconds=watched_seconds, watched=watched)
 
     def get_watch_record(self, user):
         return self.watch_records.filter(user=user).first()
 
     def get_watched(self, user):
-        if not user:
-            return False
-        record = self.watch_records.filter(user=user).first()
-        return record and record.watched
+        return self.id in watchrecords.presentations.get_watched(user, [self])
 
     def serialize(self, to_dict=True):
         data = dict(
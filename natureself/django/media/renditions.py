@@ -0,0 +1,162 @@
+"""
+图片缩略图（rendition）
+
+原图往往是几 MB 的照片，列表页中只需要几百像素宽的缩略图。我们为图片定义若干命名的 rendition（宽度、格式、质量），
+rendition 保存在原图旁边：
+
+    原图:       {MEDIA_ROOT}/images/thumbnails/fa/fa32dc55ce704e339ca6616c6e2e63d8.png
+    rendition:  {MEDIA_ROOT}/images/thumbnails/fa/fa32dc55ce704e339ca6616c6e2e63d8.thumbnail.jpg
+
+rendition 的访问地址与原图类似（MEDIA_URL 下），生成方式：
+* 懒生成：nginx 找不到 /media/ 下的文件时，交给 Django（见 nginx.conf 与 views/rendition.py），Django 生成后返回，
+  之后的请求由 nginx 直接返回
+* 预生成：上传图片后，在后台线程池中生成所有 rendition（NS_MEDIA_IMAGE_RENDITIONS_EAGER，默认开启）
+
+宽度小于 rendition 宽度的图片不会被放大，只转换格式。无法识别的图片（例如 svg）没有 rendition，访问时重定向到原图。
+
+使用方式：
+* 模板中：{% load media %}{% rendition image 'thumbnail' %} 输出地址，
+  或者 {% picture image 'thumbnail' class='img-fluid' %} 输出 <picture>（支持 webp 的浏览器使用 thumbnail-webp）
+* Image.serialize() 返回的 renditions 字段：{name: url}
+
+相关配置：
+
+    NS_MEDIA_IMAGE_RENDITIONS = {...}         # 见 DEFAULT_RENDITIONS
+    NS_MEDIA_IMAGE_RENDITIONS_EAGER = True    # 上传后是否在后台生成所有 rendition
+    NS_MEDIA_IMAGE_RENDITIONS_WORKERS = 2     # 后台生成 rendition 的线程数
+"""
+from django.conf import settings
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import threading
+
+from PIL import Image as PILImage, ImageOps
+
+from .blobs import get_file_mode
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_RENDITIONS = {
+    'thumbnail': dict(width=300, format='jpeg', quality=80),
+    'thumbnail-webp': dict(width=300, format='webp', quality=75),
+    'medium': dict(width=800, format='jpeg', quality=80),
+    'medium-webp': dict(width=800, format='webp', quality=75),
+}
+
+RENDITIONS = getattr(settings, 'NS_MEDIA_IMAGE_RENDITIONS', DEFAULT_RENDITIONS)
+EAGER = getattr(settings, 'NS_MEDIA_IMAGE_RENDITIONS_EAGER', True)
+WORKERS = getattr(settings, 'NS_MEDIA_IMAGE_RENDITIONS_WORKERS', 2)
+
+EXTENSIONS = {
+    'jpeg': 'jpg',
+    'webp': 'webp',
+    'png': 'png',
+}
+
+CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+
+def get_extension(name):
+    return EXTENSIONS[RENDITIONS[name]['format']]
+
+def get_content_type(name):
+    return CONTENT_TYPES[RENDITIONS[name]['format']]
+
+def get_rendition_path(path, name):
+    """
+    path 可以是文件路径，也可以是 URL
+    """
+    base, ext = os.path.splitext(path)
+    return f'{base}.{name}.{get_extension(name)}'
+
+def render(source, dest, width, format, quality=None):
+    with PILImage.open(source) as image:
+        # 对于 jpeg，解码时直接缩小（draft），比解码完整的图片再缩小快很多。
+        # 照片可能是旋转的（exif），因此要求宽、高都不小于目标宽度
+        image.draft('RGB', (width, width))
+        image = ImageOps.exif_transpose(image)
+
+        if image.width > width:
+            height = max(round(image.height * width / image.width), 1)
+            image = image.resize((width, height), PILImage.LANCZOS)
+
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        if format == 'jpeg':
+            if has_alpha:
+                # jpeg 不支持透明，使用白色背景
+                image = image.convert('RGBA')
+                background = PILImage.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        options = dict(optimize=True)
+        if quality:
+            options['quality'] = quality
+        if format == 'jpeg':
+            options['progressive'] = True
+        image.save(dest, format=format.upper(), **options)
+
+def generate(source, name):
+    """
+    生成 source 的 rendition，返回 rendition 的路径。已经生成、并且比原图新时直接返回。
+    原图不是可以识别的图片时返回 None
+    """
+    dest = get_rendition_path(source, name)
+    try:
+        if os.path.getmtime(dest) >= os.path.getmtime(source):
+            return dest
+    except FileNotFoundError:
+        pass
+
+    spec = RENDITIONS[name]
+    # 先写入临时文件再重命名，并发生成同一个 rendition 时，不会读到不完整的文件
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.rendition-')
+    # mkstemp 创建的文件权限为 0600，PIL 写入时不会修改，需要在重命名前修改
+    os.fchmod(fd, get_file_mode())
+    os.close(fd)
+    try:
+        render(source, tmp_path, spec['width'], spec['format'], spec.get('quality'))
+        os.replace(tmp_path, dest)
+    except (OSError, ValueError, PILImage.DecompressionBombError) as e:
+        # PIL 无法识别的图片（例如 svg）会抛出 OSError（UnidentifiedImageError）
+        logger.warning(f'Can not generate rendition {name} for {source}: {e}')
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return dest
+
+def generate_all(source):
+    for name in RENDITIONS:
+        generate(source, name)
+
+def delete_all(source):
+    for name in RENDITIONS:
+        try:
+            os.unlink(get_rendition_path(source, name))
+        except FileNotFoundError:
+            pass
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def generate_async(source):
+    """
+    在后台线程池中生成所有 rendition。进程退出时没有完成的 rendition 会在第一次访问时生成
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='rendition')
+    return _executor.submit(generate_all, source)
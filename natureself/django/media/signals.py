@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# 用户看完 PPT 时（Presentation.mark_watched）触发，sender 为 Presentation 类，参数：
+# * presentation: Presentation
+# * user: 用户
+# * record: PresentationWatchRecord
+presentation_watched = Signal(providing_args=['presentation', 'user', 'record'])
@@ -0,0 +1,38 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from natureself.django.media import renditions
+
+register = template.Library()
+
+@register.simple_tag
+def rendition(image, name):
+    """
+    输出图片 rendition 的地址，例如 {% rendition news.cover_picture 'thumbnail' %}
+
+    image 为空时输出空字符串，image 不支持 rendition（例如 Document）时输出原图地址。
+    """
+    if not image:
+        return ''
+    if not hasattr(image, 'rendition_url'):
+        return image.url()
+    return image.rendition_url(name)
+
+@register.simple_tag
+def picture(image, name, **attrs):
+    """
+    输出 <picture> 标签，如果存在 {name}-webp 的 rendition，支持 webp 的浏览器会使用 webp 格式，例如：
+
+        {% picture news.cover_picture 'thumbnail' class='img-fluid w-100' %}
+
+    其他参数会作为 <img> 标签的属性
+    """
+    if not image:
+        return ''
+
+    attrs_html = format_html_join('', ' {}="{}"', attrs.items())
+    webp = f'{name}-webp'
+    if hasattr(image, 'rendition_url') and webp in renditions.RENDITIONS:
+        return format_html('<picture><source type="image/webp" srcset="{}"><img src="{}"{}></picture>',
+                image.rendition_url(webp), image.rendition_url(name), attrs_html)
+    return format_html('<img src="{}"{}>', rendition(image, name), attrs_html)
@@ -1,7 +1,8 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path, re_path, include
 from django.views.generic import TemplateView
 
-from .views import admin, download, polyv
+from .views import admin, download, polyv, rendition
 
 urlpatterns = [
     path('api/admin/media/', include([
@@ -25,4 +26,8 @@ urlpatterns = [
         kwargs=dict(model='document')),
     path('download/slides/<str:key>', download.download_file, name='download-slide',
         kwargs=dict(model='slide')),
+
+    # 图片的 rendition，只有文件不存在时 nginx 才会交给 Django
+    re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)\.(?P<name>[\w-]+)\.(?P<ext>\w+)$', rendition.serve_rendition,
+        name='image-rendition'),
 ]
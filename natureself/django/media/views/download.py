@@ -1,8 +1,15 @@
-from django.http import FileResponse
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
 
 from natureself.django.core import api
 from natureself.django.media.models import Image, Document, Slide
 
+import os
+import re
+from urllib.parse import quote
+
 """
 下载文件
 
@@ -10,7 +17,30 @@ GET /download/documents/<str:key>
 
 会设置 Content-Dispositon 头，因此浏览器会弹出下载另存为对话框。
 另存为对话框中，默认的文件名为此前设置的 filename。
+
+下载前会调用文件的 can_download(request)，返回 False 时返回 403。注意 media 文件保存在 MEDIA_ROOT 下，
+同时可以通过 /media/ 直接访问，can_download() 只能限制 /download/ 的访问。不能公开的文件（例如导出的数据）
+应该保存在 settings.NS_PRIVATE_MEDIA_ROOT 中（nginx 不直接提供访问），检查权限后调用 send_file() 发送，
+见 natureself.django.export.views。
+
+如果配置了 nginx 的 internal location，Django 只负责查找文件、检查权限，然后通过 X-Accel-Redirect 头
+让 nginx 发送文件内容，这样下载大文件时不会占用 gunicorn worker，Range（断点续传）、缓存校验也由 nginx 处理：
+* settings.NS_MEDIA_ACCEL_REDIRECT_PREFIX（例如 '/_media/'）：指向 MEDIA_ROOT
+* settings.NS_PRIVATE_MEDIA_ACCEL_REDIRECT_PREFIX（例如 '/_protected_media/'）：指向 NS_PRIVATE_MEDIA_ROOT
+nginx 中的配置见 nginx.conf。
+
+没有配置时（例如本地开发时没有 nginx），由 Django 发送文件，支持：
+* ETag（文件的 md5sum）、Last-Modified，以及 If-None-Match、If-Modified-Since（返回 304）
+* Range 请求（只支持单个范围，返回 206），以及 If-Range
 """
+
+ACCEL_REDIRECT_PREFIX = getattr(settings, 'NS_MEDIA_ACCEL_REDIRECT_PREFIX', None)
+PRIVATE_ROOT = getattr(settings, 'NS_PRIVATE_MEDIA_ROOT', None)
+PRIVATE_ACCEL_REDIRECT_PREFIX = getattr(settings, 'NS_PRIVATE_MEDIA_ACCEL_REDIRECT_PREFIX', None)
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
 def download_file(request, key, model):
     if model == 'image':
         Model = Image
@@ -27,7 +57,144 @@ def download_file(request, key, model):
         # TODO should return 404 webpage instead of json
         return api.not_found()
 
-    # as django document claimed, we don't need to open the file with a context manager,
-    # FileResponse will close it automatically.
-    # see: https://docs.djangoproject.com/en/2.2/ref/request-response/#fileresponse-objects
-    return FileResponse(open(file.local_abs_path, 'rb'), as_attachment=True, filename=file.filename)
+    if not file.can_download(request):
+        return api.forbidden()
+
+    return send_file(request, file)
+
+def send_file(request, file):
+    """
+    发送文件，file 需要有 local_abs_path、filename、content_type、md5sum（可以为 None）属性，
+    调用前需要检查权限
+    """
+    path = get_accel_redirect_path(file.local_abs_path)
+    if path:
+        return accel_redirect_response(file, path)
+    return file_response(request, file)
+
+def get_accel_redirect_path(path):
+    """
+    返回文件在 nginx internal location 中的路径，文件所在的目录没有配置对应的 location 时返回 None
+    """
+    for root, prefix in ((PRIVATE_ROOT, PRIVATE_ACCEL_REDIRECT_PREFIX), (settings.MEDIA_ROOT, ACCEL_REDIRECT_PREFIX)):
+        if not root or not prefix:
+            continue
+        relpath = os.path.relpath(path, root)
+        if relpath != os.pardir and not relpath.startswith(os.pardir + os.sep):
+            return os.path.join(prefix, relpath)
+    return None
+
+def content_disposition(filename):
+    # 与 Django FileResponse(as_attachment=True) 生成的头相同
+    try:
+        filename.encode('ascii')
+        file_expr = 'filename="{}"'.format(filename)
+    except UnicodeEncodeError:
+        file_expr = "filename*=utf-8''{}".format(quote(filename))
+    return f'attachment; {file_expr}'
+
+def accel_redirect_response(file, path):
+    """
+    由 nginx 发送文件，Django 只返回响应头，path 见 get_accel_redirect_path()
+    """
+    response = HttpResponse(content_type=file.content_type)
+    response['Content-Disposition'] = content_disposition(file.filename)
+    response['X-Accel-Redirect'] = quote(path)
+    return response
+
+def parse_range(header, size):
+    """
+    解析 Range 头，返回 (start, end)（包含 end），无法满足时返回 None。
+    只支持单个范围，多个范围时抛出 ValueError，调用者应该忽略 Range 头，返回完整的文件。
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        raise ValueError(f'unsupported range: {header}')
+    start, end = match.groups()
+    if not start and not end:
+        raise ValueError(f'unsupported range: {header}')
+
+    if not start:
+        # bytes=-500 表示最后 500 个字节
+        length = int(end)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+def iter_file_range(fp, start, length):
+    try:
+        fp.seek(start)
+        while length > 0:
+            chunk = fp.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
+
+def file_response(request, file):
+    """
+    由 Django 发送文件，支持条件请求和 Range 请求
+    """
+    stat = os.stat(file.local_abs_path)
+    etag = f'"{file.md5sum}"' if file.md5sum else None
+    last_modified = int(stat.st_mtime)
+
+    # If-None-Match/If-Modified-Since 命中时返回 304
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    size = stat.st_size
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            byte_range = ()
+        if byte_range is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        # iter_file_range 在读取完成（或客户端断开连接）后会关闭文件
+        response = StreamingHttpResponse(
+                iter_file_range(open(file.local_abs_path, 'rb'), start, end - start + 1),
+                status = 206,
+                content_type = file.content_type,
+                )
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Disposition'] = content_disposition(file.filename)
+    else:
+        # as django document claimed, we don't need to open the file with a context manager,
+        # FileResponse will close it automatically.
+        # see: https://docs.djangoproject.com/en/2.2/ref/request-response/#fileresponse-objects
+        response = FileResponse(open(file.local_abs_path, 'rb'), as_attachment=True, filename=file.filename)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(last_modified)
+    if etag:
+        response['ETag'] = etag
+    return response
+
+def if_range_matches(request, etag, last_modified):
+    """
+    If-Range 不存在，或者与当前文件匹配时，才处理 Range 头，否则返回完整的文件
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag is not None and if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
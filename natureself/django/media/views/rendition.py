@@ -0,0 +1,55 @@
+from django.apps import apps
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound, HttpResponseRedirect
+
+from natureself.django.media import renditions
+from natureself.django.media.models import ImageRenditionMixin
+from natureself.django.media.views.download import ACCEL_REDIRECT_PREFIX
+
+import os
+from urllib.parse import quote
+
+"""
+生成、返回图片的 rendition
+
+GET /media/<path>.<name>.<ext>
+
+rendition 的地址与原图类似（见 natureself.django.media.renditions），nginx 找不到文件时才会交给 Django，
+生成之后，之后的请求都由 nginx 直接返回。原图无法识别（例如 svg）时，重定向到原图。
+"""
+def get_rendition_models():
+    return [model for model in apps.get_models() if issubclass(model, ImageRenditionMixin)]
+
+def find_image(path):
+    """
+    根据去掉扩展名的路径（{STORAGE_ROOT}/{bucket}/{key[:2]}/{key}）查找图片
+    """
+    key = os.path.basename(path)
+    for Model in get_rendition_models():
+        if not path.startswith(Model.STORAGE_ROOT.strip('/') + '/'):
+            continue
+        for image in Model.objects.filter(deleted_at__isnull=True, key=key):
+            image_path = os.path.join(Model.STORAGE_ROOT, image.bucket, image.local_path)
+            if os.path.splitext(os.path.normpath(image_path))[0] == os.path.normpath(path):
+                return image
+    return None
+
+def serve_rendition(request, path, name, ext):
+    if name not in renditions.RENDITIONS or renditions.get_extension(name) != ext:
+        return HttpResponseNotFound()
+
+    image = find_image(path)
+    if not image:
+        return HttpResponseNotFound()
+
+    rendition_path = image.generate_rendition(name)
+    if not rendition_path:
+        return HttpResponseRedirect(image.url())
+
+    if ACCEL_REDIRECT_PREFIX:
+        response = HttpResponse(content_type=renditions.get_content_type(name))
+        path = os.path.relpath(rendition_path, settings.MEDIA_ROOT)
+        response['X-Accel-Redirect'] = quote(os.path.join(ACCEL_REDIRECT_PREFIX, path))
+        return response
+
+    return FileResponse(open(rendition_path, 'rb'), content_type=renditions.get_content_type(name))
@@ -0,0 +1,195 @@
+"""
+观看记录（PolyvVideoWatchRecord、PolyvLiveWatchRecord、PresentationWatchRecord）的读写
+
+观看记录对每个 (user, item) 都有唯一约束，使用 get_or_create 或者先查询再写入时，每次标记需要两三次查询，
+而且多个请求同时标记同一个记录时，会因为唯一约束而出现 IntegrityError。这里的写入都是单条语句：
+
+* 视频、直播只需要记录是否看过：INSERT ... ON CONFLICT DO NOTHING（bulk_create(ignore_conflicts=True)）
+* PPT 需要在已有的记录（可能已经有观看时长）上设置 watched：INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+
+使用方法：
+
+    # 标记单个/多个 (user, item) 为已观看
+    videos.mark_watched(user, video)
+    videos.bulk_mark_watched([(user, video), ...])
+
+    # 一次查询用户看过 items 中的哪些，返回 item id 的 set
+    videos.get_watched(user, items)
+
+    # 在列表页中，为每个 item 设置 watched 属性，模版中使用 {{ video.watched }}，不需要每个 item 查询一次
+    videos.fetch_watched(user, items)
+
+一般通过模型的方法调用，例如 PolyvVideo.mark_watched()、PolyvVideo.fetch_watched()。
+"""
+from django.apps import apps
+from django.db import connection, transaction
+from django.utils import timezone
+
+# 每条 INSERT 语句写入的记录数量
+BATCH_SIZE = 500
+
+def supports_upsert():
+    """
+    是否支持 INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        # ON CONFLICT DO UPDATE 需要 3.24，RETURNING 需要 3.35
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+def get_converters(fields):
+    # 与 SQLCompiler 相同，将数据库返回的值（例如 sqlite 中的日期时间是字符串）转换为 python 对象
+    converters = []
+    for field in fields:
+        col = field.get_col(field.model._meta.db_table)
+        converters.append((col, connection.ops.get_db_converters(col) + field.get_db_converters(connection)))
+    return converters
+
+def upsert(model, rows, unique_fields, update):
+    """
+    批量写入，rows 为 [{字段名: 值}]，每个 row 的字段必须相同，unique_fields 为唯一约束的字段（例如 ['user', 'presentation']）。
+    update 为记录已存在时的 SET 子句，其中 {table} 会替换为表名，例如：
+
+        'watched_seconds = {table}.watched_seconds + EXCLUDED.watched_seconds'
+
+    返回写入（创建或更新）后的记录。调用前需要检查 supports_upsert()
+    """
+    if not rows:
+        return []
+
+    opts = model._meta
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    fields = [opts.get_field(name) for name in rows[0]]
+    unique_columns = [opts.get_field(name).column for name in unique_fields]
+    returning = opts.concrete_fields
+    converters = get_converters(returning)
+
+    # 按照相同的顺序写入，多个请求同时写入相同的记录时不会死锁
+    rows = sorted(rows, key=lambda row: tuple(row[name] for name in unique_fields))
+    records = []
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i+BATCH_SIZE]
+        params = []
+        for row in batch:
+            params += [field.get_db_prep_save(row[field.name], connection) for field in fields]
+        placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+        sql = (
+            f'INSERT INTO {table} ({", ".join(qn(field.column) for field in fields)}) '
+            f'VALUES {", ".join([placeholders] * len(batch))} '
+            f'ON CONFLICT ({", ".join(qn(column) for column in unique_columns)}) DO UPDATE '
+            f'SET {update.format(table=table)} '
+            f'RETURNING {", ".join(qn(field.column) for field in returning)}'
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for values in cursor.fetchall():
+                values = list(values)
+                for pos, (col, funcs) in enumerate(converters):
+                    for func in funcs:
+                        values[pos] = func(values[pos], col, connection)
+                records.append(model.from_db(connection.alias, [field.attname for field in returning], values))
+    return records
+
+def get_id(obj):
+    # items 中可以是对象，也可以是 id
+    return getattr(obj, 'pk', obj)
+
+class WatchRecords:
+    """
+    一种观看记录的读写，model_name 为观看记录的模型，field 为观看记录中指向被观看的对象的字段
+    """
+    def __init__(self, model_name, field):
+        self.model_name = model_name
+        self.field = field
+
+    @property
+    def model(self):
+        # 这里不能直接导入 models，models 会导入本模块
+        return apps.get_model('media', self.model_name)
+
+    def get_watched_queryset(self):
+        return self.model.objects.all()
+
+    def mark_watched(self, user, item):
+        self.bulk_mark_watched([(user, item)])
+
+    def bulk_mark_watched(self, pairs):
+        """
+        pairs: [(user, item)]，user 与 item 可以是对象或者 id，已经存在的记录会被忽略
+        """
+        records = {(get_id(user), get_id(item)) for user, item in pairs}
+        self.model.objects.bulk_create([
+                self.model(**{'user_id': user_id, f'{self.field}_id': item_id})
+                for user_id, item_id in sorted(records)
+                ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    def get_watched(self, user, items):
+        """
+        返回 user 看过 items 中哪些 item（id 的 set），一次查询
+        """
+        if not user or not user.is_authenticated:
+            return set()
+        item_ids = {get_id(item) for item in items}
+        if not item_ids:
+            return set()
+        return set(self.get_watched_queryset()
+                .filter(**{'user_id': user.id, f'{self.field}_id__in': item_ids})
+                .values_list(f'{self.field}_id', flat=True))
+
+    def fetch_watched(self, user, items):
+        """
+        为每个 item 设置 watched 属性（bool）
+        """
+        items = list(items)
+        watched = self.get_watched(user, items)
+        for item in items:
+            item.watched = item.pk in watched
+        return items
+
+class PresentationWatchRecords(WatchRecords):
+    """
+    PPT 的观看记录中还有观看时长，记录存在不代表已经看完，watched 为 True 才表示看完
+    """
+    def get_watched_queryset(self):
+        return self.model.objects.filter(watched=True)
+
+    def mark_watched(self, user, item):
+        return self.bulk_mark_watched([(user, item)])[0]
+
+    def bulk_mark_watched(self, pairs):
+        """
+        返回标记后的 PresentationWatchRecord 列表（按 user_id, presentation_id 排序）
+        """
+        keys = sorted({(get_id(user), get_id(item)) for user, item in pairs})
+        if not keys:
+            return []
+        if not supports_upsert():
+            return self.bulk_mark_watched_fallback(keys)
+        now = timezone.now()
+        return upsert(self.model,
+                [dict(user=user_id, presentation=item_id, watched_seconds=0, watched=True, visited_at=now)
+                    for user_id, item_id in keys],
+                ['user', 'presentation'],
+                'watched = EXCLUDED.watched')
+
+    def bulk_mark_watched_fallback(self, keys):
+        """
+        不支持 ON CONFLICT DO UPDATE 的数据库：先忽略冲突插入，再逐条更新
+        """
+        Model = self.model
+        with transaction.atomic():
+            Model.objects.bulk_create([
+                    Model(user_id=user_id, presentation_id=item_id, watched=True) for user_id, item_id in keys
+                    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+            records = []
+            for user_id, item_id in keys:
+                Model.objects.filter(user_id=user_id, presentation_id=item_id, watched=False).update(watched=True)
+                records.append(Model.objects.get(user_id=user_id, presentation_id=item_id))
+        return records
+
+videos = WatchRecords('PolyvVideoWatchRecord', 'video')
+lives = WatchRecords('PolyvLiveWatchRecord', 'live')
+presentations = PresentationWatchRecords('PresentationWatchRecord', 'presentation')
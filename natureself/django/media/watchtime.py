@@ -0,0 +1,212 @@
+"""
+PPT 观看时长（心跳）的合并写入
+
+观看 PPT 时，前端每隔几秒发送一次心跳（Presentation.add_watch_time），如果每次心跳都读取、更新一次
+PresentationWatchRecord，同时在线学习的人数较多时，这是写入最频繁的地方。
+
+因此心跳先在进程内合并：每个 (user, presentation) 只记录待写入的秒数，由后台线程每隔
+NS_MEDIA_WATCH_TIME_FLUSH_INTERVAL 秒，用一条 INSERT ... ON CONFLICT DO UPDATE 语句批量写入所有待写入的记录。
+
+* 进程内第一次收到某个 (user, presentation) 的心跳时，立即写入（创建记录），并记住数据库返回的总时长，
+  之后的心跳只在内存中累加，返回的总时长 = 数据库中的总时长 + 尚未写入的秒数
+* 其他进程中尚未写入的秒数不会包含在返回的总时长中，误差不超过一个写入间隔
+* 调用时指定 flush=True（例如观看到最后一页，需要判断是否达到最少观看时长时）会立即写入该记录，返回准确的总时长
+* 立即写入与后台线程的批量写入串行执行（flush_lock），数据库中的总时长只会增加，内存中也只保留较大的值，
+  因此返回的总时长不会因为写入的先后顺序而变小
+* 进程退出时（atexit）会写入所有待写入的记录；进程被强制结束时，最多丢失一个写入间隔的观看时长
+
+相关配置（可选）：
+
+    NS_MEDIA_WATCH_TIME_FLUSH_INTERVAL = 5    # 写入间隔（秒），0 表示不合并，每次心跳都直接写入数据库
+"""
+from django.conf import settings
+from django.db import transaction, close_old_connections, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+import time
+import atexit
+import threading
+
+from . import watchrecords
+
+import logging
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = getattr(settings, 'NS_MEDIA_WATCH_TIME_FLUSH_INTERVAL', 5)
+# 超过该时间（秒）没有心跳的记录，不再保存在内存中
+IDLE_TIMEOUT = 60 * 10
+
+def get_model():
+    from .models import PresentationWatchRecord
+    return PresentationWatchRecord
+
+def upsert(deltas):
+    """
+    deltas: {(user_id, presentation_id): seconds}，将 seconds 累加到对应的记录中（记录不存在时创建）。
+    返回 {(user_id, presentation_id): (watched_seconds, watched)}
+    """
+    if not watchrecords.supports_upsert():
+        return upsert_fallback(deltas)
+
+    now = timezone.now()
+    records = watchrecords.upsert(get_model(),
+            [dict(user=user_id, presentation=presentation_id, watched_seconds=seconds, watched=False, visited_at=now)
+                for (user_id, presentation_id), seconds in deltas.items()],
+            ['user', 'presentation'],
+            'watched_seconds = {table}.watched_seconds + EXCLUDED.watched_seconds')
+    return {(record.user_id, record.presentation_id): (record.watched_seconds, record.watched) for record in records}
+
+def upsert_fallback(deltas):
+    """
+    不支持 ON CONFLICT 的数据库，逐条更新
+    """
+    Model = get_model()
+    result = {}
+    for (user_id, presentation_id), seconds in sorted(deltas.items()):
+        with transaction.atomic():
+            updated = Model.objects.filter(user_id=user_id, presentation_id=presentation_id) \
+                    .update(watched_seconds=F('watched_seconds') + seconds)
+            if not updated:
+                Model.objects.create(user_id=user_id, presentation_id=presentation_id, watched_seconds=seconds)
+        record = Model.objects.get(user_id=user_id, presentation_id=presentation_id)
+        result[(user_id, presentation_id)] = (record.watched_seconds, record.watched)
+    return result
+
+class WatchTimeBuffer:
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # 后台线程与 atexit 可能同时写入
+        self.flush_lock = threading.Lock()
+        # 待写入的秒数 {key: seconds}
+        self.pending = {}
+        # 正在写入的秒数 {key: seconds}
+        self.inflight = {}
+        # 数据库中的值 {key: [watched_seconds, watched, 最后一次心跳的时间]}
+        self.known = {}
+        self.thread = None
+
+    def total(self, key):
+        watched_seconds, watched, last_seen = self.known[key]
+        return watched_seconds + self.inflight.get(key, 0) + self.pending.get(key, 0), watched
+
+    def add(self, user_id, presentation_id, seconds, flush=False):
+        """
+        累加观看时长，返回 (watched_seconds, watched)
+        """
+        key = (user_id, presentation_id)
+        with self.lock:
+            if key in self.known and self.flush_interval and not flush:
+                self.pending[key] = self.pending.get(key, 0) + seconds
+                self.known[key][2] = time.monotonic()
+                self.start()
+                return self.total(key)
+
+        # 第一次心跳，或者需要准确的总时长：该记录之前待写入的秒数与本次一起写入。
+        # 持有 flush_lock 时后台线程不会同时写入，inflight 为空，数据库返回的总时长包含了所有已经写入的秒数
+        with self.flush_lock:
+            with self.lock:
+                seconds += self.pending.pop(key, 0)
+
+            try:
+                watched_seconds, watched = upsert({key: seconds})[key]
+            except Exception:
+                with self.lock:
+                    self.pending[key] = self.pending.get(key, 0) + seconds
+                raise
+
+            with self.lock:
+                self.known.setdefault(key, [0, False, None])
+                self.update_known(key, watched_seconds, watched)
+                self.known[key][2] = time.monotonic()
+                return self.total(key)
+
+    def update_known(self, key, watched_seconds, watched):
+        """
+        记录数据库返回的值，需要持有 lock。数据库中的总时长只会增加，保留较大的值
+        """
+        known = self.known[key]
+        known[0] = max(known[0], watched_seconds)
+        known[1] = known[1] or watched
+
+    def set_watched(self, user_id, presentation_id):
+        with self.lock:
+            if (user_id, presentation_id) in self.known:
+                self.known[(user_id, presentation_id)][1] = True
+
+    def flush(self):
+        """
+        写入所有待写入的记录，返回写入的记录数量
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+            self.inflight, self.pending = self.pending, {}
+            deltas = self.inflight
+
+        result, retry = self.upsert(deltas)
+
+        with self.lock:
+            for key, (watched_seconds, watched) in result.items():
+                if key in self.known:
+                    self.update_known(key, watched_seconds, watched)
+            for key, seconds in deltas.items():
+                if key in retry:
+                    self.pending[key] = self.pending.get(key, 0) + seconds
+                elif key not in result:
+                    self.known.pop(key, None)
+            self.inflight = {}
+            self.evict()
+        return len(result)
+
+    def upsert(self, deltas):
+        """
+        返回 (写入成功的记录, 需要重试的记录)
+        """
+        try:
+            return upsert(deltas), {}
+        except IntegrityError:
+            # 批量写入失败（例如 PPT 或用户已经被删除，外键约束失败），逐条写入，丢弃写入失败的记录
+            result = {}
+            for key, seconds in deltas.items():
+                try:
+                    result.update(upsert({key: seconds}))
+                except IntegrityError as e:
+                    logger.warning(f'Discard watch time of {key}: {e}')
+            return result, {}
+        except Exception:
+            # 数据库暂时不可用等，下次重试
+            logger.exception('Error while flushing watch time')
+            return {}, deltas
+
+    def evict(self):
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        for key in [key for key, (s, w, last_seen) in self.known.items() if last_seen < deadline]:
+            if key not in self.pending:
+                del self.known[key]
+
+    def start(self):
+        # gunicorn 在 fork 之后才会处理请求，因此在第一次需要时（而不是导入时）启动线程
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='watch-time-flusher', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            self.flush()
+
+buffer = WatchTimeBuffer()
+atexit.register(buffer.flush)
+
+def add(user_id, presentation_id, seconds, flush=False):
+    return buffer.add(user_id, presentation_id, seconds, flush=flush)
+
+def set_watched(user_id, presentation_id):
+    buffer.set_watched(user_id, presentation_id)
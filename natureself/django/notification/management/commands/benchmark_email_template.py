@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+import time
+import random
+
+from natureself.django.notification.tools import EmailMessage
+from natureself.django.notification import templatecache
+
+class Command(BaseCommand):
+    help = '比较使用、不使用预编译模板时，构造一封邮件所需的 CPU 时间（不会发送邮件、不会写数据库）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', default='notification/emails/example-email.html', help='邮件模板')
+        parser.add_argument('--count', type=int, default=200, help='每种方式构造的邮件数量')
+
+    def build(self, template, compiled):
+        # 与验证码邮件类似，每封邮件只有一个变量不同
+        context = dict(code=''.join(random.choices('0123456789', k=6)), username='user')
+        message = EmailMessage('test@example.com', 'benchmark', template=template, context=context, compiled=compiled)
+        return message.message().as_string()
+
+    def measure(self, template, compiled, count):
+        start = time.process_time()
+        for i in range(count):
+            self.build(template, compiled)
+        return (time.process_time() - start) / count * 1000
+
+    def handle(self, *args, **options):
+        template, count = options['template'], options['count']
+
+        templatecache.clear()
+        # 预热（首次编译模板、加载 premailer 等）
+        self.build(template, False)
+        self.build(template, True)
+
+        slow = self.measure(template, False, count)
+        fast = self.measure(template, True, count)
+
+        self.stdout.write(f'template: {template}, {count} messages each')
+        self.stdout.write(f'  without cache: {slow:.3f} ms/message')
+        self.stdout.write(f'  with cache:    {fast:.3f} ms/message ({slow / fast:.1f}x)')
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import time
+import signal
+
+from natureself.django.notification.outbox import EmailOutbox
+
+class Command(BaseCommand):
+    help = '发送队列中的邮件（settings.EMAIL_QUEUE 为 True 时，send_mail() 只会将邮件加入队列）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='发送完当前到期的邮件后退出，不常驻运行')
+        parser.add_argument('--interval', type=float, default=1, help='队列为空时，等待多久（秒）再次检查队列')
+        parser.add_argument('--batch-size', type=int, default=None, help='每批取出的邮件数量')
+        parser.add_argument('--rate-limit', type=int, default=None, help='每分钟最多发送的邮件数量，0 表示不限制')
+
+    def handle(self, *args, **options):
+        outbox = EmailOutbox(batch_size=options['batch_size'], rate_limit=options['rate_limit'])
+
+        if options['once']:
+            sent = outbox.drain()
+            self.stdout.write(f'{sent} email(s) sent')
+            return
+
+        # 收到 SIGTERM/SIGINT 时，发送完当前这一批邮件再退出
+        self.stopping = False
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            # 常驻进程中需要手动清理失效的数据库连接（例如数据库重启后）
+            close_old_connections()
+            sent = outbox.drain()
+            if sent:
+                self.stdout.write(f'{sent} email(s) sent')
+            time.sleep(options['interval'])
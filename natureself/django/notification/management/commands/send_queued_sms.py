@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import time
+import signal
+
+from natureself.django.notification.outbox import SmsOutbox
+
+class Command(BaseCommand):
+    help = '发送队列中的短信（settings.ALI_SMS_QUEUE 为 True 时，send_sms() 只会将短信加入队列）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='发送完当前到期的短信后退出，不常驻运行')
+        parser.add_argument('--interval', type=float, default=0.5, help='队列为空时，等待多久（秒）再次检查队列')
+        parser.add_argument('--batch-size', type=int, default=None, help='每批取出的短信数量')
+
+    def handle(self, *args, **options):
+        outbox = SmsOutbox(batch_size=options['batch_size'])
+
+        if options['once']:
+            sent = outbox.drain()
+            self.stdout.write(f'{sent} sms sent')
+            return
+
+        # 收到 SIGTERM/SIGINT 时，发送完当前这一批短信再退出
+        self.stopping = False
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            # 常驻进程中需要手动清理失效的数据库连接（例如数据库重启后）
+            close_old_connections()
+            sent = outbox.drain()
+            if sent:
+                self.stdout.write(f'{sent} sms sent')
+            time.sleep(options['interval'])
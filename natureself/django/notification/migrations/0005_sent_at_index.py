@@ -0,0 +1,21 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0004_auto_20190508_2054'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alisms',
+            index=models.Index(fields=['-sent_at', '-id'], name='notification_alisms_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['-sent_at', '-id'], name='notification_email_sent_idx'),
+        ),
+    ]
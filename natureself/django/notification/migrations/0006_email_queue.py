@@ -0,0 +1,32 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0005_sent_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(condition=models.Q(status='pending'), fields=['next_attempt_at'], name='notification_email_queue_idx'),
+        ),
+    ]
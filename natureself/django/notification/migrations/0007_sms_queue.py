@@ -0,0 +1,37 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notification', '0006_email_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alisms',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='alisms',
+            name='client_ip',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='alisms',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='alisms',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='alisms',
+            index=models.Index(condition=models.Q(status='pending'), fields=['next_attempt_at'], name='notification_alisms_queue_idx'),
+        ),
+    ]
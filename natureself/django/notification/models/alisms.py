@@ -6,8 +6,9 @@ import re
 import json
 from model_utils import Choices
 import jsonfield
-from aliyunsdkcore.client import AcsClient
-from aliyunsdkcore.request import CommonRequest
+
+from ..sms import get_transport
+from ..throttle import get_bucket
 
 import logging
 logger = logging.getLogger(__name__)
@@ -17,31 +18,34 @@ DRYRUN = getattr(settings, 'ALI_SMS_DRY_RUN', False)
 ALI_SMS_ACCESS_KEY_ID = settings.ALI_SMS_ACCESS_KEY_ID
 ALI_SMS_ACCESS_KEY_SECRET = settings.ALI_SMS_ACCESS_KEY_SECRET
 
-def send_sms(phone_numbers, signature_name, template_code, template_param):
-    return AliSms.objects.send_sms(phone_numbers, signature_name, template_code, template_param)
-
-def _alisdk_send_sms(phone_numbers, signature_name, template_code, template_param):
-    client = AcsClient(ALI_SMS_ACCESS_KEY_ID, ALI_SMS_ACCESS_KEY_SECRET, 'default')
-
-    request = CommonRequest()
-    request.set_accept_format('json')
-    request.set_domain('dysmsapi.aliyuncs.com')
-    request.set_method('POST')
-    request.set_protocol_type('https')
-    request.set_version('2017-05-25')
-    request.set_action_name('SendSms')
-    request.add_query_param('PhoneNumbers', phone_numbers)
-    request.add_query_param('SignName', signature_name)
-    request.add_query_param('TemplateCode', template_code)
-    if not isinstance(template_param, str):
-        template_param = json.dumps(template_param)
-    request.add_query_param('TemplateParam', template_param)
-    response = client.do_action(request)
-
-    return json.loads(response)
+# 为 True 时，send_sms() 只将短信加入待发送队列，由 `manage.py send_queued_sms` 异步发送，
+# 见 natureself.django.notification.outbox
+QUEUE = getattr(settings, 'ALI_SMS_QUEUE', False)
+# 频率限制（令牌桶），格式为 (容量, 秒)，例如 (5, 3600) 表示最多连续发送 5 条，之后每小时恢复 5 条，None 表示不限制。
+# 单手机号、单 IP 的限制在调用 send_sms() 时检查，超过限制的短信不会发送，状态为 reject；
+# 全局限制（接口调用频率）在 worker 中控制，见 natureself.django.notification.outbox
+THROTTLE_PER_NUMBER = getattr(settings, 'ALI_SMS_THROTTLE_PER_NUMBER', (5, 60 * 60))
+THROTTLE_PER_IP = getattr(settings, 'ALI_SMS_THROTTLE_PER_IP', (30, 60 * 60))
+
+def send_sms(phone_numbers, signature_name, template_code, template_param, client_ip=None):
+    return AliSms.objects.send_sms(phone_numbers, signature_name, template_code, template_param, client_ip=client_ip)
+
+def check_throttle(phone_numbers, client_ip=None):
+    """
+    检查单手机号、单 IP 的频率限制，返回超过限制的原因，未超过时返回 None
+    """
+    for number in phone_numbers.split(','):
+        bucket = get_bucket(THROTTLE_PER_NUMBER, key=f'sms:number:{number}')
+        if bucket and not bucket.consume():
+            return f'超过单手机号发送频率限制: {number}'
+    if client_ip:
+        bucket = get_bucket(THROTTLE_PER_IP, key=f'sms:ip:{client_ip}')
+        if bucket and not bucket.consume():
+            return f'超过单 IP 发送频率限制: {client_ip}'
+    return None
 
 class AliSmsManager(models.Manager):
-    def send_sms(self, phone_numbers, signature_name, template_code, template_param):
+    def send_sms(self, phone_numbers, signature_name, template_code, template_param, client_ip=None):
         # clean data
         # removes spaces in between commas
         phone_numbers = ','.join([n.strip() for n in phone_numbers.split(',')])
@@ -80,7 +84,26 @@ class AliSmsManager(models.Manager):
                 template_param = template_param,
                 access_key_id = ALI_SMS_ACCESS_KEY_ID,
                 content = f'【{signature_name}】{content}',
+                client_ip = client_ip or '',
+                status = self.model.STATUSES.pending,
                 )
+
+        reject_reason = check_throttle(phone_numbers, client_ip)
+        if reject_reason:
+            logger.warning(f'sms rejected, to: {phone_numbers}, reason: {reject_reason}')
+            sms.status = self.model.STATUSES.reject
+            sms.ali_message = reject_reason
+            sms.save()
+
+            return sms
+
+        if QUEUE and not DRYRUN:
+            # 由 worker 进程发送
+            sms.next_attempt_at = timezone.now()
+            sms.save()
+
+            return sms
+
         sms.save()
 
         if DRYRUN:
@@ -91,25 +114,11 @@ class AliSmsManager(models.Manager):
 
             return sms
 
-        # 发送短信
-        # 将来需要实现异步发送
-        # TODO 需要实现频率控制，包括单 IP 限制、单手机号限制、总频率限制、其他风控措施（例如需要验证码才能发送短信等）
-        response = _alisdk_send_sms(phone_numbers, signature_name, template_code, template_param)
-        sms.sent_at = timezone.now()
-        # 见 https://sentry.evahealth.net/ns/cardpc/issues/751/
-        # 在发生错误时，可能没有 BizId，消息样例：
-        # {
-        #   'Code': 'isv.BUSINESS_LIMIT_CONTROL',
-        #   'Message': '触发小时级流控Permits:5',
-        #   'RequestId': '6E3636E5-2708-4DFD-B2A2-923A47B6EA0F'
-        # }
-        sms.ali_bizid = response.get('BizId', '')
-        sms.ali_code = response['Code']
-        sms.ali_message = response['Message']
-        if response['Code'] == 'OK':
-            sms.status = self.model.STATUSES.success
-        else:
-            sms.status = self.model.STATUSES.failed
+        # 同步发送短信
+        # TODO 其他风控措施（例如需要验证码才能发送短信等）
+        sms.attempts = 1
+        response = get_transport().send(phone_numbers, signature_name, template_code, template_param)
+        sms.set_response(response)
         sms.save()
 
         return sms
@@ -118,6 +127,14 @@ class AliSms(models.Model):
     """
     使用阿里云短信服务发送的短信记录
     """
+    class Meta:
+        indexes = [
+            # 管理后台按照 -sent_at 游标分页，见 natureself.django.core.utils.get_cursor_pagination
+            models.Index(fields=['-sent_at', '-id'], name='notification_alisms_sent_idx'),
+            # worker 取待发送短信
+            models.Index(fields=['next_attempt_at'], name='notification_alisms_queue_idx',
+                condition=models.Q(status='pending')),
+        ]
 
     objects = AliSmsManager()
 
@@ -156,13 +173,12 @@ class AliSms(models.Model):
     TEMPLATE_VARIABLE_PATTERN = re.compile(r'\${(?P<key>[^}]+)}')
 
     # 短信发送状态
-    # 目前我们使用同步发送的方式，即调用 send_sms() 会立即发送，在发送之后才会返回，
-    # 但是将来我们可能会采用异步发送的方式，即 send_sms() 仅仅将短信加入待发送队列，然后异步调度发送，
-    # 从而可以实现频率限制等功能。
+    # 如果 settings.ALI_SMS_QUEUE 为 True，send_sms() 仅仅将短信加入待发送队列，然后由 worker 进程异步发送
+    # （见 natureself.django.notification.outbox），否则调用 send_sms() 会立即发送，在发送之后才会返回。
     STATUSES = Choices(
-        # pending 表示已经将短信加入待发送队列，等待被发送，限制使用同步发送的方式，短信不会处于该状态
+        # pending 表示已经将短信加入待发送队列，等待被发送（包括网络错误、等待重试的短信）
         ('pending', 'pending', '待发送'),
-        # reject 表示由于某种原因拒绝发送，例如超过发送频率限制，或其他内部限制。目前没有实现这方面限制，所以不会处于该状态
+        # reject 表示由于某种原因拒绝发送，例如超过发送频率限制（单手机号、单 IP），此时 ali_message 中记录了原因
         ('reject', 'reject', '拒绝发送'),
         # 表示已经调用了第三方服务商的 SDK，但是有些第三方可能需要异步检查发送结果，
         # 我们获得这个结果前处于该状态。目前阿里大鱼服务会立刻返回结果，所以目前不会处于该状态
@@ -208,9 +224,39 @@ class AliSms(models.Model):
     # 实际调用阿里云 SDK 的时间
     sent_at = models.DateTimeField(null=True)
 
+    # 请求发送短信的客户端 IP，用于单 IP 频率限制
+    client_ip = models.TextField(blank=True, default='')
+    # 以下字段用于异步发送，见 natureself.django.notification.outbox
+    # 已经尝试发送的次数
+    attempts = models.IntegerField(default=0)
+    # 下一次尝试发送的时间，worker 只会取出 next_attempt_at 已经到达的 pending 短信
+    next_attempt_at = models.DateTimeField(null=True)
+    # 最后一次发送失败（网络错误等，没有得到阿里云的响应）的错误信息
+    last_error = models.TextField(blank=True, default='')
+
     def __str__(self):
         return f'to: {self.phone_numbers}, message: {self.content}'
 
+    def set_response(self, response):
+        """
+        根据阿里云 API 的响应设置发送结果（不保存）
+        """
+        self.sent_at = timezone.now()
+        # 见 https://sentry.evahealth.net/ns/cardpc/issues/751/
+        # 在发生错误时，可能没有 BizId，消息样例：
+        # {
+        #   'Code': 'isv.BUSINESS_LIMIT_CONTROL',
+        #   'Message': '触发小时级流控Permits:5',
+        #   'RequestId': '6E3636E5-2708-4DFD-B2A2-923A47B6EA0F'
+        # }
+        self.ali_bizid = response.get('BizId', '')
+        self.ali_code = response['Code']
+        self.ali_message = response['Message']
+        if response['Code'] == 'OK':
+            self.status = self.STATUSES.success
+        else:
+            self.status = self.STATUSES.failed
+
     def serialize(self, to_dict=True):
         data = dict(
                 phone_numbers = [n.strip() for n in self.phone_numbers.split(',')],
@@ -221,6 +267,8 @@ class AliSms(models.Model):
                 ali_bizid = self.ali_bizid,
                 ali_code = self.ali_code,
                 ali_message = self.ali_message,
+                attempts = self.attempts,
+                last_error = self.last_error,
                 )
 
         return data if to_dict else json.dumps(data, ensure_ascii=False)
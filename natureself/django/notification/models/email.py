@@ -46,6 +46,15 @@ class Email(models.Model):
 
     此外，数据库中还会记录一些与发送有关的信息，例如发送时间、发送是否成功等等。
     """
+    class Meta:
+        indexes = [
+            # 管理后台按照 -sent_at 游标分页，见 natureself.django.core.utils.get_cursor_pagination
+            models.Index(fields=['-sent_at', '-id'], name='notification_email_sent_idx'),
+            # worker 取待发送邮件，待发送的邮件只占很少一部分，因此使用部分索引
+            models.Index(fields=['next_attempt_at'], name='notification_email_queue_idx',
+                condition=models.Q(status='pending')),
+        ]
+
     objects = EmailManager()
 
     # 邮件标题
@@ -59,11 +68,10 @@ class Email(models.Model):
     content = models.TextField()
 
     # 邮件发送的状态
-    # 目前我们的邮件使用同步发送的方式，即调用 send_mail() 会立刻发送，在发送结束后才会返回，
-    # 但是将来我们可能会采用异步发送的方式，即 send_mail() 仅仅将邮件加入待发送队列，然后异步调度发送，
-    # 从而可以实现频率限制等功能。
+    # 如果 settings.EMAIL_QUEUE 为 True，send_mail() 仅仅将邮件加入待发送队列，然后由 worker 进程异步发送
+    # （见 natureself.django.notification.outbox），否则调用 send_mail() 会立刻发送，在发送结束后才会返回。
     STATUSES = Choices(
-        # pending 表示已经将邮件加入待发送队列，等待被发送，现在使用同步发送的方式，邮件不会处于该状态
+        # pending 表示已经将邮件加入待发送队列，等待被发送（包括发送失败、等待重试的邮件）
         ('pending', 'pending', '待发送'),
         # reject 表示由于某种原因拒绝发送，例如超过发送频率限制，或其他内部限制。目前没有实现这方面限制，所以不会处于该状态
         ('reject', 'reject', '拒绝发送'),
@@ -84,9 +92,17 @@ class Email(models.Model):
 
     # 调用 send_mail() 的时间
     created_at = models.DateTimeField(auto_now_add=True)
-    # 实际通过 smtp 或 http api 发送邮件的时间。目前我们使用同步发送的方式，因此 created_at 与 sent_at 相同（或只有极小的差别）
+    # 实际通过 smtp 或 http api 发送邮件的时间。同步发送时，created_at 与 sent_at 相同（或只有极小的差别）
     sent_at = models.TextField()
 
+    # 以下字段用于异步发送，见 natureself.django.notification.outbox
+    # 已经尝试发送的次数
+    attempts = models.IntegerField(default=0)
+    # 下一次尝试发送的时间，worker 只会取出 next_attempt_at 已经到达的 pending 邮件
+    next_attempt_at = models.DateTimeField(null=True)
+    # 最后一次发送失败的错误信息
+    last_error = models.TextField(blank=True, default='')
+
     def __str__(self):
         return f'recipients: {self.recipients}, subject: {self.subject}'
 
@@ -95,12 +111,15 @@ class Email(models.Model):
         display = f'{name} <{addr}>' if name else addr
         return dict(name=name, address=addr, display=display)
 
+    @property
+    def local_abs_path(self):
+        return os.path.join(settings.MEDIA_ROOT, 'emails', self.local_path)
+
     @cached_property
     def message(self):
-        local_abs_path = os.path.join(settings.MEDIA_ROOT, 'emails', self.local_path)
-        if not os.path.exists(local_abs_path):
+        if not os.path.exists(self.local_abs_path):
             return None
-        with open(local_abs_path) as fp:
+        with open(self.local_abs_path) as fp:
             return message_from_file(fp, _class=message.EmailMessage, policy=policy.default)
 
     @cached_property
@@ -163,6 +182,8 @@ class Email(models.Model):
                 'status': self.status,
                 'created_at': self.created_at,
                 'sent_at': self.sent_at,
+                'attempts': self.attempts,
+                'last_error': self.last_error,
                 'attachments': [attachment['filename'] for attachment in self.attachments],
                 }
 
@@ -0,0 +1,361 @@
+"""
+邮件、短信异步发送
+
+邮件
+----
+
+send_mail() 在请求线程中同步连接 SMTP 服务器发送邮件，如果 SMTP 服务器很慢，会阻塞 gunicorn 的 worker。
+开启 settings.EMAIL_QUEUE 后，send_mail() 只会把邮件保存到数据库（状态为 pending），由单独的 worker 进程发送：
+
+    python manage.py send_queued_mail
+
+worker 的工作方式：
+* 每次从数据库中取出一批 next_attempt_at 已经到达的 pending 邮件，取出时将 next_attempt_at 推后一段时间（租约），
+  并增加 attempts，这样多个 worker 同时运行时不会重复发送；如果 worker 在发送过程中退出，租约过期后邮件会被重新发送
+* 同一批邮件（以及连续的多批邮件）复用同一个 SMTP 连接，队列为空时关闭连接
+* 发送失败时，如果是临时错误（网络错误、4xx 等），按照指数退避设置下一次发送的时间，超过最大次数后标记为 failed；
+  如果是永久错误（5xx，例如收件人地址不存在），直接标记为 failed
+* 按照 EMAIL_QUEUE_RATE_LIMIT 限制发送频率
+
+相关配置（均为可选）：
+
+    EMAIL_QUEUE = True                  # 开启异步发送
+    EMAIL_QUEUE_BATCH_SIZE = 50         # 每批取出的邮件数量
+    EMAIL_QUEUE_RATE_LIMIT = 120        # 每分钟最多发送的邮件数量，0 表示不限制
+    EMAIL_QUEUE_MAX_ATTEMPTS = 5        # 最多尝试发送的次数
+    EMAIL_QUEUE_RETRY_DELAY = 60        # 第一次重试的间隔（秒），之后每次翻倍
+    EMAIL_QUEUE_MAX_RETRY_DELAY = 3600  # 重试间隔的上限（秒）
+    EMAIL_QUEUE_LEASE = 300             # 租约时间（秒），应该远大于发送一批邮件所需的时间
+
+短信
+----
+
+开启 settings.ALI_SMS_QUEUE 后，send_sms() 只会把短信保存到数据库（状态为 pending），由单独的 worker 进程发送：
+
+    python manage.py send_queued_sms
+
+worker 的工作方式与邮件类似（租约、重试、指数退避），另外：
+* 同一批中使用相同模板、只有一个手机号的短信，合并为一次 SendBatchSms 调用（每次最多 transport.MAX_BATCH_SIZE 条），
+  批量调用失败时，逐条调用 SendSms 重新发送，以便每条短信都能得到准确的结果
+* 按照 ALI_SMS_THROTTLE_GLOBAL 限制调用阿里云 API 的频率（令牌桶，每次 API 调用消耗一个令牌）
+* 阿里云返回的错误（例如手机号非法、流控）直接标记为 failed，只有网络错误等没有得到响应的情况才会重试
+
+相关配置（均为可选）：
+
+    ALI_SMS_QUEUE = True                    # 开启异步发送
+    ALI_SMS_QUEUE_BATCH_SIZE = 200          # 每批取出的短信数量
+    ALI_SMS_QUEUE_MAX_ATTEMPTS = 5          # 最多尝试发送的次数
+    ALI_SMS_THROTTLE_GLOBAL = (20, 1)       # 调用阿里云 API 的频率限制，(容量, 秒)，None 表示不限制
+
+重试间隔、租约时间与邮件相同（EMAIL_QUEUE_RETRY_DELAY 等）。
+"""
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from email.utils import getaddresses, formataddr
+import re
+import time
+import smtplib
+import datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .models import Email, AliSms
+from .sms import get_transport
+from .throttle import get_bucket
+
+BATCH_SIZE = getattr(settings, 'EMAIL_QUEUE_BATCH_SIZE', 50)
+RATE_LIMIT = getattr(settings, 'EMAIL_QUEUE_RATE_LIMIT', 120)
+MAX_ATTEMPTS = getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(settings, 'EMAIL_QUEUE_RETRY_DELAY', 60)
+MAX_RETRY_DELAY = getattr(settings, 'EMAIL_QUEUE_MAX_RETRY_DELAY', 60 * 60)
+LEASE = getattr(settings, 'EMAIL_QUEUE_LEASE', 60 * 5)
+
+class RawMessage:
+    """
+    保存在文件中的邮件原文。Django 的 EmailBackend 只会调用 message().as_bytes(linesep='\\r\\n')，
+    我们直接返回原文，避免重新解析、序列化邮件时改变邮件内容
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def as_bytes(self, **kwargs):
+        return self.data
+
+class QueuedEmailMessage:
+    """
+    将数据库中的 Email 包装成 Django EmailBackend 可以发送的对象，与 tools.EmailMessage 类似
+    """
+    encoding = settings.DEFAULT_CHARSET
+
+    def __init__(self, email):
+        self.email = email
+        self.from_email = email.from_email
+
+    def recipients(self):
+        return [formataddr(addr) for addr in getaddresses([self.email.recipients])]
+
+    def message(self):
+        with open(self.email.local_abs_path, 'rb') as fp:
+            data = fp.read()
+        # 邮件文件是以文本方式写入的，换行符为 \n，SMTP 要求使用 \r\n
+        return RawMessage(re.sub(rb'\r?\n', b'\r\n', data))
+
+def is_permanent_error(exc):
+    """
+    判断发送失败是否为永久错误（重试也不会成功）
+    """
+    if isinstance(exc, FileNotFoundError):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        # 所有收件人都被拒绝时才会抛出该异常，recipients 为 {地址: (code, message)}
+        return all(500 <= code < 600 for code, message in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException) and 500 <= exc.smtp_code < 600:
+        return True
+    return False
+
+def get_retry_delay(attempts):
+    return min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+class EmailOutbox:
+    """
+    从数据库中取出待发送的邮件并发送，一般通过 `manage.py send_queued_mail` 运行
+    """
+    def __init__(self, batch_size=None, rate_limit=None, max_attempts=None, connection=None):
+        self.batch_size = batch_size or BATCH_SIZE
+        self.rate_limit = RATE_LIMIT if rate_limit is None else rate_limit
+        self.max_attempts = max_attempts or MAX_ATTEMPTS
+        self.connection = connection or get_connection()
+        self.last_sent_at = None
+
+    def claim(self):
+        """
+        取出一批待发送的邮件，并设置租约
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # skip_locked 使多个 worker 可以同时运行，sqlite 不支持 select_for_update，会忽略该选项
+            emails = list(Email.objects
+                    .select_for_update(skip_locked=True)
+                    .filter(status=Email.STATUSES.pending, next_attempt_at__lte=now)
+                    .order_by('next_attempt_at', 'id')[:self.batch_size])
+            if emails:
+                Email.objects.filter(id__in=[email.id for email in emails]).update(
+                        next_attempt_at = now + datetime.timedelta(seconds=LEASE),
+                        attempts = F('attempts') + 1,
+                        )
+        for email in emails:
+            email.attempts += 1
+        return emails
+
+    def throttle(self):
+        if not self.rate_limit:
+            return
+        interval = 60 / self.rate_limit
+        if self.last_sent_at is not None:
+            wait = self.last_sent_at + interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.last_sent_at = time.monotonic()
+
+    def send(self, email):
+        """
+        发送一封邮件，并记录结果，返回是否发送成功
+        """
+        self.throttle()
+        try:
+            if self.connection.connection is None:
+                self.connection.open()
+            self.connection.send_messages([QueuedEmailMessage(email)])
+        except Exception as e:
+            self.mark_failed(email, e)
+            if not is_permanent_error(e):
+                # 连接可能已经不可用，关闭后下一封邮件会重新连接
+                self.close()
+            return False
+        else:
+            email.status = Email.STATUSES.success
+            email.sent_at = timezone.now()
+            email.last_error = ''
+            email.save(update_fields=['status', 'sent_at', 'last_error'])
+            return True
+
+    def mark_failed(self, email, exc):
+        email.last_error = str(exc) or exc.__class__.__name__
+        if is_permanent_error(exc) or email.attempts >= self.max_attempts:
+            logger.error('Error while sending email %s (attempts=%s), giving up: %s', email.id, email.attempts, exc)
+            email.status = Email.STATUSES.failed
+            email.sent_at = timezone.now()
+        else:
+            delay = get_retry_delay(email.attempts)
+            logger.warning('Error while sending email %s (attempts=%s), retry in %ss: %s', email.id, email.attempts, delay, exc)
+            email.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+        email.save(update_fields=['status', 'sent_at', 'last_error', 'next_attempt_at'])
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            # close() 在连接已经断开时可能抛出异常，这里不关心
+            self.connection.connection = None
+
+    def run_batch(self):
+        """
+        发送一批邮件，返回 (取出的数量, 发送成功的数量)
+        """
+        emails = self.claim()
+        sent = 0
+        for email in emails:
+            if self.send(email):
+                sent += 1
+        return len(emails), sent
+
+    def drain(self):
+        """
+        发送所有到期的邮件，直到队列为空，返回发送成功的数量
+        """
+        total = 0
+        try:
+            while True:
+                claimed, sent = self.run_batch()
+                total += sent
+                if claimed < self.batch_size:
+                    break
+        finally:
+            self.close()
+        return total
+
+SMS_BATCH_SIZE = getattr(settings, 'ALI_SMS_QUEUE_BATCH_SIZE', 200)
+SMS_MAX_ATTEMPTS = getattr(settings, 'ALI_SMS_QUEUE_MAX_ATTEMPTS', 5)
+SMS_THROTTLE_GLOBAL = getattr(settings, 'ALI_SMS_THROTTLE_GLOBAL', (20, 1))
+
+class SmsOutbox:
+    """
+    从数据库中取出待发送的短信并发送，一般通过 `manage.py send_queued_sms` 运行
+    """
+    def __init__(self, batch_size=None, max_attempts=None, transport=None, throttle=SMS_THROTTLE_GLOBAL):
+        self.batch_size = batch_size or SMS_BATCH_SIZE
+        self.max_attempts = max_attempts or SMS_MAX_ATTEMPTS
+        self.transport = transport or get_transport()
+        # 进程内的令牌桶，多个 worker 同时运行时，总频率为各个 worker 之和
+        self.bucket = get_bucket(throttle)
+
+    def claim(self):
+        """
+        取出一批待发送的短信，并设置租约
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            messages = list(AliSms.objects
+                    .select_for_update(skip_locked=True)
+                    .filter(status=AliSms.STATUSES.pending, next_attempt_at__lte=now)
+                    .order_by('next_attempt_at', 'id')[:self.batch_size])
+            if messages:
+                AliSms.objects.filter(id__in=[sms.id for sms in messages]).update(
+                        next_attempt_at = now + datetime.timedelta(seconds=LEASE),
+                        attempts = F('attempts') + 1,
+                        )
+        for sms in messages:
+            sms.attempts += 1
+        return messages
+
+    def throttle(self):
+        if self.bucket:
+            self.bucket.wait()
+
+    def save_response(self, sms, response):
+        sms.set_response(response)
+        sms.last_error = ''
+        sms.save(update_fields=['sent_at', 'ali_bizid', 'ali_code', 'ali_message', 'status', 'last_error'])
+        if sms.status == AliSms.STATUSES.failed:
+            logger.warning('Error while sending sms %s: %s %s', sms.id, sms.ali_code, sms.ali_message)
+
+    def mark_failed(self, sms, exc):
+        sms.last_error = str(exc) or exc.__class__.__name__
+        if sms.attempts >= self.max_attempts:
+            logger.error('Error while sending sms %s (attempts=%s), giving up: %s', sms.id, sms.attempts, exc)
+            sms.status = AliSms.STATUSES.failed
+            sms.sent_at = timezone.now()
+        else:
+            delay = get_retry_delay(sms.attempts)
+            logger.warning('Error while sending sms %s (attempts=%s), retry in %ss: %s', sms.id, sms.attempts, delay, exc)
+            sms.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+        sms.save(update_fields=['status', 'sent_at', 'last_error', 'next_attempt_at'])
+
+    def send(self, sms):
+        """
+        发送一条短信，并记录结果，返回是否发送成功
+        """
+        self.throttle()
+        try:
+            response = self.transport.send(sms.phone_numbers, sms.signature_name, sms.template_code, sms.template_param)
+        except Exception as e:
+            self.mark_failed(sms, e)
+            return False
+        self.save_response(sms, response)
+        return sms.status == AliSms.STATUSES.success
+
+    def send_batch(self, template_code, messages):
+        """
+        通过一次 SendBatchSms 调用发送多条短信，返回发送成功的数量
+        """
+        self.throttle()
+        try:
+            response = self.transport.send_batch(template_code,
+                    [(sms.phone_numbers, sms.signature_name, sms.template_param) for sms in messages])
+        except Exception as e:
+            logger.warning('Error while sending sms batch (%s messages), fallback to SendSms: %s', len(messages), e)
+            response = None
+        if response is None or response.get('Code') != 'OK':
+            if response is not None:
+                logger.warning('Error while sending sms batch (%s messages), fallback to SendSms: %s %s',
+                        len(messages), response.get('Code'), response.get('Message'))
+            return sum(1 for sms in messages if self.send(sms))
+
+        # 批量发送只返回一个 BizId，所有短信共用
+        for sms in messages:
+            self.save_response(sms, response)
+        return len(messages)
+
+    def run_batch(self):
+        """
+        发送一批短信，返回 (取出的数量, 发送成功的数量)
+        """
+        messages = self.claim()
+        sent = 0
+
+        # 只有单个手机号的短信可以合并发送，多个手机号的短信本身就是一次调用
+        groups = {}
+        for sms in messages:
+            if ',' in sms.phone_numbers:
+                if self.send(sms):
+                    sent += 1
+            else:
+                groups.setdefault(sms.template_code, []).append(sms)
+
+        for template_code, group in groups.items():
+            if len(group) == 1:
+                if self.send(group[0]):
+                    sent += 1
+                continue
+            size = self.transport.MAX_BATCH_SIZE
+            for i in range(0, len(group), size):
+                sent += self.send_batch(template_code, group[i:i+size])
+
+        return len(messages), sent
+
+    def drain(self):
+        """
+        发送所有到期的短信，直到队列为空，返回发送成功的数量
+        """
+        total = 0
+        while True:
+            claimed, sent = self.run_batch()
+            total += sent
+            if claimed < self.batch_size:
+                break
+        return total
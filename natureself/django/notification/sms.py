@@ -0,0 +1,93 @@
+"""
+短信发送通道（transport）
+
+AliSms 不直接调用阿里云 SDK，而是通过 transport 发送，transport 可以通过 settings.ALI_SMS_TRANSPORT 替换，
+例如在测试中使用本地的模拟服务。transport 需要实现两个方法，返回值均为阿里云 API 的响应（dict，包含 Code、Message、BizId 等）：
+
+    send(phone_numbers, signature_name, template_code, template_param)
+    send_batch(template_code, messages)    # messages 为 [(phone_number, signature_name, template_param), ...]
+
+网络错误等无法获得响应的情况，应该抛出异常，调用者会稍后重试。
+
+每个进程中只会创建一个 transport 实例（见 get_transport()），AcsClient 在进程内复用，不会每条短信都重新创建。
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import json
+import threading
+
+from aliyunsdkcore.client import AcsClient
+from aliyunsdkcore.request import CommonRequest
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+class AliyunSmsTransport:
+    """
+    通过阿里云 SDK 发送短信
+
+    相关配置：
+    * ALI_SMS_ACCESS_KEY_ID、ALI_SMS_ACCESS_KEY_SECRET
+    * ALI_SMS_ENDPOINT：API 地址，默认为 dysmsapi.aliyuncs.com，测试时可以指向本地模拟服务
+    * ALI_SMS_PROTOCOL：默认为 https
+    * ALI_SMS_PORT：默认为 80（阿里云 SDK 的默认值，https 时不会使用）
+    """
+    # SendBatchSms 一次最多支持 100 个手机号
+    MAX_BATCH_SIZE = 100
+
+    def __init__(self):
+        self.endpoint = getattr(settings, 'ALI_SMS_ENDPOINT', 'dysmsapi.aliyuncs.com')
+        self.protocol = getattr(settings, 'ALI_SMS_PROTOCOL', 'https')
+        self.client = AcsClient(
+                settings.ALI_SMS_ACCESS_KEY_ID,
+                settings.ALI_SMS_ACCESS_KEY_SECRET,
+                'default',
+                port = getattr(settings, 'ALI_SMS_PORT', 80),
+                )
+
+    def make_request(self, action):
+        request = CommonRequest()
+        request.set_accept_format('json')
+        request.set_domain(self.endpoint)
+        request.set_method('POST')
+        request.set_protocol_type(self.protocol)
+        request.set_version('2017-05-25')
+        request.set_action_name(action)
+        return request
+
+    def do_action(self, request):
+        try:
+            response = self.client.do_action_with_exception(request)
+        except ServerException as e:
+            # 服务端返回的业务错误（例如流控、手机号非法），与原来 do_action() 的行为一致，作为响应返回
+            return dict(Code=e.get_error_code(), Message=e.get_error_msg(), RequestId=e.get_request_id())
+        return json.loads(response)
+
+    def send(self, phone_numbers, signature_name, template_code, template_param):
+        request = self.make_request('SendSms')
+        request.add_query_param('PhoneNumbers', phone_numbers)
+        request.add_query_param('SignName', signature_name)
+        request.add_query_param('TemplateCode', template_code)
+        if not isinstance(template_param, str):
+            template_param = json.dumps(template_param)
+        request.add_query_param('TemplateParam', template_param)
+        return self.do_action(request)
+
+    def send_batch(self, template_code, messages):
+        request = self.make_request('SendBatchSms')
+        request.add_query_param('PhoneNumberJson', json.dumps([m[0] for m in messages]))
+        request.add_query_param('SignNameJson', json.dumps([m[1] for m in messages], ensure_ascii=False))
+        request.add_query_param('TemplateCode', template_code)
+        request.add_query_param('TemplateParamJson', json.dumps([m[2] for m in messages], ensure_ascii=False))
+        return self.do_action(request)
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                path = getattr(settings, 'ALI_SMS_TRANSPORT', 'natureself.django.notification.sms.AliyunSmsTransport')
+                _transport = import_string(path)()
+    return _transport
@@ -0,0 +1,156 @@
+"""
+邮件模板预编译缓存
+
+使用模板发送邮件时，EmailMessage 需要：渲染模板、用 BeautifulSoup 解析两次 HTML（render_content、sanitize_content）、
+premailer 将 css 改为 inline、htmlmin 压缩，以及从磁盘读取每张图片并用 libmagic 检测类型、编码为 MIME。
+对于验证码这类邮件，每次发送时只有验证码不同，其他处理的结果完全相同。
+
+因此我们对每个模板预先「编译」一次：用占位符代替 context 中的变量渲染模板，完成上述所有处理，得到 HTML 骨架
+和编码好的 MIME 图片；之后发送时只需要把占位符替换为实际的值。
+
+为了保证结果与不使用缓存时完全相同，只有满足以下条件时才会使用缓存，否则按照原来的方式处理：
+* 没有传入 request（context processor 的结果可能与请求相关）
+* context 中所有的值都是字符串，且不包含需要 HTML 转义的字符、空白字符（htmlmin 会改变连续的空白）
+* 编译时，用实际的 context 按照原来的方式处理一次，与骨架替换后的结果比较，不一致（例如模板中对变量使用了过滤器，
+  或者根据变量的值使用了 {% if %}）时，该模板不再使用缓存
+
+注意：如果模板根据变量的值选择不同的内容（例如 {% if code == '000000' %}），编译时的检查不一定能发现，
+这类模板请在 send_mail() 中传入 compiled=False。
+
+缓存保存在进程内，key 为模板名称和 context 中的变量名，模板文件、图片文件的 mtime 变化时会重新编译。
+
+相关配置：
+
+    EMAIL_TEMPLATE_CACHE = True     # 是否启用，默认启用
+"""
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.template.loader import get_template
+
+import os
+import re
+import uuid
+import threading
+
+import magic
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'EMAIL_TEMPLATE_CACHE', True)
+
+# 可以直接替换的值：不需要 HTML 转义，且不包含连续的空白字符、换行
+SAFE_VALUE_PATTERN = re.compile(r'[^\s&<>"\']*( [^\s&<>"\']+)*')
+
+_static_images = {}
+_templates = {}
+_lock = threading.Lock()
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+def get_static_image(static_name):
+    """
+    读取静态图片，返回 (文件路径, 内容, mimetype)，结果按照文件 mtime 缓存
+    """
+    path = finders.find(static_name)
+    mtime = get_mtime(path)
+    cached = _static_images.get(static_name)
+    if cached and cached[0] == path and cached[1] == mtime:
+        return cached[2]
+
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    image = (path, content, magic.from_buffer(content, mime=True))
+    _static_images[static_name] = (path, mtime, image)
+    return image
+
+class CompiledTemplate:
+    def __init__(self, content, images, placeholders, files):
+        # 处理完成的 HTML 骨架，其中的变量为占位符
+        self.content = content
+        # [(content_id, content, mimetype), ...]，与 EmailMessage.images 相同
+        self.images = images
+        # 编码好的 MIME 图片，所有使用该模板的邮件共用（只会被序列化，不会被修改）
+        self.image_parts = None
+        # {变量名: 占位符}
+        self.placeholders = placeholders
+        # {文件路径: mtime}，用于检查缓存是否过期
+        self.files = files
+
+    def is_stale(self):
+        return any(get_mtime(path) != mtime for path, mtime in self.files.items())
+
+    def render(self, context):
+        content = self.content
+        for key, placeholder in self.placeholders.items():
+            content = content.replace(placeholder, context[key])
+        return content
+
+# 编译失败、或者结果与原来的方式不一致的模板，不再尝试编译
+UNCOMPILABLE = object()
+
+def can_compile(context, request=None):
+    if not ENABLED or request is not None:
+        return False
+    return all(isinstance(value, str) and SAFE_VALUE_PATTERN.fullmatch(value) for value in (context or {}).values())
+
+def compile_template(message, template, context):
+    """
+    编译模板，message 为 EmailMessage，用于调用 render_content、sanitize_content 等方法
+    """
+    # 占位符只包含字母和数字，不会被 premailer、htmlmin 改变
+    token = uuid.uuid4().hex
+    placeholders = {key: f'nsvar{token}{i}x' for i, key in enumerate(sorted(context))}
+
+    content, images = message.render_content(template, context=placeholders)
+    content, images = message.sanitize_content(content, images)
+
+    files = {}
+    template_path = getattr(get_template(template).origin, 'name', None)
+    if template_path and os.path.exists(template_path):
+        files[template_path] = get_mtime(template_path)
+    for path in message.image_files:
+        files[path] = get_mtime(path)
+
+    compiled = CompiledTemplate(content, images, placeholders, files)
+
+    # 检查：用实际的值按照原来的方式处理一次，结果应该完全相同
+    expected, expected_images = message.sanitize_content(*message.render_content(template, context=context))
+    if compiled.render(context) != expected or compiled.images != expected_images:
+        logger.warning(f'Email template {template} can not be compiled, using slow path')
+        return UNCOMPILABLE
+
+    compiled.image_parts = [message.create_inline_image(*image) for image in images]
+    return compiled
+
+def get_compiled_template(message, template, context=None, request=None):
+    """
+    获取编译好的模板，不能使用缓存时返回 None
+    """
+    context = context or {}
+    if not can_compile(context, request):
+        return None
+
+    key = (template, tuple(sorted(context)))
+    compiled = _templates.get(key)
+    if compiled is None or (compiled is not UNCOMPILABLE and compiled.is_stale()):
+        with _lock:
+            compiled = _templates.get(key)
+            if compiled is None or (compiled is not UNCOMPILABLE and compiled.is_stale()):
+                try:
+                    compiled = compile_template(message, template, context)
+                except Exception as e:
+                    # 例如图片地址中使用了变量，交给原来的方式处理（会抛出原来的异常）
+                    logger.warning(f'Error while compiling email template {template}: {e}')
+                    compiled = UNCOMPILABLE
+                _templates[key] = compiled
+
+    return None if compiled is UNCOMPILABLE else compiled
+
+def clear():
+    _static_images.clear()
+    _templates.clear()
@@ -0,0 +1,68 @@
+"""
+令牌桶限流
+
+令牌桶以固定的速度补充令牌，每次操作消耗令牌，令牌不足时拒绝（或等待）。桶的容量决定了允许的突发数量。
+例如 TokenBucket(5, 3600) 表示最多连续发送 5 条，之后平均每 720 秒恢复 1 条。
+
+桶的状态可以保存在进程内（key 为 None），也可以保存在 Django 缓存中（多进程共享，例如按手机号、IP 限流）。
+保存在缓存中时，读取、写回不是原子操作，并发请求可能会多消耗少量令牌，对于限流来说这是可以接受的。
+"""
+from django.core.cache import cache
+
+import time
+
+class TokenBucket:
+    def __init__(self, capacity, period, key=None):
+        """
+        capacity: 桶的容量，即允许的突发数量
+        period: 补充 capacity 个令牌需要的时间（秒）
+        key: 缓存的 key，为 None 时状态保存在进程内
+        """
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.key = f'ns:throttle:{key}' if key else None
+        self.timeout = max(int(period * 2), 1)
+        self._state = None
+
+    def _load(self, now):
+        state = cache.get(self.key) if self.key else self._state
+        if state is None:
+            return self.capacity, now
+        tokens, updated_at = state
+        return min(self.capacity, tokens + (now - updated_at) * self.rate), now
+
+    def _save(self, tokens, now):
+        if self.key:
+            cache.set(self.key, (tokens, now), timeout=self.timeout)
+        else:
+            self._state = (tokens, now)
+
+    def consume(self, tokens=1):
+        """
+        尝试消耗令牌，成功返回 True，令牌不足时返回 False（不消耗令牌）
+        """
+        available, now = self._load(time.time())
+        if available < tokens:
+            return False
+        self._save(available - tokens, now)
+        return True
+
+    def wait(self, tokens=1):
+        """
+        消耗令牌，令牌不足时等待，一般只在 worker 进程中使用
+        """
+        while True:
+            available, now = self._load(time.time())
+            if available >= tokens:
+                self._save(available - tokens, now)
+                return
+            time.sleep((tokens - available) / self.rate)
+
+def get_bucket(config, key=None):
+    """
+    根据配置 (capacity, period) 创建令牌桶，配置为 None 时返回 None（不限流）
+    """
+    if not config:
+        return None
+    capacity, period = config
+    return TokenBucket(capacity, period, key=key)
@@ -1,6 +1,5 @@
 from django.template.loader import render_to_string
 from django.conf import settings
-from django.contrib.staticfiles import finders
 from django.core.mail.message import forbid_multi_line_headers
 from django.core.mail.utils import DNS_NAME
 from django.core.mail import get_connection
@@ -25,8 +24,12 @@ import logging
 logger = logging.getLogger(__name__)
 
 from .models import Email, send_sms
+from .templatecache import get_compiled_template, get_static_image
 
 DRYRUN = getattr(settings, 'EMAIL_DRY_RUN', False)
+# 为 True 时，send_mail() 只将邮件加入待发送队列，由 `manage.py send_queued_mail` 异步发送，
+# 见 natureself.django.notification.outbox
+QUEUE = getattr(settings, 'EMAIL_QUEUE', False)
 
 """
 Django 本身提供了很好用的发送邮件的功能。但是我们希望所有程序发出的邮件都可以被存档以备后续查阅，
@@ -61,6 +64,10 @@ Django 封装的 `send_mail` 还是不太好用，例如不支持附件、内嵌
     # 函数内会处理好内嵌图片，所有图片请使用 {% static %} 引入
     send_mail(to, subject, template='path/to/template.html', context={...})
 
+    # 使用模板发送时，默认会使用预编译的模板（见 natureself.django.notification.templatecache），
+    # 如果模板会根据变量的值选择不同的内容，需要传入 compiled=False
+    send_mail(to, subject, template='path/to/template.html', context={...}, compiled=False)
+
     # 可以通过 attachments 参数来带附件，其中 attachment 是一个三元组：
     #   (filename, content, mimetype)
     #  * filename: 附件显示的文件名
@@ -74,10 +81,13 @@ Django 封装的 `send_mail` 还是不太好用，例如不支持附件、内嵌
     #  * content、mimetype 与 attachment 相同
     # XXX 不建议这样使用，我们发送 HTML 邮件时，应该尽量使用 Django 模板来构造邮件内容
     send_mail(to, subject, content, images=[...])
+
+send_mail 返回数据库中的 Email 对象。如果开启了 settings.EMAIL_QUEUE，返回时邮件还没有发送，状态为 pending。
 """
 
 def send_mail(to, subject, from_email=None,
         content=None, plain=False, template=None, context=None, request=None, images=None, attachments=None,
+        compiled=True,
         ):
 
     message = EmailMessage(
@@ -85,6 +95,7 @@ def send_mail(to, subject, from_email=None,
             content=content, plain=plain,
             template=template, context=context, request=request,
             images=images, attachments=attachments,
+            compiled=compiled,
         )
 
     return message.send()
@@ -102,6 +113,7 @@ class EmailMessage:
 
     def __init__(self, to, subject, from_email=None,
             content=None, plain=False, template=None, context=None, request=None, images=None, attachments=None,
+            compiled=True,
             ):
 
         # 调用时，应该提供 content 或 template 二者之一（不能两个都不提供或两个都提供）
@@ -109,12 +121,23 @@ class EmailMessage:
         if (not content and not template) or (content and template):
             raise ValueError('Must provide one and only one of "content" or "template"')
 
-        if content:
-            content = f'<pre>\n{content}\n<pre>' if plain else content
+        # 预编译模板中已经编码好的 MIME 图片
+        self.image_parts = None
+
+        compiled_template = None
+        if template and compiled:
+            compiled_template = get_compiled_template(self, template, context=context, request=request)
+
+        if compiled_template:
+            content, images = compiled_template.render(context or {}), compiled_template.images
+            self.image_parts = compiled_template.image_parts
         else:
-            content, images = self.render_content(template, context=context, request=request)
+            if content:
+                content = f'<pre>\n{content}\n<pre>' if plain else content
+            else:
+                content, images = self.render_content(template, context=context, request=request)
 
-        content, images = self.sanitize_content(content, images)
+            content, images = self.sanitize_content(content, images)
 
         self.to = to if isinstance(to, list) else [str(to)]
         self.subject = subject
@@ -137,7 +160,10 @@ class EmailMessage:
         msg_text = MIMEText(self.content, 'html', 'utf-8')
         msg_content.attach(msg_text)
 
-        if self.images:
+        if self.image_parts:
+            for part in self.image_parts:
+                msg_content.attach(part)
+        elif self.images:
             for image in self.images:
                 msg_content.attach(self.create_inline_image(*image))
 
@@ -149,25 +175,33 @@ class EmailMessage:
         return msg_root
 
     def send(self):
+        queued = QUEUE and not DRYRUN
         email = Email.objects.create(
                 subject = self.subject,
                 from_email = self.from_email,
                 recipients = self.recipients(),
                 content = self.content,
                 message = self.message(),
+                next_attempt_at = timezone.now() if queued else None,
                 )
 
+        if queued:
+            # 邮件已经保存到文件中，由 worker 进程读取后发送
+            return email
+
         exc = None
 
         email.sent_at = timezone.now()
         if DRYRUN:
             email.status = Email.STATUSES.dryrun
         else:
+            email.attempts = 1
             try:
                 connection = get_connection()
                 connection.send_messages([self])
             except Exception as e:
                 email.status = Email.STATUSES.failed
+                email.last_error = str(e)
                 exc = e
             else:
                 email.status = Email.STATUSES.success
@@ -243,6 +277,8 @@ class EmailMessage:
     def render_content(self, template, context=None, request=None):
         content = render_to_string(template, context=context, request=request)
         images = []
+        # 引用的静态图片的文件路径，预编译模板时用于检查文件是否变化
+        self.image_files = []
 
         soup = BeautifulSoup(content, 'html.parser')
         for img in soup.find_all('img'):
@@ -260,15 +296,14 @@ class EmailMessage:
             #   static('app/img/awesome.png') -> returns {STATIC_URL}app/img/awesome.png
             # so, for the reversed approach, we first left strip off STATIC_URL, then use finders to find the filesystem path
             static_name = src[len(settings.STATIC_URL):]
-            static_file = finders.find(static_name)
 
             content_id = str(len(images) + 1)
             img['src'] = f'cid:{content_id}'
 
-            with open(static_file, 'rb') as fp:
-                content = fp.read()
-                mimetype = magic.from_buffer(content, mime=True)
-                images.append((content_id, content, mimetype))
+            # 图片内容、类型按照文件 mtime 缓存，不需要每次都读取文件、检测类型
+            static_file, content, mimetype = get_static_image(static_name)
+            self.image_files.append(static_file)
+            images.append((content_id, content, mimetype))
 
         return str(soup), images
 
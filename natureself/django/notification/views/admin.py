@@ -30,7 +30,7 @@ class EmailView(AdminView):
             * recipient: filter recipients with 'icontains'
             * status: filter status with '='
             * sent_range: filter email sent between date, format: 2019-03-21,2019-03-22
-            * pagination params (page=1, page_size=10)
+            * pagination params (page=1, page_size=10), or cursor pagination params (cursor=xxx, page_size=10)
 
     GET /api/admin/notification/emails/{id}
         description: get email model
@@ -52,6 +52,9 @@ class EmailView(AdminView):
     MODEL = Email
     ORDER_BY = ['-sent_at']
     USE_PAGINATION = True
+    # 发送记录会越来越多，支持游标分页（请求中不带 page 参数时），总数使用估算值
+    PAGINATION_MODE = 'cursor'
+    PAGINATION_COUNT = 'estimate'
 
     CREATE_METHOD = 'create_email'
     UPDATE_METHOD = None
@@ -66,6 +69,20 @@ class EmailView(AdminView):
         panels.DateRangePanel('sent_at', form_field_name='sent_range', label='发送日期'),
         ], model=MODEL, form_mode='search')
 
+    # 包含收件人，异步导出的文件只有发起导出的用户（以及超级管理员）可以下载，见 natureself.django.export
+    EXPORT_FILENAME = '邮件发送记录'
+    EXPORT_COLUMNS = [
+        ('ID', 'id', 8),
+        ('标题', 'subject', 40),
+        ('发件人', 'from_email', 30),
+        ('收件人', 'recipients', 40),
+        ('状态', 'status', 10),
+        ('创建时间', 'created_at', 20),
+        ('发送时间', 'sent_at', 20),
+        ('尝试次数', 'attempts', None),
+        ('错误信息', 'last_error', 40),
+    ]
+
     def create_email(self, request):
         subject = request.json.get('subject')
         if not subject:
@@ -104,7 +121,7 @@ class AliSmsView(AdminView):
             * status: filter status with '='
             * sent_before: filter sms sent before the date, date format: '2019-03-21'
             * sent_after: filter sms sent after the date, date format: '2019-03-21'
-            * pagination params (page=1, page_size=10)
+            * pagination params (page=1, page_size=10), or cursor pagination params (cursor=xxx, page_size=10)
 
     GET /api/admin/notification/alisms/{id}
         description: get sms model
@@ -126,6 +143,9 @@ class AliSmsView(AdminView):
     MODEL = AliSms
     ORDER_BY = ['-sent_at']
     USE_PAGINATION = True
+    # 发送记录会越来越多，支持游标分页（请求中不带 page 参数时），总数使用估算值
+    PAGINATION_MODE = 'cursor'
+    PAGINATION_COUNT = 'estimate'
 
     CREATE_METHOD = 'create_sms'
     UPDATE_METHOD = None
@@ -139,6 +159,24 @@ class AliSmsView(AdminView):
         panels.DateRangePanel('sent_at', form_field_name='sent_range', label='发送日期'),
         ], model=MODEL, form_mode='search')
 
+    # 包含收件人，异步导出的文件只有发起导出的用户（以及超级管理员）可以下载，见 natureself.django.export
+    EXPORT_FILENAME = '短信发送记录'
+    EXPORT_COLUMNS = [
+        ('ID', 'id', 8),
+        ('手机号', 'phone_numbers', 20),
+        ('签名', 'signature_name', 15),
+        ('模板', 'template_code', 30),
+        ('内容', 'content', 60),
+        ('状态', 'status', 10),
+        ('创建时间', 'created_at', 20),
+        ('发送时间', 'sent_at', 20),
+        ('客户端 IP', 'client_ip', 15),
+        ('阿里云返回码', 'ali_code', 15),
+        ('阿里云返回信息', 'ali_message', 30),
+        ('尝试次数', 'attempts', None),
+        ('错误信息', 'last_error', 40),
+    ]
+
     def create_sms(self, request):
         phone_numbers = request.json.get('phone_numbers')
         if not phone_numbers:
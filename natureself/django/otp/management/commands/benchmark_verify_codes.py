@@ -0,0 +1,121 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import time
+import random
+import string
+
+from natureself.django.otp.models import SmsVerifyCode, EmailVerifyCode
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ('向验证码表中写入大量（默认最多 100 万条）验证码，测量 generate_code/verify_code 中的查询在不同数据量下的耗时。'
+            '所有数据在一个事务中写入，结束后回滚，不会保留在数据库中')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['sms', 'email'], default='sms')
+        parser.add_argument('--sizes', default='10000,100000,1000000', help='依次写入到这些数量后各测量一次，以逗号分隔')
+        parser.add_argument('--lookups', type=int, default=200, help='每次测量执行的查询次数')
+        parser.add_argument('--explain', action='store_true', help='输出最后一次测量时的查询计划')
+
+    def random_recipient(self):
+        return '1' + ''.join(random.choices(string.digits, k=10))
+
+    def random_session_key(self):
+        return ''.join(random.choices(string.ascii_lowercase + string.digits, k=32))
+
+    def seed(self, VCode, message, count):
+        """
+        写入 count 条验证码，大部分已经过期（生成时间在最近 90 天内均匀分布），返回 [(recipient, session_key)]
+        """
+        now = timezone.now()
+        keys = []
+        batch = []
+        for i in range(count):
+            recipient, session_key = self.random_recipient(), self.random_session_key()
+            keys.append((recipient, session_key))
+            generated_at = now - timezone.timedelta(seconds=random.randint(0, 90 * 86400))
+            batch.append(VCode(
+                    message = message,
+                    recipient = recipient,
+                    code = ''.join(random.choices(string.digits, k=6)),
+                    generated_at = generated_at,
+                    silent_before = generated_at + timezone.timedelta(seconds=VCode.DEFAULT_SILENT_DURATION),
+                    expires_at = generated_at + timezone.timedelta(seconds=VCode.DEFAULT_VALID_DURATION),
+                    session_key = session_key,
+                    verify_count = random.randint(0, 2),
+                    used = random.random() < 0.7,
+                    usage = random.choice(list(VCode.USAGES))[0],
+                    ))
+            if len(batch) >= 5000:
+                VCode.objects.bulk_create(batch)
+                batch = []
+        VCode.objects.bulk_create(batch)
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(VCode._meta.db_table)}')
+        return keys
+
+    def measure(self, VCode, keys, lookups):
+        """
+        返回 latest_silent、latest_valid 每次查询的平均耗时（毫秒）
+        """
+        # 一半查询已存在的手机号/会话，一半查询新的手机号/会话（即新用户请求验证码）
+        samples = [random.choice(keys) if i % 2 else (self.random_recipient(), self.random_session_key())
+                for i in range(lookups)]
+
+        result = []
+        for lookup in (
+                lambda recipient, session_key: VCode.objects.latest_silent(recipient, session_key),
+                lambda recipient, session_key: VCode.objects.latest_valid('login', recipient, session_key),
+                ):
+            start = time.perf_counter()
+            for recipient, session_key in samples:
+                try:
+                    lookup(recipient, session_key)
+                except VCode.DoesNotExist:
+                    pass
+            result.append((time.perf_counter() - start) / len(samples) * 1000)
+        return result
+
+    def explain(self, VCode, recipient, session_key):
+        # 与 latest_silent()、latest_valid() 相同的查询（latest() 即按照 -expires_at 排序取第一个）
+        self.stdout.write('latest_silent:')
+        self.stdout.write(VCode.objects
+                .filter(Q(recipient=recipient) | Q(session_key=session_key))
+                .filter(silent_before__gt=timezone.now())
+                .order_by('-expires_at')[:1].explain())
+        self.stdout.write('latest_valid:')
+        self.stdout.write(VCode.objects.filter_valid()
+                .filter(usage='login')
+                .filter(recipient=recipient, session_key=session_key)
+                .order_by('-expires_at')[:1].explain())
+
+    def handle(self, *args, **options):
+        VCode = SmsVerifyCode if options['engine'] == 'sms' else EmailVerifyCode
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+
+        try:
+            with transaction.atomic():
+                message = VCode._meta.get_field('message').related_model(status='dryrun')
+                message.save()
+
+                keys = []
+                for size in sizes:
+                    start = time.perf_counter()
+                    keys += self.seed(VCode, message, size - len(keys))
+                    seeded = time.perf_counter() - start
+                    silent, valid = self.measure(VCode, keys, options['lookups'])
+                    self.stdout.write(f'{size:>10} codes (seeded in {seeded:.1f}s): '
+                            f'latest_silent {silent:.3f} ms, latest_valid {valid:.3f} ms')
+
+                if options['explain']:
+                    self.explain(VCode, *keys[0])
+                raise Rollback()
+        except Rollback:
+            pass
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from natureself.django.otp import ratelimit
+
+class Command(BaseCommand):
+    help = '查看发送验证码的限流统计：每个限流器命中（hit，请求被拒绝）与未命中（miss，请求通过）的次数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='输出后清零')
+
+    def handle(self, *args, **options):
+        for name, metrics in ratelimit.get_metrics().items():
+            total = metrics['hit'] + metrics['miss']
+            rate = metrics['hit'] / total * 100 if total else 0
+            self.stdout.write(f'{name:<10} hit {metrics["hit"]:>8}  miss {metrics["miss"]:>8}  ({rate:.1f}% rejected)')
+        if options['reset']:
+            ratelimit.reset_metrics()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import datetime
+
+from natureself.django.otp.models import SmsVerifyCode, EmailVerifyCode
+
+class Command(BaseCommand):
+    help = '分批删除过期很久的短信/邮件验证码，需要定期执行（例如每天一次）。发送记录（AliSms、Email）不会删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=30,
+                help='只删除过期超过指定天数的验证码，默认为 30 天')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批（每个事务）删除的数量')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['min_age'])
+        for model in (SmsVerifyCode, EmailVerifyCode):
+            count = model.objects.delete_expired(before, batch_size=options['batch_size'])
+            self.stdout.write(f'{model._meta.label}: {count} expired code(s) deleted')
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otp', '0002_auto_20190428_1629'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailverifycode',
+            index=models.Index(fields=['recipient', 'silent_before'], name='otp_emailcode_silent_rcpt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailverifycode',
+            index=models.Index(fields=['session_key', 'silent_before'], name='otp_emailcode_silent_sess_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailverifycode',
+            index=models.Index(condition=models.Q(used=False), fields=['recipient', 'session_key', 'usage', '-expires_at'], name='otp_emailcode_valid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailverifycode',
+            index=models.Index(fields=['expires_at'], name='otp_emailcode_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsverifycode',
+            index=models.Index(fields=['recipient', 'silent_before'], name='otp_smscode_silent_rcpt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsverifycode',
+            index=models.Index(fields=['session_key', 'silent_before'], name='otp_smscode_silent_sess_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsverifycode',
+            index=models.Index(condition=models.Q(used=False), fields=['recipient', 'session_key', 'usage', '-expires_at'], name='otp_smscode_valid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsverifycode',
+            index=models.Index(fields=['expires_at'], name='otp_smscode_expires_idx'),
+        ),
+    ]
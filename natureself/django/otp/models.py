@@ -1,12 +1,20 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.conf import settings
 from django.utils import timezone
 from natureself.django.notification.tools import send_sms, send_mail
+from natureself.django.core.utils import get_client_ip
 
 import random
 import jsonfield
 from model_utils import Choices
 
+class MessageRejected(Exception):
+    """
+    消息没有发送（例如超过了短信的单手机号、单 IP 频率限制），此时不会创建验证码
+    """
+    pass
+
 class VerifyCodeManager(models.Manager):
     def create(self, request, recipient, usage, silent_duration=None, valid_duration=None, clone=None):
         silent_duration = silent_duration or self.model.DEFAULT_SILENT_DURATION
@@ -18,7 +26,10 @@ class VerifyCodeManager(models.Manager):
         else:
             code = ''.join(random.choices('0123456789', k=6))
 
-        message = self.model.send_message(recipient, usage, code)
+        message = self.model.send_message(recipient, usage, code, client_ip=get_client_ip(request))
+        # 消息没有发送时，不能创建验证码（否则客户端会认为验证码已发送）
+        if self.model.is_rejected(message):
+            raise MessageRejected(f'message to {recipient} rejected')
 
         return super().create(
                 message = message,
@@ -31,7 +42,7 @@ class VerifyCodeManager(models.Manager):
                 verify_count = 0,
                 used = False,
                 client_meta = dict(
-                    client_ip = request.META['REMOTE_ADDR'],
+                    client_ip = get_client_ip(request),
                     user_agent = request.META.get('HTTP_USER_AGENT', ''),
                     ),
                 clone = clone,
@@ -43,6 +54,58 @@ class VerifyCodeManager(models.Manager):
                    .filter(verify_count__lt=self.model.VERIFY_COUNT_LIMIT) \
                    .filter(used=False)
 
+    # 以下两个查询是 generate_code/verify_code 中的查询，索引（见 get_indexes()）与这两个查询对应，修改时需要一起修改
+
+    def latest_silent(self, recipient, session_key, now=None):
+        """
+        相应的手机号或邮箱、或者相应的会话中，还未到 silent_before 的最新的验证码，没有时抛出 DoesNotExist
+        """
+        return self.filter(Q(recipient=recipient) | Q(session_key=session_key)) \
+                   .filter(silent_before__gt=now or timezone.now()) \
+                   .latest('expires_at')
+
+    def latest_valid(self, usage, recipient, session_key):
+        """
+        仍有效的最新的验证码，没有时抛出 DoesNotExist
+        """
+        return self.filter_valid() \
+                   .filter(usage=usage) \
+                   .filter(recipient=recipient, session_key=session_key) \
+                   .latest('expires_at')
+
+    def delete_expired(self, before, batch_size=1000):
+        """
+        分批删除 before 之前已经过期的验证码，每批一个事务，避免长时间锁表，返回删除的数量
+        """
+        total = 0
+        while True:
+            ids = list(self.filter(expires_at__lt=before).order_by('expires_at').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return total
+            with transaction.atomic():
+                # 从被删除的验证码复制的验证码（clone）会被设置为 NULL
+                self.filter(id__in=ids).delete()
+            total += len(ids)
+
+def get_indexes(prefix):
+    """
+    验证码表的索引。Django 2.2 中抽象模型的索引名称不能包含模型名，因此由子类分别定义：
+
+        class Meta:
+            indexes = get_indexes('otp_smscode')
+    """
+    return [
+        # latest_silent()：recipient 与 session_key 是 OR 条件，分别使用一个索引（BitmapOr），
+        # 静默期内的记录只有最近一分钟的，与表的大小无关
+        models.Index(fields=['recipient', 'silent_before'], name=f'{prefix}_silent_rcpt_idx'),
+        models.Index(fields=['session_key', 'silent_before'], name=f'{prefix}_silent_sess_idx'),
+        # latest_valid()：等值条件在前，按 expires_at 倒序，只包含未使用的验证码
+        models.Index(fields=['recipient', 'session_key', 'usage', '-expires_at'], name=f'{prefix}_valid_idx',
+            condition=Q(used=False)),
+        # delete_expired()
+        models.Index(fields=['expires_at'], name=f'{prefix}_expires_idx'),
+    ]
+
 class VerifyCode(models.Model):
     """
     短信/邮件验证码，每一个 VerifyCode 对应一条真实发送的信息。
@@ -88,6 +151,13 @@ class VerifyCode(models.Model):
             )
     usage = models.TextField(choices=USAGES)
 
+    @classmethod
+    def is_rejected(cls, message):
+        """
+        send_message() 返回的消息是否被拒绝发送
+        """
+        return False
+
     def is_valid(self):
         return (self.expires_at > timezone.now()) \
                 and (self.verify_count < self.VERIFY_COUNT_LIMIT) \
@@ -107,6 +177,9 @@ class VerifyCode(models.Model):
             self.clone.mark_used(save)
 
 class SmsVerifyCode(VerifyCode):
+    class Meta:
+        indexes = get_indexes('otp_smscode')
+
     message = models.ForeignKey('notification.AliSms', models.CASCADE)
 
     SIGNATURE = settings.NS_OTP_ALI_SMS_SIGNATURE
@@ -118,15 +191,24 @@ class SmsVerifyCode(VerifyCode):
     DEFAULT_TEMPLATE_PARAM = settings.NS_OTP_ALI_SMS_DEFAULT_TEMPLATE_PARAM
 
     @classmethod
-    def send_message(cls, recipient, usage, code):
+    def send_message(cls, recipient, usage, code, client_ip=None):
         return send_sms(
                 phone_numbers = recipient,
                 signature_name = cls.SIGNATURE,
                 template_code = cls.TEMPLATES[usage],
                 template_param = dict(code=code, **cls.DEFAULT_TEMPLATE_PARAM),
+                client_ip = client_ip,
                 )
 
+    @classmethod
+    def is_rejected(cls, message):
+        # 超过频率限制的短信不会发送，状态为 reject，见 natureself.django.notification.models.alisms
+        return message.status == message.STATUSES.reject
+
 class EmailVerifyCode(VerifyCode):
+    class Meta:
+        indexes = get_indexes('otp_emailcode')
+
     message = models.ForeignKey('notification.Email', models.CASCADE)
 
     FROM = settings.NS_OTP_EMAIL_FROM
@@ -139,7 +221,7 @@ class EmailVerifyCode(VerifyCode):
     DEFAULT_TEMPLATE_CONTEXT = settings.NS_OTP_EMAIL_DEFAULT_TEMPLATE_CONTEXT
 
     @classmethod
-    def send_message(cls, recipient, usage, code):
+    def send_message(cls, recipient, usage, code, client_ip=None):
         return send_mail(
                 recipient,
                 cls.TITLE,
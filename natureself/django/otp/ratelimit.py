@@ -0,0 +1,165 @@
+"""
+发送验证码的限流（基于 Django 缓存）
+
+发送验证码的接口容易被滥用（短信轰炸、遍历手机号等），这里在查询数据库之前，先用缓存中的计数器拒绝过于频繁的请求：
+
+* 滑动窗口计数器：分别按接收者（手机号或邮箱）、会话、客户端 IP 以及全局计数，任何一个超过限制都会拒绝
+* 静默期：发送验证码后，在缓存中记录该接收者、会话的静默期（见 generate_code()），
+  静默期内的请求直接拒绝，不在静默期时 generate_code() 不需要再查询数据库
+
+滑动窗口使用两个固定窗口近似：当前窗口的计数 + 上一个窗口的计数 × 上一个窗口仍在滑动窗口中的比例。
+被拒绝的请求同样计数，持续请求的客户端会一直被拒绝，直到请求频率降下来。
+
+计数器、静默期需要在所有进程间共享，因此缓存不能是 LocMemCache（除非只有一个进程），
+可以是 FileBasedCache（单机）、Redis、Memcached 等。
+
+每个限流器的命中（hit，请求被拒绝）与未命中（miss，请求通过）次数记录在缓存中，
+通过 get_metrics() 或 `manage.py otp_rate_limit_stats` 查看。
+
+相关配置（均为可选）：
+
+    # (次数, 秒)，None 表示不限制
+    NS_OTP_RATE_LIMITS = {
+        'recipient': (10, 60 * 60),
+        'session': (10, 60 * 60),
+        'ip': (30, 60 * 60),
+        'global': (300, 60),
+    }
+    # 为 False 时不使用缓存记录静默期，generate_code() 每次都查询数据库
+    NS_OTP_SILENT_TRACKER = True
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from natureself.django.core.utils import get_client_ip
+
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMITS = {
+    'recipient': (10, 60 * 60),
+    'session': (10, 60 * 60),
+    'ip': (30, 60 * 60),
+    'global': (300, 60),
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **getattr(settings, 'NS_OTP_RATE_LIMITS', {})}
+SILENT_TRACKER = getattr(settings, 'NS_OTP_SILENT_TRACKER', True)
+
+KEY_PREFIX = 'ns:otp:ratelimit'
+
+def incr(key, timeout):
+    """
+    计数器加一，返回加一后的值。memcached、redis 中 incr 是原子操作
+    """
+    # key 不存在时 incr 会抛出 ValueError，add 只在 key 不存在时写入
+    if cache.add(key, 1, timeout=timeout):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # 在 add 与 incr 之间过期了
+        cache.set(key, 1, timeout=timeout)
+        return 1
+
+class SlidingWindow:
+    """
+    limit: 滑动窗口中允许的请求次数
+    window: 窗口长度（秒）
+    """
+    def __init__(self, name, limit, window):
+        self.name = name
+        self.limit = limit
+        self.window = window
+
+    def get_key(self, ident, index):
+        return f'{KEY_PREFIX}:{self.name}:{ident}:{index}'
+
+    def hit(self, ident, now=None):
+        """
+        记录一次请求，返回是否允许
+        """
+        now = now or time.time()
+        index, elapsed = divmod(now, self.window)
+        index = int(index)
+        # 保留两个窗口，下一个窗口中还需要读取上一个窗口的计数
+        current = incr(self.get_key(ident, index), timeout=self.window * 2)
+        previous = cache.get(self.get_key(ident, index - 1), 0)
+        return previous * (1 - elapsed / self.window) + current <= self.limit
+
+def get_limiter(name):
+    config = RATE_LIMITS.get(name)
+    if not config:
+        return None
+    limit, window = config
+    return SlidingWindow(name, limit, window)
+
+def record(name, hit):
+    incr(f'{KEY_PREFIX}:metrics:{name}:{"hit" if hit else "miss"}', timeout=None)
+
+def get_metrics():
+    """
+    返回 {name: {'hit': 次数, 'miss': 次数}}，name 为 silent 以及 NS_OTP_RATE_LIMITS 中的名称
+    """
+    names = ['silent'] + list(RATE_LIMITS)
+    keys = {f'{KEY_PREFIX}:metrics:{name}:{result}': (name, result) for name in names for result in ('hit', 'miss')}
+    values = cache.get_many(list(keys))
+    metrics = {name: {'hit': 0, 'miss': 0} for name in names}
+    for key, (name, result) in keys.items():
+        metrics[name][result] = values.get(key, 0)
+    return metrics
+
+def reset_metrics():
+    cache.delete_many([f'{KEY_PREFIX}:metrics:{name}:{result}'
+        for name in ['silent'] + list(RATE_LIMITS) for result in ('hit', 'miss')])
+
+def get_silent_keys(recipient, session_key):
+    keys = [f'{KEY_PREFIX}:silent:recipient:{recipient}']
+    if session_key:
+        keys.append(f'{KEY_PREFIX}:silent:session:{session_key}')
+    return keys
+
+def mark_silent(recipient, session_key, duration):
+    """
+    发送验证码后调用，记录接收者、会话在 duration 秒内处于静默期
+    """
+    if SILENT_TRACKER:
+        cache.set_many({key: True for key in get_silent_keys(recipient, session_key)}, timeout=duration)
+
+def is_silent(recipient, session_key):
+    """
+    接收者或会话是否处于静默期。不使用缓存记录静默期时总是返回 True（即需要查询数据库）
+    """
+    if not SILENT_TRACKER:
+        return True
+    return bool(cache.get_many(get_silent_keys(recipient, session_key)))
+
+def check(request, recipient):
+    """
+    检查是否允许向 recipient 发送验证码，允许时返回 None，否则返回被哪个限制拒绝（silent、recipient 等）
+    """
+    session_key = request.session.session_key
+
+    if SILENT_TRACKER:
+        silent = is_silent(recipient, session_key)
+        record('silent', silent)
+        if silent:
+            return 'silent'
+
+    for name, ident in (
+            ('recipient', recipient),
+            ('session', session_key),
+            ('ip', get_client_ip(request)),
+            ('global', 'all'),
+            ):
+        limiter = get_limiter(name)
+        if not limiter or not ident:
+            continue
+        allowed = limiter.hit(ident)
+        record(name, not allowed)
+        if not allowed:
+            logger.warning(f'send code rejected by {name} rate limit, recipient: {recipient}, ident: {ident}')
+            return name
+
+    return None
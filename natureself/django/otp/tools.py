@@ -1,10 +1,11 @@
-from django.db.models import Q
 from django.utils import timezone
 from natureself.django.core.validators import is_valid_email, is_valid_phone
 
+import math
 from model_utils import Choices
 
-from .models import VerifyCode, SmsVerifyCode, EmailVerifyCode
+from .models import VerifyCode, SmsVerifyCode, EmailVerifyCode, MessageRejected
+from . import ratelimit
 
 USAGES = VerifyCode.USAGES
 
@@ -15,6 +16,8 @@ GENERATE_RESULTS = Choices(
     ('invalid_recipient', 'invalid_recipient', '接收的手机号或邮箱无效'),
     # 在最近的静默期（默认一分钟）内
     ('silent', 'silent', '请求太频繁，未发送验证码'),
+    # 消息被拒绝发送（例如超过短信的单手机号、单 IP 频率限制），没有生成验证码
+    ('rejected', 'rejected', '超过发送频率限制，未发送验证码'),
 )
 
 def validate_recipient(engine, recipient):
@@ -24,6 +27,11 @@ def validate_recipient(engine, recipient):
         return True
     return False
 
+def mark_silent(vcode):
+    seconds = math.ceil((vcode.silent_before - timezone.now()).total_seconds())
+    if seconds > 0:
+        ratelimit.mark_silent(vcode.recipient, vcode.session_key, seconds)
+
 def generate_code(engine, request, recipient, usage, silent_duration=None, valid_duration=None):
     """
     生成验证码，返回 (verify_code, generate_result)
@@ -58,21 +66,20 @@ def generate_code(engine, request, recipient, usage, silent_duration=None, valid
     # * 如果该验证码仍有效（在有效期内、且未被标记为失效），则返回该验证码
     # * 如果验证码有效，但手机号不同、或 session 不同，则返回 None
     # * 如果该验证码已失效，则返回 None
-    try:
-        vcode = VCode.objects \
-                .filter(Q(recipient=recipient) | Q(session_key=session_key)) \
-                .filter(silent_before__gt=now) \
-                .latest('expires_at')
+    # 缓存中记录了静默期（见 natureself.django.otp.ratelimit），不在静默期时无需查询数据库
+    if ratelimit.is_silent(recipient, session_key):
+        try:
+            vcode = VCode.objects.latest_silent(recipient, session_key, now)
 
-        if not vcode.is_valid():
-            return None, GENERATE_RESULTS.silent
+            if not vcode.is_valid():
+                return None, GENERATE_RESULTS.silent
 
-        if vcode.recipient != recipient or vcode.session_key != session_key:
-            return None, GENERATE_RESULTS.silent
+            if vcode.recipient != recipient or vcode.session_key != session_key:
+                return None, GENERATE_RESULTS.silent
 
-        return vcode, GENERATE_RESULTS.silent
-    except VCode.DoesNotExist:
-        pass
+            return vcode, GENERATE_RESULTS.silent
+        except VCode.DoesNotExist:
+            pass
 
     # 当前不在静默期，因此允许生成新的校验码并发送消息
     # 我们首先查找是否存在有效的验证码，判断条件为：
@@ -86,19 +93,16 @@ def generate_code(engine, request, recipient, usage, silent_duration=None, valid
     # * 如果存在，则使用相同的 code 生成新的消息
     # * 如果不存在，则生成新的 code 并生成新的消息
     try:
-        vcode = VCode.objects \
-                .filter_valid() \
-                .filter(usage=usage) \
-                .filter(recipient=recipient, session_key=session_key) \
-                .latest('expires_at')
-
-        new = VCode.objects.create(request, recipient, usage, silent_duration=silent_duration, valid_duration=valid_duration, clone=vcode)
-        return new, GENERATE_RESULTS.ok
+        clone = VCode.objects.latest_valid(usage, recipient, session_key)
     except VCode.DoesNotExist:
-        pass
+        clone = None
 
-    # 生成新的 code，并发送信息
-    vcode = VCode.objects.create(request, recipient, usage, silent_duration=silent_duration, valid_duration=valid_duration)
+    # 发送信息，消息被拒绝发送（超过频率限制）时不会创建验证码
+    try:
+        vcode = VCode.objects.create(request, recipient, usage, silent_duration=silent_duration, valid_duration=valid_duration, clone=clone)
+    except MessageRejected:
+        return None, GENERATE_RESULTS.rejected
+    mark_silent(vcode)
     return vcode, GENERATE_RESULTS.ok
 
 def verify_code(engine, request, recipient, usage, code, mark_used_on_success=True):
@@ -145,11 +149,7 @@ def verify_code(engine, request, recipient, usage, code, mark_used_on_success=Tr
     # * 已经失效的验证码不增加校验计数，
     # * 对于一定会返回失败的操作不增加校验计数
     try:
-        vcode = VCode.objects \
-                .filter_valid() \
-                .filter(usage=usage) \
-                .filter(recipient=recipient, session_key=request.session.session_key) \
-                .latest('expires_at')
+        vcode = VCode.objects.latest_valid(usage, recipient, request.session.session_key)
     except VCode.DoesNotExist:
         return False
 
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
     'natureself.django.notification',
     'natureself.django.course',
     'natureself.django.otp',
+    'natureself.django.export',
 ]
 
 if not DEBUG:
@@ -127,6 +128,8 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = 'cardpc.User'
 AUTHENTICATION_BACKENDS = [
+    # 根据登录凭证的形式只使用一种方式登录，之后的后端只用于已登录用户的 session（见 DispatchBackend）
+    'natureself.django.account.backends.DispatchBackend',
     'django.contrib.auth.backends.ModelBackend',
     'natureself.django.account.backends.SmsCodeBackend',
     'natureself.django.account.backends.EmailCodeBackend',
@@ -166,6 +169,33 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
 MEDIA_URL = '/media/'
 
+# 不能公开访问的文件（例如导出的数据），不能放在 MEDIA_ROOT 下（MEDIA_ROOT 由 nginx 直接对外提供访问），
+# 只能在 Django 检查权限后下载。部署时与 MEDIA_ROOT 一样需要持久化，并挂载到 web（nginx）容器中
+NS_PRIVATE_MEDIA_ROOT = os.path.join(BASE_DIR, 'private')
+
+# 下载文件时（/download/...），Django 查找文件、检查权限（can_download()）后，由 nginx 发送文件内容：
+# MEDIA_ROOT 下的文件通过 /_media/，NS_PRIVATE_MEDIA_ROOT 下的文件通过 /_protected_media/（见 nginx.conf）。
+# 本地开发时没有 nginx，由 Django 发送文件
+NS_MEDIA_ACCEL_REDIRECT_PREFIX = None if DEBUG else '/_media/'
+NS_PRIVATE_MEDIA_ACCEL_REDIRECT_PREFIX = None if DEBUG else '/_protected_media/'
+
+# 缓存配置
+# 我们使用 gunicorn 多进程部署，Django 默认的 LocMemCache 是进程内的缓存，一个进程中的缓存失效，
+# 其他进程无法感知，因此默认使用文件缓存。生产环境可以在 settings_local.py 中改为 memcached 等。
+# 注意不要把缓存目录放在 MEDIA_ROOT 下，MEDIA_ROOT 是由 nginx 直接对外提供访问的。
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# 专题页面缓存时间（秒），见 cardpc.pagecache
+CARDPC_PAGE_CACHE_TIMEOUT = 60 * 10
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -196,6 +226,13 @@ LOGGING = {
 
 NS_REGISTER_VIEW = 'cardpc.views.account.api_register'
 
+# send_mail() 只将邮件加入队列，由单独的进程发送（entrypoint.sh mailer，即 manage.py send_queued_mail），
+# 避免 SMTP 服务器很慢时阻塞 gunicorn worker，见 natureself.django.notification.outbox
+EMAIL_QUEUE = True
+# send_sms() 只将短信加入队列，由单独的进程发送（entrypoint.sh smser，即 manage.py send_queued_sms），
+# 单手机号、单 IP 的频率限制见 natureself.django.notification.models.alisms
+ALI_SMS_QUEUE = True
+
 try:
     from nsproject.settings_local import *
 except ModuleNotFoundError as e:
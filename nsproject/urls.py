@@ -22,6 +22,7 @@ urlpatterns = [
     path('', include('natureself.django.notification.urls')),
     path('', include('natureself.django.account.urls')),
     path('', include('natureself.django.course.urls')),
+    path('', include('natureself.django.export.urls')),
 ]
 
 from django.conf import settings